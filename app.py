@@ -6,8 +6,10 @@ from tkinter import ttk, filedialog, messagebox
 
 import threading
 
-from download_json_core import run_download_json
+from download_json_core import run_download_json, run_sync_portraits, load_latest_txt
 from download_assets_core import run_download_assets
+from pipeline import run_pipeline
+import http_client
 
 def get_base_dir():
     if getattr(sys, 'frozen', False):
@@ -28,7 +30,7 @@ class DownloadApp(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("KPBeta Downloader")
-        self.geometry("600x420")
+        self.geometry("600x480")
         self.resizable(False, False)
         self._build_widgets()
         self._setup_logging()
@@ -64,13 +66,25 @@ class DownloadApp(tk.Tk):
             .grid(row=2, column=2, sticky="w", **pad)
 
         # ---- Options ----
+        options_frame = ttk.Frame(self)
+        options_frame.grid(row=3, column=1, sticky="w", **pad)
+
         self.modify_json_var = tk.BooleanVar(value=True)
         self.modify_check = ttk.Checkbutton(
-            self,
+            options_frame,
             text="Modify JSON (for Unity Player)",
             variable=self.modify_json_var
         )
-        self.modify_check.grid(row=3, column=1, sticky="w", **pad)
+        self.modify_check.pack(anchor="w")
+
+        # シナリオ取得と並行して、今回取得したシナリオのアセットだけを取得する
+        self.chain_assets_var = tk.BooleanVar(value=False)
+        self.chain_check = ttk.Checkbutton(
+            options_frame,
+            text="Also download assets for new scenarios",
+            variable=self.chain_assets_var
+        )
+        self.chain_check.pack(anchor="w")
         ttk.Button(
             self,
             text="Edit latest.txt",
@@ -99,12 +113,37 @@ class DownloadApp(tk.Tk):
         )
         self.assets_button.pack(side="left", padx=5)
 
+        self.portrait_button = ttk.Button(
+            btn_frame,
+            text="3. Sync Portraits",
+            width=20,
+            command=self._on_run_portraits
+        )
+        self.portrait_button.pack(side="left", padx=5)
+
+        self.retry_button = ttk.Button(
+            btn_frame,
+            text="Retry Failed Assets",
+            width=20,
+            command=self._on_run_retry
+        )
+        self.retry_button.pack(side="left", padx=5)
+
         # ---- Log / Result ----
         ttk.Label(self, text="Result").grid(row=5, column=0, sticky="nw", **pad)
 
         self.result_text = tk.Text(self, width=70, height=10, state="disabled")
         self.result_text.grid(row=5, column=1, columnspan=2, **pad)
 
+        # ---- Status ----
+        self.status_label = ttk.Label(self, text="待機中")
+        self.status_label.grid(row=6, column=0, sticky="w", **pad)
+
+        self.concurrency_label = ttk.Label(
+            self, text=f"Concurrency ({http_client.concurrency_mode}): {http_client.describe_concurrency()}"
+        )
+        self.concurrency_label.grid(row=6, column=1, columnspan=2, sticky="w", **pad)
+
     def _setup_logging(self):
         handler = TextHandler(self.result_text)
         formatter = logging.Formatter("[%(levelname)s] %(message)s")
@@ -177,6 +216,8 @@ class DownloadApp(tk.Tk):
         # ---- ボタン ----
         self.run_button.config(state=state)
         self.assets_button.config(state=state)
+        self.portrait_button.config(state=state)
+        self.retry_button.config(state=state)
 
         # ---- 入力欄 ----
         self.session_entry.config(state=state)
@@ -184,11 +225,27 @@ class DownloadApp(tk.Tk):
 
         # ---- チェックボックス・タブなど ----
         self.modify_check.config(state=state)
+        self.chain_check.config(state=state)
 
         # ---- ステータス表示（あれば）----
         if hasattr(self, "status_label"):
             self.status_label.config(text="処理中..." if running else "待機中")
 
+        self._running = running
+        self._poll_concurrency()
+
+    def _poll_concurrency(self):
+        # adaptive モードの現在の並列数を表示
+        if getattr(self, "_poll_job", None):
+            self.after_cancel(self._poll_job)
+            self._poll_job = None
+
+        self.concurrency_label.config(
+            text=f"Concurrency ({http_client.concurrency_mode}): {http_client.describe_concurrency()}"
+        )
+        if self._running:
+            self._poll_job = self.after(1000, self._poll_concurrency)
+
     
     # -----------------------------
     # Run logic
@@ -204,6 +261,7 @@ class DownloadApp(tk.Tk):
             target_list = [target]
         save_root = self.save_root_entry.get().strip()
         modify_json = self.modify_json_var.get()
+        chain_assets = self.chain_assets_var.get()
         
         os.makedirs(ICON_DIR, exist_ok=True)
         os.makedirs(ILLUST_DIR, exist_ok=True)
@@ -226,21 +284,30 @@ class DownloadApp(tk.Tk):
         # スレッドで実行（GUIフリーズ防止）
         thread = threading.Thread(
             target=self._run_download_thread,
-            args=(session, target_list, latest_dict, save_root, modify_json),
+            args=(session, target_list, latest_dict, save_root, modify_json, chain_assets),
             daemon=True
         )
 
         thread.start()
 
-    def _run_download_thread(self, session, target, latest_dict, save_root, modify_json):
+    def _run_download_thread(self, session, target, latest_dict, save_root, modify_json, chain_assets=False):
         try:
-            result = run_download_json(
-                session=session,
-                target=target,
-                latest_dict=latest_dict,
-                save_root=save_root,
-                modify_json=modify_json
-            )
+            if chain_assets:
+                result = run_pipeline(
+                    session=session,
+                    target=target,
+                    latest_dict=latest_dict,
+                    save_root=save_root,
+                    modify_json=modify_json
+                )
+            else:
+                result = run_download_json(
+                    session=session,
+                    target=target,
+                    latest_dict=latest_dict,
+                    save_root=save_root,
+                    modify_json=modify_json
+                )
 
             msg = result.get("message", "Completed.")
             success = result.get("success", True)
@@ -280,16 +347,93 @@ class DownloadApp(tk.Tk):
         )
         t.start()
 
-    def _run_assets_thread(self, data_directory):
+    def _on_run_retry(self):
+        data_directory = self.save_root_entry.get()
+
+        # UI ロック
+        self._set_running(True)
+
+        self._append_result("=== Start Retry of Failed Assets ===")
+
+        t = threading.Thread(
+            target=self._run_assets_thread,
+            args=(data_directory, True),
+            daemon=True
+        )
+        t.start()
+
+    def _run_assets_thread(self, data_directory, retry_only=False):
         try:
             result = run_download_assets(
-                data_directory=data_directory
+                data_directory=data_directory,
+                retry_only=retry_only
             )
 
             msg = result.get("message", "Assets download completed")
+            success = result.get("success", True)
+
+            self.after(0, self._append_result, msg)
+
+            if success:
+                self.after(0, messagebox.showinfo, "Completed", msg)
+            else:
+                self.after(0, messagebox.showwarning, "Completed with warnings", msg)
+
+        except Exception as e:
+            self.after(0, messagebox.showerror, "Error", str(e))
+
+        finally:
+            self.after(0, self._set_running, False)
+
+
+    def _on_run_portraits(self):
+        session = self.session_entry.get().strip()
+        target = self.target_var.get()
+
+        if target == "all":
+            target_list = ["kamihime", "eidolon", "soul", "memorial", "burst", "concierge"]
+        else:
+            target_list = [target]
+        save_root = self.save_root_entry.get().strip()
+
+        if not session:
+            messagebox.showerror("Error", "x-kh-session is required.")
+            return
+
+        if not os.path.isdir(save_root):
+            messagebox.showerror("Error", "Scenario folder not found")
+            return
 
+        latest_dict = load_latest_txt(LATEST_PATH)
+
+        # UI ロック
+        self._set_running(True)
+
+        self._append_result("=== Start Portrait Sync ===")
+
+        t = threading.Thread(
+            target=self._run_portraits_thread,
+            args=(session, target_list, latest_dict, save_root),
+            daemon=True
+        )
+        t.start()
+
+    def _run_portraits_thread(self, session, target, latest_dict, save_root):
+        try:
+            result = run_sync_portraits(
+                session=session,
+                target=target,
+                latest_dict=latest_dict,
+                save_root=save_root
+            )
+
+            msg = result.get("message", "Portraits synced.")
             self.after(0, self._append_result, msg)
-            self.after(0, messagebox.showinfo, "Completed", msg)
+
+            if result.get("success", True):
+                self.after(0, messagebox.showinfo, "Completed", msg)
+            else:
+                self.after(0, messagebox.showwarning, "Completed with warnings", msg)
 
         except Exception as e:
             self.after(0, messagebox.showerror, "Error", str(e))
@@ -318,22 +462,6 @@ class TextHandler(logging.Handler):
 # -----------------------------
 # latest editor
 # -----------------------------
-def load_latest_txt(path: str) -> dict:
-    latest = {}
-    if not os.path.exists(path):
-        return latest
-
-    with open(path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            if ':' not in line:
-                continue
-            key, value = line.split(':', 1)
-            latest[key.strip()] = value.strip()
-    return latest
-
 def save_latest_txt(path: str, text: str):
     with open(path, 'w', encoding='utf-8') as f:
         f.write(text)
@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import sqlite3
+import logging
+import threading
+
+# asset_manifest.py
+# アセット実行用のシナリオごとのキャッシュ (asset_manifest.db, SQLite)。
+#   metas  : シナリオの .json -> scenario_path / resource_directory
+#   scripts: *_script.ks / *_script.json -> 素材の (link, resource_directory) 一覧
+# どちらもファイルの size + mtime が同じなら読まずに使う。mtime だけ変わった
+# (コピーし直した等) ときは sha1 を比べ、中身が同じならそのまま使う。
+# link は接続先 (STATIC_BASE) からの相対で持ち、接続先が変わったら使わない。
+# 分担モードでは複数のプロセスが同じ db を開く。書き込めなかった分は次の実行で作り直すだけなので
+# エラーは警告にとどめる。
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS metas (
+        path              TEXT PRIMARY KEY,
+        size              INTEGER,
+        mtime             REAL,
+        scenario_path     TEXT,
+        resource_directory TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scripts (
+        path              TEXT PRIMARY KEY,
+        size              INTEGER,
+        mtime             REAL,
+        sha1              TEXT,
+        base              TEXT,
+        scenario_path     TEXT,
+        resource_directory TEXT,
+        items             TEXT
+    )
+    """,
+]
+
+
+def file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _key(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+class AssetManifest:
+
+    def __init__(self, path: str, base: str, commit_every: int = 200):
+        self.path = path
+        self.base = base.rstrip('/') + '/'
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        for sql in SCHEMA:
+            self._db.execute(sql)
+        self._db.commit()
+
+    def _write(self, sql: str, params: tuple):
+        try:
+            self._db.execute(sql, params)
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._db.commit()
+                self._pending = 0
+        except sqlite3.Error as e:
+            logging.warning("Failed to update %s : %s", self.path, e)
+
+    # -----------------------------
+    # scenario .json
+    # -----------------------------
+    def meta(self, json_path: str, st=None):
+        """
+        return: {"scenario_path", "resource_directory"} / 変わっていれば None
+        st: 走査で取れている stat (os.DirEntry.stat()) があれば渡す
+        """
+        st = st or os.stat(json_path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime, scenario_path, resource_directory FROM metas WHERE path=?",
+                (_key(json_path),)
+            ).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+            return None
+        return {"scenario_path": row[2], "resource_directory": row[3]}
+
+    def put_meta(self, json_path: str, meta: dict, st=None):
+        st = st or os.stat(json_path)
+        with self._lock:
+            self._write(
+                "INSERT OR REPLACE INTO metas VALUES (?, ?, ?, ?, ?)",
+                (_key(json_path), st.st_size, st.st_mtime,
+                 meta["scenario_path"], meta.get("resource_directory") or "")
+            )
+
+    # -----------------------------
+    # *_script.ks / *_script.json
+    # -----------------------------
+    def items(self, script_path: str, data: dict):
+        """return: (link, resource_directory) のリスト / 使えなければ None"""
+        try:
+            st = os.stat(script_path)
+        except OSError:
+            return None
+        key = _key(script_path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime, sha1, base, scenario_path, resource_directory, items "
+                "FROM scripts WHERE path=?", (key,)
+            ).fetchone()
+
+        if (row is None or row[0] != st.st_size or row[3] != self.base
+                or row[4] != data["scenario_path"] or row[5] != (data.get("resource_directory") or "")):
+            self.misses += 1
+            return None
+
+        if row[1] != st.st_mtime:
+            if file_sha1(script_path) != row[2]:
+                self.misses += 1
+                return None
+            with self._lock:
+                self._write("UPDATE scripts SET mtime=? WHERE path=?", (st.st_mtime, key))
+
+        self.hits += 1
+        return [(self.base + rel if not rel.startswith(("http://", "https://")) else rel, rd)
+                for rel, rd in json.loads(row[6])]
+
+    def put_items(self, script_path: str, data: dict, items: list):
+        st = os.stat(script_path)
+        rel_items = [
+            (link[len(self.base):] if link.startswith(self.base) else link, rd)
+            for link, rd in items
+        ]
+        with self._lock:
+            self._write(
+                "INSERT OR REPLACE INTO scripts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (_key(script_path), st.st_size, st.st_mtime, file_sha1(script_path), self.base,
+                 data["scenario_path"], data.get("resource_directory") or "",
+                 json.dumps(rel_items, ensure_ascii=False, separators=(",", ":")))
+            )
+
+    def close(self):
+        with self._lock:
+            try:
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.warning("Failed to update %s : %s", self.path, e)
+            finally:
+                self._db.close()
+        logging.info("Asset manifest: %d cached, %d parsed", self.hits, self.misses)
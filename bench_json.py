@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+import http_client
+import http_replay
+import job_journal
+import format_hints
+import write_csv
+import download_portrait as portrait
+import download_json_core as core
+from mock_server import MockServer, synthetic_fixtures, ids_from_latest
+
+# bench_json.py
+# JSON 段階 (iter_download_json) を mock_server.py のローカル API / CDN に向けて
+# 並列数ごとに回し、ID/秒・リクエスト/秒・ID ごとの所要時間 (p50 / p99) を表にする。
+# 保存先・index.csv・ジャーナル・ポートレートは一時フォルダに向けるので、
+# 手元のライブラリや設定には触らない。
+#
+#   python bench_json.py --latest latest.txt --concurrency 4,8,16,32 --latency 0.05
+#   python bench_json.py --ids 300 --latency 0.03 --error-rate 0.01
+# --replay を付けると mock ではなく記録した本番の通信 (http_replay.py) を再生して測る。
+#   python bench_json.py --latest latest.txt --replay traffic.jsonl.gz --speed 0.5
+
+TARGETS = ["kamihime", "eidolon", "soul", "memorial", "burst", "concierge"]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(pct / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def set_concurrency(n: int):
+    """api / static のゲートを n 本で固定する (worker_count もこれに従う)"""
+    for key in ("api", "static"):
+        http_client.limits[key] = http_client.AdaptiveLimit(key, n, n, n, False)
+
+
+def request_count(server) -> int:
+    if server is None:
+        return http_replay.replayer.served
+    return server.state.snapshot()["requests"]
+
+
+def run_once(server, target: list, latest_dict: dict, work_dir: str) -> dict:
+    save_root = os.path.join(work_dir, "save")
+    shutil.rmtree(save_root, ignore_errors=True)
+    job_journal.set_path(os.path.join(work_dir, "journal.jsonl"))
+    if os.path.exists(job_journal.JOURNAL_PATH):
+        os.remove(job_journal.JOURNAL_PATH)
+    write_csv.INDEX_PATH = os.path.join(work_dir, "index.csv")
+    if os.path.exists(write_csv.INDEX_PATH):
+        os.remove(write_csv.INDEX_PATH)
+    # ポートレートも毎回取り直させる (既存スキップで後の回だけ速く見えないように)
+    for path in (portrait.ICON_DIR, portrait.ILLUST_DIR):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+    if server is None:
+        http_replay.replayer.rewind()
+    before = request_count(server)
+    started = time.monotonic()
+    elapsed = []
+    statuses = {}
+    summary = {}
+
+    for record in core.iter_download_json(
+        session="bench",
+        target=target,
+        latest_dict=latest_dict,
+        save_root=save_root,
+        modify_json=False
+    ):
+        if record.get("kind") == "summary":
+            summary = record
+            continue
+        elapsed.append(record.get("elapsed", 0.0))
+        statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+
+    wall = time.monotonic() - started
+    requests_made = request_count(server) - before
+
+    return {
+        "ids": len(elapsed),
+        "wall": wall,
+        "ids_per_sec": len(elapsed) / wall if wall else 0.0,
+        "requests": requests_made,
+        "requests_per_sec": requests_made / wall if wall else 0.0,
+        "p50": percentile(elapsed, 50),
+        "p99": percentile(elapsed, 99),
+        "statuses": statuses,
+        "cancelled": summary.get("cancelled", False),
+        "reason": summary.get("reason", ""),
+    }
+
+
+def synthetic_latest(n: int) -> dict:
+    """latest.txt が無いときの小さな目次 (神姫・幻獣・スキンを n 件前後)"""
+    return {
+        "kamihime_5": str(n // 2),
+        "eidolon_5": str(n // 4),
+        "soul": str(n // 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the JSON stage against a local mock API/CDN")
+    parser.add_argument("--latest", default=None, help="latest.txt to derive the ID space from")
+    parser.add_argument("--ids", type=int, default=200, help="approximate ID count when --latest is not given")
+    parser.add_argument("--target", default="all")
+    parser.add_argument("--concurrency", default="1,4,8,16", help="comma separated settings to compare")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per setting (best is reported)")
+    parser.add_argument("--exist-ratio", type=float, default=0.8)
+    parser.add_argument("--latency", type=float, default=0.02, help="mock seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency spread (share of --latency)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 503 responses")
+    parser.add_argument("--expire-after", type=int, default=0, help="answer 440 after this many API requests")
+    parser.add_argument("--keep-rate-limit", action="store_true",
+                        help="keep the token buckets from setting.ini (default: unlimited)")
+    parser.add_argument("--replay", default=None, help="replay a traffic recording instead of the mock server")
+    parser.add_argument("--speed", type=float, default=1.0, help="latency scale for --replay (0 = no waiting)")
+    parser.add_argument("--work-dir", default=None, help="keep outputs here instead of a temp folder")
+    parser.add_argument("--verbose", action="store_true", help="show warnings (404s for missing IDs are expected)")
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+        console.setLevel(logging.WARNING)
+        logging.getLogger().addHandler(console)
+
+    target = TARGETS if args.target == "all" else args.target.split(",")
+    if args.latest:
+        latest_dict = core.load_latest_txt(args.latest)
+    else:
+        latest_dict = synthetic_latest(args.ids)
+
+    if not args.keep_rate_limit:
+        for bucket in http_client.buckets.values():
+            bucket.rate = 0
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="kp-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    portrait.ICON_DIR = os.path.join(work_dir, "portrait")
+    portrait.ILLUST_DIR = os.path.join(work_dir, "portrait_full")
+    format_hints.HINTS_PATH = os.path.join(work_dir, "format_hints.json")
+
+    if args.replay:
+        server = None
+        replayer = http_replay.start_replay(args.replay, args.speed)
+        print(f"replay: {args.replay} ({replayer.responses} responses), "
+              f"speed x{args.speed}")
+    else:
+        fixtures = synthetic_fixtures(ids_from_latest(latest_dict, target), args.exist_ratio)
+        server = MockServer(fixtures, latency=args.latency, jitter=args.jitter,
+                            error_rate=args.error_rate, expire_after=args.expire_after)
+        server.start()
+        core.set_base_urls(server.api_base, server.static_base)
+        print(f"mock: {len(fixtures['characters'])} characters, {len(fixtures['episodes'])} episodes, "
+              f"latency {args.latency * 1000:.0f} ms, 503 rate {args.error_rate:.1%}")
+    print(f"{'conc':>5} {'IDs':>6} {'wall s':>8} {'IDs/s':>8} {'req':>7} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8}  status")
+
+    rows = []
+    try:
+        for n in [int(x) for x in args.concurrency.split(",") if x.strip()]:
+            set_concurrency(n)
+            best = None
+            for _ in range(max(1, args.repeat)):
+                row = run_once(server, target, latest_dict, work_dir)
+                if best is None or row["wall"] < best["wall"]:
+                    best = row
+            best["concurrency"] = n
+            rows.append(best)
+            status = ", ".join(f"{k} {v}" for k, v in sorted(best["statuses"].items()))
+            if best["cancelled"]:
+                status += f" (cancelled: {best['reason']})"
+            print(f"{n:>5} {best['ids']:>6} {best['wall']:>8.2f} {best['ids_per_sec']:>8.1f} "
+                  f"{best['requests']:>7} {best['requests_per_sec']:>8.1f} "
+                  f"{best['p50'] * 1000:>8.0f} {best['p99'] * 1000:>8.0f}  {status}")
+    finally:
+        if server is not None:
+            server.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return 0 if rows and not any(row["cancelled"] for row in rows) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import configparser
+
+# blob_store.py
+# assets 以下のファイルを中身 (sha1) ごとに 1 つだけ持つ。
+#   assets/_blobs/ab/abcdef...   実体
+#   assets/<resource_directory>/...   実体へのハードリンク
+# 同じ playse や KSD の共通テクスチャ・ボイスが何十ものフォルダにあっても、ディスク上は 1 つになる。
+# ハードリンクが作れないファイルシステムでは _blobs に実体を置かず、最初に置いたファイルを
+# 元にしてコピーする (ディスクは減らないが、取り直し・変換のし直しはしない)。
+#
+# _blobs/index.jsonl に「元 → 最終的な中身の sha1」を 1 件 1 行で追記する。
+#   {"key": URL, "sha1"}              そのURLから取ったファイル (ogg は変換後の中身)
+#   {"key": "sha1:<元の sha1>", "sha1"}   KSD から出した変換前の中身 → 変換後の中身
+#   {"sha1", "path"}                  リンクできないときの元ファイル (assets からの相対)
+# 同じ key が既にあれば、ダウンロードや ktx / ffmpeg の変換をせずに place() で置くだけで済む。
+#
+# 置いたファイルは他のフォルダと同じ実体なので、その場で書き換えてはいけない。
+# 書き直すときは別名に書いて os.replace する (download_asset の .part、fix_ogg の _tmp.ogg と同じ)。
+
+BLOB_DIR = "_blobs"
+
+
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+config = configparser.RawConfigParser()
+config.read(os.path.join(BASE_DIR, "setting.ini"))
+enabled = config.getboolean('assets', 'blob_store', fallback=True)
+
+
+def file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BlobStore:
+
+    def __init__(self, root: str):
+        self.root = root
+        self.dir = os.path.join(root, BLOB_DIR)
+        self.index_path = os.path.join(self.dir, "index.jsonl")
+        self._keys = {}    # key -> sha1
+        self._paths = {}   # sha1 -> 元ファイル (リンクできないとき)
+        self._lock = threading.Lock()
+        self._file = None
+        self.stored = 0
+        self.linked = 0
+        self.copied = 0
+
+        os.makedirs(self.dir, exist_ok=True)
+        self.linkable = self._probe()
+        if not self.linkable:
+            logging.warning("Hard links are not supported under %s; duplicate assets are copied", root)
+        if os.path.exists(self.index_path):
+            self._load()
+
+    def _probe(self) -> bool:
+        src = os.path.join(self.dir, ".probe")
+        dst = src + ".link"
+        try:
+            with open(src, "wb"):
+                pass
+            os.link(src, dst)
+            return True
+        except OSError:
+            return False
+        finally:
+            for path in (src, dst):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _load(self):
+        with open(self.index_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた最終行
+                    continue
+                if "key" in rec:
+                    self._keys[rec["key"]] = rec["sha1"]
+                elif "path" in rec:
+                    self._paths[rec["sha1"]] = os.path.join(self.root, rec["path"])
+
+    def _append(self, rec: dict):
+        try:
+            if self._file is None:
+                self._file = open(self.index_path, "a", encoding="utf-8")
+            self._file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self._file.flush()
+        except OSError as e:
+            logging.error("Failed to write %s : %s", self.index_path, e)
+
+    def blob_path(self, sha1: str) -> str:
+        return os.path.join(self.dir, sha1[:2], sha1)
+
+    def source(self, sha1: str):
+        """その中身を持つファイル / 無ければ None"""
+        if self.linkable:
+            path = self.blob_path(sha1)
+        else:
+            path = self._paths.get(sha1)
+        return path if path and os.path.exists(path) else None
+
+    def lookup(self, key: str):
+        """key (URL など) の中身の sha1 / 実体が無ければ None"""
+        sha1 = self._keys.get(key)
+        if sha1 is None or self.source(sha1) is None:
+            return None
+        return sha1
+
+    def place(self, sha1: str, dst: str) -> bool:
+        """dst を sha1 の中身にする (リンク / コピー)。実体が無ければ False"""
+        src = self.source(sha1)
+        if src is None:
+            return False
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return True
+        tmp = dst + ".link"
+        try:
+            if self.linkable:
+                os.link(src, tmp)
+                self.linked += 1
+            else:
+                shutil.copyfile(src, tmp)
+                self.copied += 1
+            os.replace(tmp, dst)
+        except OSError as e:
+            logging.warning("Failed to place %s : %s", dst, e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def ingest(self, path: str, sha1: str = None, key: str = None) -> str:
+        """
+        書き終えた path を登録する。同じ中身が既にあれば path をそれへのリンクに置き換える。
+        key を渡すと key -> 中身 も記録する。return: sha1
+        """
+        sha1 = sha1 or file_sha1(path)
+        src = self.source(sha1)
+        if src is None:
+            if self.linkable:
+                blob = self.blob_path(sha1)
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(path, blob)
+                    self.stored += 1
+                except FileExistsError:
+                    # 他のスレッド / プロセスが同じ中身を先に入れた
+                    self.place(sha1, path)
+                except OSError as e:
+                    logging.warning("Failed to store %s : %s", path, e)
+                    return sha1
+            else:
+                with self._lock:
+                    self._paths[sha1] = path
+                    self._append({"sha1": sha1, "path": os.path.relpath(path, self.root)})
+                self.stored += 1
+        elif self.linkable:
+            self.place(sha1, path)
+
+        if key is not None and self._keys.get(key) != sha1:
+            with self._lock:
+                self._keys[key] = sha1
+                self._append({"key": key, "sha1": sha1})
+        return sha1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        logging.info("Blob store: %d stored, %d linked, %d copied", self.stored, self.linked, self.copied)
+        self.stored = self.linked = self.copied = 0
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(root: str):
+    """root (assets フォルダ) の BlobStore / [assets] blob_store = false なら None"""
+    if not enabled:
+        return None
+    key = os.path.normcase(os.path.abspath(root))
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = BlobStore(root)
+        return store
+
+
+def dedupe_tree(root: str) -> int:
+    """既存の assets フォルダのファイルを取り込み、重複をリンクにする。return: 取り込んだファイル数"""
+    store = BlobStore(root)
+    count = 0
+    for folder, dirs, files in os.walk(root):
+        if os.path.abspath(folder) == os.path.abspath(root) and BLOB_DIR in dirs:
+            dirs.remove(BLOB_DIR)
+        for name in files:
+            if name.endswith((".part", ".part.json", ".link")):
+                continue
+            store.ingest(os.path.join(folder, name))
+            count += 1
+    store.close()
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Deduplicate an existing assets folder into the blob store")
+    parser.add_argument("root", nargs="?", default=os.path.join(BASE_DIR, "assets"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+    n = dedupe_tree(args.root)
+    print(f"Ingested {n} files under {args.root}")
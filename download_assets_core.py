@@ -2,12 +2,25 @@ import requests
 import json
 import os
 import sys
+import time
 import re
+import shutil
 import urllib3
 import logging
 import configparser
 import threading
+import queue
+import sqlite3
 import concurrent.futures as cf
+import http_client
+import run_control
+import job_journal
+from ignore_list import IgnoreList
+from retry_queue import RetryQueue
+import kag_refs
+import resumable
+from asset_manifest import AssetManifest
+import blob_store
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 logging.basicConfig(
     filename='1_error.log',
@@ -15,7 +28,8 @@ logging.basicConfig(
     level='INFO',
     format='[%(levelname)s] %(asctime)s: %(message)s'
 )
-from ksd_postprocess import fix_ogg_files
+from ksd_postprocess import fix_ogg_files, FFMPEG_EXE
+import modifi_json
 
 base_url = dict()
 base_url['fgimage'] = 'https://static-r.kamihimeproject.net/scenarios/fgimage/' # https://gnkh-resource-r.prod.nkh.dmmgames.com/scenarios/fgimage/
@@ -38,25 +52,110 @@ config = configparser.RawConfigParser()
 config.read(SETTING_PATH)
 thread_num = config.getint('script', 'threads')
 
+# CDN の接続先 ([network] static_base で差し替え可。mock_server.py など)
+STATIC_BASE = 'https://static-r.kamihimeproject.net'
+
+def set_static_base(static: str):
+    global STATIC_BASE
+    static = static.rstrip('/')
+    for key, url in base_url.items():
+        base_url[key] = static + url[len(STATIC_BASE):]
+    STATIC_BASE = static
+    http_client.register_host(static, "static")
+
+if config.get('network', 'static_base', fallback=''):
+    set_static_base(config.get('network', 'static_base'))
+
 # Set request timeout (seconds)
 req_timeout = 120
+# iter_content で 1 回に受け取る量 (bytes)
+CHUNK_SIZE = 256 * 1024
 
-ignore_links = []
-retry_links = []
-retry_num = 3
+# 通信エラー / 5xx で取れなかったアセット。実行の最後に retry_threads 本で retry_num 回まで
+# 取り直し (1 回目の前に retry_backoff 秒、以後は倍々に待つ)、残りは次回に持ち越す
+retry_links = RetryQueue(os.path.join(BASE_DIR, "retry.jsonl"))
+retry_num = config.getint('assets', 'retry_rounds', fallback=3)
+retry_threads = config.getint('assets', 'retry_threads', fallback=2)
+retry_backoff = config.getfloat('assets', 'retry_backoff', fallback=10.0)
 
+# CDN に無かったアセット。ignore_ttl 秒たったものは HEAD で確認し直し、
+# 公開されていれば一覧から外す (1 回の実行で最大 ignore_revalidate_max 件。ttl 0 で確認しない)
 ignore_file = os.path.join(BASE_DIR, "ignore.txt")
+ignore_links = IgnoreList(os.path.join(BASE_DIR, "ignore.jsonl"), legacy_path=ignore_file)
+ignore_ttl = config.getfloat('assets', 'ignore_ttl', fallback=30 * 86400)
+ignore_revalidate_max = config.getint('assets', 'ignore_revalidate_max', fallback=500)
+
+# 取り終えた .ogg を ffmpeg で直すスレッド数 (0 なら全部取り終えてからまとめて直す)
+ogg_threads = config.getint('assets', 'ogg_threads', fallback=2)
+
+# 走査・解析 (別スレッド) → ダウンロード (共有プール) の流れ作業。
+# 解析は parse_ahead シナリオまで先に進め、プールに載せて終わっていないアセットは
+# download_window 件まで (0 ならプールのスレッド数の 4 倍)
+parse_ahead = config.getint('assets', 'parse_ahead', fallback=64)
+download_window = config.getint('assets', 'download_window', fallback=0)
 
-if os.path.exists(ignore_file):
-    with open(ignore_file, 'r', encoding="utf-8") as f:
-        ignore_links = f.read().splitlines()
-    ignore_links_len = len(ignore_links)
-else:
-    ignore_links_len = 0
+# シナリオごとの素材一覧のキャッシュ (asset_manifest.py)。実行中だけ開く
+use_manifest = config.getboolean('assets', 'manifest', fallback=True)
+MANIFEST_PATH = os.path.join(BASE_DIR, "asset_manifest.db")
+manifest = None
 
 links = []
 asset_folder = os.path.join(BASE_DIR, 'assets')
 
+def set_assets_root(root):
+    """
+    アセットの保存先を root にする (分担モードで全ワーカーが同じフォルダに揃えるとき)。
+    ignore.jsonl / retry.jsonl / asset_manifest.db も root に置き、404 などを全ワーカーで共有する
+    """
+    global asset_folder, MANIFEST_PATH, retry_links, ignore_links
+    asset_folder = root
+    os.makedirs(root, exist_ok=True)
+    MANIFEST_PATH = os.path.join(root, "asset_manifest.db")
+    retry_links = RetryQueue(os.path.join(root, "retry.jsonl"))
+    ignore_links = IgnoreList(os.path.join(root, "ignore.jsonl"))
+
+# 取ってから ffmpeg で直す .ogg の dst -> link。直した後の中身を link の分として blob store に入れる
+_transcode_links = {}
+# 最後にまとめて直す (変換プールが無い) .ogg の link -> 取った dst。同じ link の別 dst はこれをコピーする
+_raw_ogg = {}
+# 別の dst 用に取得中の link -> 終わったら set される Event
+_fetching = {}
+_fetching_lock = threading.Lock()
+
+def _link_known(store, link, dst) -> bool:
+    sha1 = store.lookup(link)
+    return sha1 is not None and store.place(sha1, dst)
+
+def _claim_link(link):
+    """return: None (自分が取る) / 他のスレッドが取得中ならその Event"""
+    with _fetching_lock:
+        ev = _fetching.get(link)
+        if ev is None:
+            _fetching[link] = threading.Event()
+        return ev
+
+def _release_link(link):
+    with _fetching_lock:
+        ev = _fetching.pop(link, None)
+    if ev is not None:
+        ev.set()
+
+def _copy_raw_ogg(link, dst, downloaded_ogg_files) -> bool:
+    """まとめて直す待ちの同じ link の .ogg があればコピーし、dst も最後に直す対象に入れる"""
+    src = _raw_ogg.get(link)
+    if downloaded_ogg_files is None or src is None or not os.path.exists(src):
+        return False
+    tmp = dst + ".part"
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except OSError as e:
+        logging.warning("Failed to copy %s : %s", src, e)
+        return False
+    _transcode_links[dst] = link
+    downloaded_ogg_files.append(dst)
+    return True
+
 headers = {}
 headers['user-agent'] = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
 
@@ -65,11 +164,9 @@ _ASSET_SESSION = None
 def get_asset_session():
     global _ASSET_SESSION
     if _ASSET_SESSION is None:
-        s = requests.Session()
-        s.headers.update({
+        _ASSET_SESSION = http_client.new_session({
             'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
         })
-        _ASSET_SESSION = s
     return _ASSET_SESSION
 
 
@@ -78,7 +175,7 @@ def get_asset_session():
 ############################################################################
 def download_script(script_path, url):
     s = get_asset_session()
-    r = s.get(url, headers=headers, verify=False)
+    r = http_client.get(s, url, headers=headers, verify=False)
     if r.status_code == 200:
         try:
             with open(script_path, 'w', encoding='utf-8') as f:
@@ -98,180 +195,883 @@ def download_script(script_path, url):
         return False
 
 
+def is_error_page(content_type, head: bytes) -> bool:
+    """CDN は 200 で HTML のエラーページを返すことがある。Content-Type と先頭の数バイトで判定する"""
+    if content_type and 'text/html' in content_type.lower():
+        return True
+    return head[:64].lstrip().lower().startswith((b'<html', b'<!doctype html'))
+
+
+def asset_dst(link, resource_directory):
+    folder = os.path.join(asset_folder, resource_directory)
+    return os.path.join(folder, link[link.rfind('/')+1:]).replace('_pc_h', '')
+
+
 def download_asset(link, resource_directory, downloaded_ogg_files=None):
+    """
+    return: dict(kind="asset", link, dst, status, bytes, elapsed)
+      status: downloaded / exists / ignored / failed
+    """
     link = link.replace(' ', '')
     folder = os.path.join(asset_folder, resource_directory)
-    dst = os.path.join(folder, link[link.rfind('/')+1:]).replace('_pc_h', '')
+    dst = asset_dst(link, resource_directory)
     s = get_asset_session()
+    result = {"kind": "asset", "link": link, "dst": dst, "status": "exists", "bytes": 0, "elapsed": 0.0}
+    started = time.monotonic()
 
     if not os.path.exists(folder):
-        os.mkdir(folder)
+        os.makedirs(folder, exist_ok=True)
 
     if os.path.exists(dst):
-        pass
+        retry_links.done(link)
     else:
         if link in ignore_links:
             logging.warning('Ignore %s' % link)
-            return
+            result["status"] = "ignored"
+            return result
+
+        # 他のフォルダ用に同じ URL を取ったことがあれば、その中身をリンクするだけ。
+        # 取得中なら終わるのを待ってからリンクする (ogg は変換が終わるまで待つ。
+        # 最後にまとめて直す場合は取った .ogg をコピーする)
+        store = blob_store.get_store(asset_folder)
+        owner = False
+        if store is not None:
+            busy = _link_known(store, link, dst) or _claim_link(link)
+            if busy is not True and busy is not None:
+                busy.wait()
+                busy = _link_known(store, link, dst) or _copy_raw_ogg(link, dst, downloaded_ogg_files)
+            if busy is True:
+                result["status"] = "linked"
+                retry_links.done(link)
+                result["elapsed"] = time.monotonic() - started
+                return result
+            owner = busy is None
 
+        result["status"] = "failed"
+        # 書きかけは .part に置き、最後まで受け取れたら dst に置き換える
+        # (途中で落ちても dst は「既にある」扱いにならない)。
+        # 途中で切れた .part は検証子と一緒に残し、次は続きから受け取る (resumable.py)
         try:
-            r = s.get(link, headers=headers, verify=False, timeout=req_timeout)
-            if r.status_code == 200 and not r.text.startswith('<html>'):
-                with open(dst, 'wb') as f:
-                    for chunk in r:
-                        f.write(chunk)
-                    if (downloaded_ogg_files is not None and dst.lower().endswith(".ogg")):
+            got = resumable.fetch(
+                s, link, dst,
+                check=lambda r, head: not is_error_page(r.headers.get('Content-Type'), head),
+                chunk_size=CHUNK_SIZE, headers=headers, verify=False, timeout=req_timeout
+            )
+            result["bytes"] = got["bytes"]
+            if got["saved"]:
+                if got["resumed"]:
+                    result["resumed"] = got["resumed"]
+                if (downloaded_ogg_files is not None and dst.lower().endswith(".ogg")):
+                    _transcode_links[dst] = link
+                    if submit_transcode(dst, link if owner else None):
+                        # 待っているスレッドは変換が終わってから (transcode_ogg が) 放す
+                        owner = False
+                    else:
+                        _raw_ogg[link] = dst
                         downloaded_ogg_files.append(dst)
+                elif store is not None:
+                    store.ingest(dst, got["sha1"], key=link)
+                result["status"] = "downloaded"
+                retry_links.done(link)
 
             else:
                 logging.error("Error: %s" % link)
-                logging.error("%s (%s)" % (link, r.status_code))
+                logging.error("%s (%s)" % (link, got["status"]))
 
-                if r.status_code == 404:
-                    ignore_links.append(link)
+                if got["status"] == 404:
+                    # CDN に無い。取り直しても同じなので失敗には数えない
+                    ignore_links.add(link, got["status"])
+                    retry_links.done(link)
+                    result["status"] = "ignored"
+                elif got["status"] in http_client.RETRY_STATUS:
+                    retry_links.add(link, resource_directory, f"HTTP {got['status']}")
         except requests.exceptions.RequestException as e:
-            retry_links.append(link, resource_directory)
+            retry_links.add(link, resource_directory, str(e))
             logging.error("%s: %s" % (link, e))
+        finally:
+            if owner:
+                _release_link(link)
+
+    result["elapsed"] = time.monotonic() - started
+    return result
+
+# 取り終えた .ogg をすぐ ffmpeg で直すプール (ダウンロードと並行させる)。
+# 動いていなければ (ogg_threads = 0 / ffmpeg が無い) 従来どおり downloaded_ogg_files に
+# 溜めて最後にまとめて直す
+_transcoder = None
+_transcode_lock = threading.Lock()
+_transcode_futures = []
+
+def start_transcoder():
+    global _transcoder
+    if ogg_threads <= 0 or not os.path.exists(FFMPEG_EXE):
+        return
+    with _transcode_lock:
+        if _transcoder is None:
+            _transcoder = cf.ThreadPoolExecutor(max_workers=ogg_threads, thread_name_prefix="ogg")
+
+def submit_transcode(dst, link=None) -> bool:
+    """
+    return: プールに載せたら True (載せなければ呼び出し側でまとめて直す)
+    link: 取得を待たせている link (直し終えたら _release_link する)
+    """
+    with _transcode_lock:
+        if _transcoder is None:
+            return False
+        _transcode_futures.append(_transcoder.submit(transcode_ogg, dst, link))
+    return True
+
+def transcode_ogg(dst, link=None) -> bool:
+    try:
+        fixed = fix_ogg_files([dst])
+        store_transcoded([dst], fixed)
+        return bool(fixed)
+    finally:
+        if link is not None:
+            _release_link(link)
+
+def finish_transcoder() -> int:
+    """載せた分が全部終わるまで待つ。return: 直せた数"""
+    global _transcoder
+    with _transcode_lock:
+        pool, _transcoder = _transcoder, None
+        futures = list(_transcode_futures)
+        _transcode_futures.clear()
+    if pool is None:
+        return 0
+    pool.shutdown(wait=True)
+    fixed = 0
+    for fut in futures:
+        try:
+            fixed += fut.result()
+        except Exception as e:
+            logging.error("Failed to fix ogg: %s", e)
+    return fixed
+
+# 1 回の実行 (iter_download_assets) で共有するスレッドプールと、dst ごとの Future。
+# 共通の fgimage / bgm / bg は多くのシナリオから参照されるので、同じ dst は
+# 実行中 1 回だけ確認・取得し、後から来たシナリオは同じ Future の結果を待つ (singleflight)。
+_pool = None
+_pool_lock = threading.Lock()
+_planned = {}  # dst -> Future
+_present = set()  # 今回の実行で存在を確認した dst (assets_present)
+
+def start_pool(workers=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = cf.ThreadPoolExecutor(max_workers=workers or http_client.pool_size(thread_num))
+            _planned.clear()
+            _present.clear()
+
+def finish_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+        _planned.clear()
+        _present.clear()
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def submit_asset(link, resource_directory, downloaded_ogg_files):
+    """return: (Future, 今回の実行で既に同じ dst を取りに行っていたか)"""
+    link = link.replace(' ', '')
+    dst = asset_dst(link, resource_directory)
+    with _pool_lock:
+        fut = _planned.get(dst)
+        if fut is not None:
+            return fut, True
+        fut = _pool.submit(download_asset, link, resource_directory, downloaded_ogg_files)
+        _planned[dst] = fut
+        return fut, False
+
+
+def _failed_result(e):
+    logging.error("Asset download failed: %s", e)
+    return {"kind": "asset", "link": "", "dst": "", "status": "failed",
+            "bytes": 0, "elapsed": 0.0, "error": str(e)}
+
+
+def submit_items(items, downloaded_ogg_files, futures):
+    """
+    items を共有プールに載せ、Future を futures に足す (同じ dst は 1 つ)。
+    return: 他のシナリオが先に載せていた Future の set
+    """
+    breaker = run_control.breaker
+    seen = set(futures)
+    shared = set()
+    for link, resource_directory in items:
+        if breaker.tripped:
+            break
+        fut, dup = submit_asset(link, resource_directory, downloaded_ogg_files)
+        if fut in seen:
+            continue
+        seen.add(fut)
+        if dup:
+            shared.add(fut)
+        futures.append(fut)
+    return shared
+
+
+def collect_results(futures, shared):
+    """終わった futures の結果 (キャンセルされた分は除く)。shared の分は bytes=0 / downloaded は exists"""
+    results = []
+    for fut in futures:
+        if fut.cancelled():
+            continue
+        try:
+            result = fut.result()
+        except run_control.RunCancelled:
+            continue
+        except Exception as e:
+            results.append(_failed_result(e))
+            continue
+        if fut in shared:
+            result = dict(result, bytes=0, coalesced=True,
+                          status="exists" if result["status"] == "downloaded" else result["status"])
+        results.append(result)
+    return results
+
+
+def download_asset_list(items, downloaded_ogg_files=None, max_workers=None):
+    """
+    items: (link, resource_directory) のリスト
+    return: download_asset の結果のリスト (同じ dst は 1 件)
+    start_pool() 済みなら共有プールに載せ、他のシナリオが取得中 / 取得済みの dst は
+    その結果を bytes=0 (downloaded は exists) にして返す。
+    それ以外 (retry_pass や単独の呼び出し) は max_workers 本のプールをその場で作る。
+    """
+    results = []
+    breaker = run_control.breaker
+    if breaker.tripped:
+        return results
+
+    if _pool is None or max_workers:
+        return _download_with_own_pool(items, downloaded_ogg_files, max_workers)
+
+    futures = []
+    breaker.track(futures)
+    try:
+        shared = submit_items(items, downloaded_ogg_files, futures)
+        cf.wait(futures)
+        results = collect_results(futures, shared)
+    finally:
+        breaker.untrack(futures)
+
+    return results
+
+
+def _download_with_own_pool(items, downloaded_ogg_files, max_workers):
+    results = []
+    breaker = run_control.breaker
+    max_workers = max_workers or http_client.pool_size(thread_num)
+    with cf.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        breaker.track(futures)
+        try:
+            for link, resource_directory in items:
+                if breaker.tripped:
+                    break
+                futures.append(executor.submit(download_asset, link, resource_directory, downloaded_ogg_files))
+
+            for fut in cf.as_completed(futures):
+                if fut.cancelled():
+                    continue
+                try:
+                    results.append(fut.result())
+                except run_control.RunCancelled:
+                    continue
+                except Exception as e:
+                    results.append(_failed_result(e))
+        finally:
+            breaker.untrack(futures)
+
+    return results
+
 
 def download_assets(
     links,
     resource_directory='',
-    downloaded_ogg_files=None
+    downloaded_ogg_files=None,
+    max_workers=None
 ):
-    with cf.ThreadPoolExecutor(max_workers=thread_num) as executor:
-        futures = [executor.submit(download_asset, link, resource_directory, downloaded_ogg_files) for link in links]
-
-        for _ in cf.as_completed(futures):
-            pass
+    """return: download_asset の結果のリスト (終わった順)"""
+    return download_asset_list([(link, resource_directory) for link in links],
+                               downloaded_ogg_files, max_workers)
 
 
-def download_scenario_assets(character, scenario_type, filename, data, data_directory, downloaded_ogg_files):
-    script_file = '%s_script.ks' % filename.replace('.json', '').replace('.ks', '')
-    script_path = os.path.join(data_directory, scenario_type, character, script_file)
-
+def scenario_script_items(script_path, data):
+    """.ks の素材 (link, resource_directory) の一覧 / スクリプトが取れなければ None"""
     # Download script file if not exists
     if not os.path.exists(script_path):
         print ("Downloading script file...")
         if not download_script(script_path, base_url['scenarios'] + data['scenario_path']):
-            print ("Failed to download script for %s" % filename)
-            logging.error('Failed to download script for %s' % filename)
-            return
+            print ("Failed to download script for %s" % os.path.basename(script_path))
+            logging.error('Failed to download script for %s' % os.path.basename(script_path))
+            return None
 
     with open(script_path, encoding='utf-8') as file:
         script = file.read()
 
-    links = []
-    for match in re.finditer(r'\[chara_face.*storage="(.*)"', script):
-        links.append(base_url['fgimage'] + match.group(1))
+    return ks_asset_items(kag_refs.ks_refs(script), data)
 
-    for match in re.finditer(r'\[playbgm.*storage="(.*)"', script):
-        links.append(base_url['bgm'] + match.group(1))
 
-    for match in re.finditer(r'\[bg.*storage="(.*)"', script):
-        links.append(base_url['bg'] + re.sub(r"(.*)(-.*)",
-                                             r"\1_pc_h\2", match.group(1)))
+def download_scenario_assets(script_path, data, downloaded_ogg_files):
+    items = scenario_script_items(script_path, data)
+    if items is None:
+        return None
+    return download_asset_list(items, downloaded_ogg_files)
 
-    download_assets(links, '', downloaded_ogg_files)
 
-    links = []
-    for match in re.finditer(r'\[playse.*storage="(.*)"', script):
-        links.append(base_url['scenarios'] + '/'.join(
-            data['scenario_path'].split('/')[:3]) + '/sound/' + match.group(1))
+def ks_asset_items(refs, data):
+    """
+    .ks の参照 -> (link, resource_directory)。
+    共通素材 (resource_directory なし) とシナリオ固有の効果音をまとめて 1 回で投げる
+    """
+    items = []
+    for ref in refs:
+        if ref.kind == "fgimage":
+            items.append((base_url['fgimage'] + ref.name, ''))
+        elif ref.kind == "bgm":
+            items.append((base_url['bgm'] + ref.name, ''))
+        elif ref.kind == "bg":
+            items.append((base_url['bg'] + re.sub(r"(.*)(-.*)", r"\1_pc_h\2", ref.name), ''))
+        elif ref.kind == "se":
+            items.append((base_url['scenarios'] + '/'.join(
+                data['scenario_path'].split('/')[:3]) + '/sound/' + ref.name, data["resource_directory"]))
+    return items
 
-    download_assets(links, data["resource_directory"], downloaded_ogg_files)
-
-
-def download_hscene_assets(character, scenario_type, filename, data, data_directory, downloaded_ogg_files):
-    script_file = f"{filename.replace('.json', '').replace('.ks', '')}_script.json"
-    script_path = os.path.join(data_directory, scenario_type, character, script_file)
 
+def hscene_script_items(script_path, data):
+    """Harem の scenario.json の素材 (link, resource_directory) の一覧 / スクリプトが取れなければ None"""
     # スクリプトファイルがなければダウンロード
     if not os.path.exists(script_path):
         print("Downloading script file...")
         if not download_script(script_path, base_url['scenarios'] + data['scenario_path']):
-            print(f"Failed to download script for {filename}")
-            logging.error(f"Failed to download script for {filename}")
-            return
+            print(f"Failed to download script for {os.path.basename(script_path)}")
+            logging.error(f"Failed to download script for {os.path.basename(script_path)}")
+            return None
 
     # JSONファイルを開く
+    # JSON 段階の直後に呼ばれた場合は modifi_json 未処理のことがあるので、ここでも整形してから読む
     with open(script_path, encoding='utf-8') as file:
-        script = json.load(file)
+        text = file.read()
+    script = json.loads(modifi_json.remove_trailing_colons(modifi_json.remove_trailing_commas(text)))
+    if not isinstance(script, dict):
+        script = {"scenario": script}
 
-    links = []
+    # bgm / film / talk.voice はすべてシナリオのフォルダから取る
     resource_path = data['scenario_path'][:data['scenario_path'].rfind('/')]
-    scenes = script.get("scenario", [])
-
-    for section in scenes:
-        # `bgm` の処理
-        if 'bgm' in section:
-            links.append(f"{base_url['scenarios']}{resource_path}/{section['bgm']}")
-
-        # `film` の処理（新形式対応）
-        if 'film' in section:
-            if isinstance(section['film'], list):
-                # リストの場合は .jpg で終わる要素のみ抽出
-                film_files = [f for f in section['film'] if isinstance(f, str) and f.endswith('.jpg')]
-            else:
-                # 文字列の場合（旧形式）
-                film_files = [section['film']] if section['film'].endswith('.jpg') else []
-
-            # 取得した jpg ファイルをダウンロード対象に追加
-            for film in film_files:
-                links.append(f"{base_url['scenarios']}{resource_path}/{film}")
+    return [(f"{base_url['scenarios']}{resource_path}/{ref.name}", data["resource_directory"])
+            for ref in kag_refs.hscene_refs(script)]
 
-        # `talk` の処理（ボイスファイル）
-        if 'talk' in section:
-            for part in section['talk']:
-                if 'voice' in part:
-                    links.append(f"{base_url['scenarios']}{resource_path}/{part['voice']}")
 
+def download_hscene_assets(script_path, data, downloaded_ogg_files):
+    items = hscene_script_items(script_path, data)
+    if items is None:
+        return None
     # アセットをダウンロード
-    download_assets(links, data["resource_directory"], downloaded_ogg_files)
+    return download_asset_list(items, downloaded_ogg_files)
+
+
+# ---------------------------------------Plan-------------------------------------------
+
+def script_path_for(data_directory, scenario_type, character, filename, data):
+    base = filename.replace('.json', '').replace('.ks', '')
+    ext = 'ks' if data['scenario_path'].endswith('.ks') else 'json'
+    return os.path.join(data_directory, scenario_type, character, f"{base}_script.{ext}")
+
+
+def _subdirs(path):
+    with os.scandir(path) as it:
+        return sorted((e for e in it if e.is_dir()), key=lambda e: e.name)
+
+
+def scan_library(data_directory):
+    """
+    保存先フォルダ全体からアセット作業計画を作る (従来の全走査)。
+    yield: dict(scenario_type, character, filename, script_path, resource_directory, scenario_path)
+    os.scandir の stat (Windows では一覧と一緒に取れる) で manifest を引くので、
+    変わっていない .json は開かない。
+    """
+    for type_entry in _subdirs(data_directory):
+        scenario_type = type_entry.name
+        # .staging は書きかけのフォルダ (download_json_core.stage_dir)
+        if scenario_type.startswith('.'):
+            continue
+        for char_entry in _subdirs(type_entry.path):
+            character = char_entry.name
+            with os.scandir(char_entry.path) as it:
+                files = sorted((e for e in it if e.is_file()), key=lambda e: e.name)
+            for file_entry in files:
+                filename = file_entry.name
+                # JSON以外は無視
+                if not filename.lower().endswith(".json"):
+                    continue
+                if '_script' in filename:
+                    continue
+
+                json_path = file_entry.path
+                st = file_entry.stat() if manifest is not None else None
+                data = manifest.meta(json_path, st) if manifest is not None else None
+                if data is None:
+                    with open(json_path, encoding="utf-8") as file:
+                        data = json.load(file)
+                    if manifest is not None:
+                        manifest.put_meta(json_path, data, st)
+
+                yield {
+                    "scenario_type": scenario_type,
+                    "character": character,
+                    "filename": filename,
+                    "script_path": script_path_for(data_directory, scenario_type, character, filename, data),
+                    "resource_directory": data.get("resource_directory", ""),
+                    "scenario_path": data["scenario_path"],
+                }
 
 
+def scenario_items(entry):
+    """
+    シナリオの素材 (link, resource_directory) の一覧 / スクリプトが取れなければ None。
+    スクリプトが前回から変わっていなければ manifest の一覧を使う (読まない)
+    """
+    data = {
+        "scenario_path": entry["scenario_path"],
+        "resource_directory": entry.get("resource_directory") or "",
+    }
+    script_path = entry["script_path"]
+
+    if manifest is not None:
+        items = manifest.items(script_path, data)
+        if items is not None:
+            return items
+
+    if data['scenario_path'].endswith('.ks'):
+        items = scenario_script_items(script_path, data)
+    else:
+        items = hscene_script_items(script_path, data)
+
+    if items is not None and manifest is not None:
+        manifest.put_items(script_path, data, items)
+    return items
+
+
+def assets_present(items) -> bool:
+    """全部の素材がある / 無いと分かっている (ignore) なら True"""
+    for link, resource_directory in items:
+        link = link.replace(' ', '')
+        if link in ignore_links:
+            continue
+        dst = asset_dst(link, resource_directory)
+        if dst in _present:
+            continue
+        if not os.path.exists(dst):
+            return False
+        _present.add(dst)
+    return True
+
+
+def process_scenario(entry, downloaded_ogg_files):
+    """return: download_asset の結果のリスト / スクリプトが取れなければ None"""
+    items = scenario_items(entry)
+    if items is None:
+        return None
+    return download_asset_list(items, downloaded_ogg_files)
+
+def revalidate_ignored(max_checks=None):
+    """
+    ignore_ttl を過ぎた link を HEAD で確認し直す。200 なら一覧から外して次の
+    ダウンロードで取り直させ、まだ無ければ確認時刻だけ更新する。
+    return: 一覧から外した件数
+    """
+    max_checks = ignore_revalidate_max if max_checks is None else max_checks
+    links = ignore_links.expired(ignore_ttl)[:max_checks]
+    if not links:
+        return 0
+
+    logging.info("Revalidating %d ignored links", len(links))
+    s = get_asset_session()
+
+    def check(link):
+        try:
+            r = http_client.request(s, 'HEAD', link, headers=headers, verify=False,
+                                    timeout=req_timeout, allow_redirects=True)
+            r.close()
+        except requests.exceptions.RequestException as e:
+            logging.warning("%s: %s", link, e)
+            return False
+        if r.status_code == 200 and not is_error_page(r.headers.get('Content-Type'), b""):
+            ignore_links.remove(link)
+            logging.info("Published since ignored: %s", link)
+            return True
+        ignore_links.add(link, r.status_code)
+        return False
+
+    with cf.ThreadPoolExecutor(max_workers=http_client.worker_count('static')) as ex:
+        restored = sum(ex.map(check, links))
+
+    logging.info("Revalidated %d ignored links, %d published", len(links), restored)
+    return restored
+
+def retry_pass(downloaded_ogg_files, wait_first=True):
+    """
+    retry_links を retry_threads 本で取り直す。取れなかった分は retry_num 回まで繰り返し、
+    回ごとに retry_backoff 秒から倍々に待つ (wait_first=False なら 1 回目は待たない)。
+    yield: download_asset の結果 ("retry": True 付き)
+    """
+    breaker = run_control.breaker
+    for round_no in range(retry_num):
+        pending = retry_links.items()
+        if not pending or breaker.tripped:
+            return
+
+        delay = retry_backoff * (2 ** round_no)
+        if round_no == 0 and not wait_first:
+            delay = 0
+        logging.info("Retrying %d failed assets in %.0fs (round %d/%d)",
+                     len(pending), delay, round_no + 1, retry_num)
+        breaker.sleep(delay)
+
+        by_directory = {}
+        for link, resource_directory in pending:
+            by_directory.setdefault(resource_directory, []).append(link)
+
+        for resource_directory, links in by_directory.items():
+            for asset in download_assets(links, resource_directory, downloaded_ogg_files,
+                                         max_workers=retry_threads):
+                asset["retry"] = True
+                yield asset
+
+def store_transcoded(ogg_files, fixed):
+    """直し終えた .ogg を blob store に入れる (直せなかったものは link の分として記録しない)"""
+    store = blob_store.get_store(asset_folder)
+    fixed = set(fixed)
+    for dst in ogg_files:
+        link = _transcode_links.pop(dst, None)
+        if _raw_ogg.get(link) == dst:
+            del _raw_ogg[link]
+        if store is None or not os.path.exists(dst):
+            continue
+        try:
+            store.ingest(dst, key=link if dst in fixed else None)
+        except OSError as e:
+            logging.error("Failed to store %s: %s", dst, e)
+
 # ---------------------------------------Start-------------------------------------------
 
-def run_download_assets(
-    data_directory: str
-) -> dict:
+_SCAN_DONE = object()
+
+
+def parse_stage(units, out, stop, poll):
+    """
+    アセット実行の解析スレッド。units ((unit, entry) / 台帳の待ちは None) を順に読み、
+    シナリオごとの素材一覧を out (上限付きキュー) に入れる。
+    out: (unit, entry, items, cached, error) / 最後に (_SCAN_DONE, 走査中の例外 or None)
+    stop が立ったら次の単位を読まずに終わる。
+    """
+    breaker = run_control.breaker
+    error = None
+    try:
+        for claimed in units:
+            if stop.is_set():
+                break
+            if claimed is None:
+                # 他のワーカーの作業が終わる (か lease が切れる) のを待つ
+                breaker.sleep(poll)
+                continue
+            unit, entry = claimed
+            try:
+                items = scenario_items(entry)
+                parsed = (unit, entry, items, items is not None and assets_present(items), None)
+            except run_control.RunCancelled:
+                raise
+            except Exception as e:
+                logging.error("Failed to process %s: %s", entry.get("script_path"), e)
+                parsed = (unit, entry, None, False, e)
+            out.put(parsed)
+    except BaseException as e:
+        error = e
+    finally:
+        out.put((_SCAN_DONE, error))
+
+
+def start_scenario(parsed, downloaded_ogg_files, futures, counts):
+    """解析済みのシナリオを共有プールに載せる。return: 実行中のシナリオ (dict)"""
+    unit, entry, items, cached, error = parsed
+    scenario = {"kind": "scenario", "script_path": entry.get("script_path"),
+                "status": "done", "assets": 0, "bytes": 0, "elapsed": 0.0}
+    job = {"unit": unit, "scenario": scenario, "futures": [], "shared": set(),
+           "started": time.monotonic(), "journaled": False}
+
+    # ジャーナルに planned として載っている分だけ着手/完了を記録する
+    job["journaled"] = job_journal.is_pending("asset", entry["script_path"])
+    if job["journaled"]:
+        job_journal.start("asset", entry["script_path"])
+
+    if error is not None:
+        scenario["status"] = "error"
+        scenario["error"] = str(error)
+    elif items is None:
+        scenario["status"] = "no_script"
+    elif cached:
+        # 素材が全部そろっているシナリオは通信もプールも使わない
+        scenario["cached"] = True
+        counts["cached"] += 1
+    else:
+        job["shared"] = submit_items(items, downloaded_ogg_files, job["futures"])
+        futures.extend(job["futures"])
+    return job
+
+
+def unique_scenarios(plan):
+    """同じシナリオ (再開分と今回分の重複など) は 1 回だけ処理する"""
+    seen = set()
+    for entry in plan:
+        key = os.path.normcase(os.path.abspath(entry["script_path"]))
+        if key in seen:
+            continue
+        seen.add(key)
+        yield entry
+
+
+def scenario_unit(data_directory, entry):
+    """work_ledger の作業単位名 (ワーカーごとにマウント先が違っても同じになるよう相対パス)"""
+    return os.path.relpath(entry["script_path"], data_directory).replace(os.sep, '/')
+
+
+def iter_download_assets(
+    data_directory: str,
+    plan=None,
+    reset_breaker: bool = True,
+    ledger=None,
+    retry_only: bool = False
+):
+    """
+    run_download_assets の逐次版。
+    シナリオごとに、各アセットの結果 (download_asset 参照) に続けて
+      {"kind": "scenario", "script_path", "status" (done/no_script/error/cancelled), "assets", "bytes", "elapsed"}
+    を (アセットが揃った順に) yield し、最後に {"kind": "summary", ...} (run_download_assets の戻り値と同じ内容) を yield する。
+    plan が None なら data_directory 全体を走査する。
+    plan を渡した場合 (run_download_json の asset_plan やキューを読むジェネレータ) は
+    その中のシナリオだけを処理する。
+    ledger: work_ledger.Ledger (stage "asset")。渡すとシナリオ単位で台帳から取り、
+    同じ台帳を使う他のワーカーと分担する (失敗した単位は台帳が取り直すので retry_pass はしない)。
+    最後に retry_links (今回と前回までに取れなかったアセット) を retry_pass で取り直し、
+    その結果も asset として yield する。
+    retry_only: 保存先を走査せず retry_links だけを取り直す
+    走査・解析は parse_stage のスレッドで先に進め、シナリオの終わりを待たずに
+    次のシナリオのアセットをプールに載せる (download_window 件まで)。
+    """
     
     logging.info("Start download")
+    logging.info("Concurrency mode: %s (%s)",
+                 http_client.concurrency_mode, http_client.describe_concurrency())
     
     if not os.path.exists(asset_folder):
         os.mkdir(asset_folder)
 
     downloaded_ogg_files = []
+    counts = {"scenarios": 0, "cached": 0, "downloaded": 0, "exists": 0, "ignored": 0, "failed": 0,
+              "retried": 0, "recovered": 0}
+    total_bytes = 0
 
-    for scenario_type in os.listdir(data_directory):
-        for character in os.listdir(os.path.join(data_directory, scenario_type)):
-            scenarios = os.listdir(os.path.join(data_directory, scenario_type, character))
-            for filename in scenarios:
-                # JSON以外は無視
-                if not filename.lower().endswith(".json"):
-                    continue
-                if '_script' in filename:
-                    continue
+    breaker = run_control.breaker
+    if reset_breaker:
+        breaker.reset()
 
-                with open(os.path.join(data_directory, scenario_type, character, filename), encoding="utf-8") as file:
-                    data = json.load(file)
+    global manifest
+    if retry_only:
+        plan = []
+    elif ignore_ttl > 0 and ledger is None:
+        revalidate_ignored()
 
-                if data['scenario_path'].endswith('.ks'):
-                    download_scenario_assets(character, scenario_type, filename, data, data_directory, downloaded_ogg_files)
-                else:
-                    download_hscene_assets(character, scenario_type, filename, data, data_directory, downloaded_ogg_files)
+    if use_manifest and not retry_only:
+        try:
+            manifest = AssetManifest(MANIFEST_PATH, STATIC_BASE)
+        except sqlite3.Error as e:
+            logging.warning("Asset manifest disabled: %s", e)
 
-    if len(ignore_links) != ignore_links_len:
-        # Write new ignore links to file
-        with open(ignore_file, 'a', encoding="utf-8") as f:
-            for link in ignore_links[ignore_links_len:]:
-                f.write(link + '\n')
-    
+    if plan is None:
+        plan = scan_library(data_directory)
+
+    units = ((scenario_unit(data_directory, entry), entry) for entry in unique_scenarios(plan))
+    if ledger is not None:
+        units = ledger.claim_iter(units)
+        ledger.start_heartbeat()
+    held = set()
+    start_pool()
+    start_transcoder()
+
+    # 走査・解析は別スレッドで先に進め、ここではプールに載せて終わったシナリオから結果を返す
+    parsed_queue = queue.Queue(maxsize=max(1, parse_ahead))
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=parse_stage, args=(units, parsed_queue, stop, ledger.poll if ledger is not None else 0),
+        name="asset-parse", daemon=True
+    )
+    producer.start()
+    window = download_window or http_client.pool_size(thread_num) * 4
+    active = []      # プールに載せたシナリオ (start_scenario 参照)
+    running = set()  # 載せて終わっていない Future
+    futures = []     # 中止時にキャンセルする分
+    scanning = True
+    scan_error = None
+    breaker.track(futures)
+
+    try:
+        while (scanning and not breaker.tripped) or active:
+            # 空きがあれば次のシナリオを載せる (何も載っていなければ届くまで待つ)
+            while scanning and not breaker.tripped and len(running) < window:
+                try:
+                    parsed = parsed_queue.get(block=not active)
+                except queue.Empty:
+                    break
+                if parsed[0] is _SCAN_DONE:
+                    scanning = False
+                    scan_error = parsed[1]
+                    break
+                job = start_scenario(parsed, downloaded_ogg_files, futures, counts)
+                if job["unit"] is not None:
+                    held.add(job["unit"])
+                running.update(fut for fut in job["futures"] if not fut.done())
+                active.append(job)
+
+            if running:
+                done, _ = cf.wait(running, timeout=0.05, return_when=cf.FIRST_COMPLETED)
+                running -= done
+                if len(futures) > 4 * window:
+                    futures[:] = [fut for fut in futures if not fut.done()]
+
+            for job in [job for job in active if all(fut.done() for fut in job["futures"])]:
+                active.remove(job)
+                scenario = job["scenario"]
+                results = collect_results(job["futures"], job["shared"])
+                if any(fut.cancelled() for fut in job["futures"]):
+                    scenario["status"] = "cancelled"
+
+                for asset in results:
+                    counts[asset["status"]] = counts.get(asset["status"], 0) + 1
+                    scenario["assets"] += 1
+                    scenario["bytes"] += asset["bytes"]
+                    yield asset
+
+                failed = any(asset["status"] == "failed" for asset in results)
+                if job["journaled"] and scenario["status"] == "done" and not failed:
+                    job_journal.commit("asset", scenario["script_path"])
+
+                if ledger is not None:
+                    if scenario["status"] in ("error", "cancelled") or failed:
+                        ledger.release(job["unit"])
+                    else:
+                        ledger.complete(job["unit"])
+                    held.discard(job["unit"])
+
+                counts["scenarios"] += 1
+                total_bytes += scenario["bytes"]
+                scenario["elapsed"] = time.monotonic() - job["started"]
+                yield scenario
+
+        if isinstance(scan_error, run_control.RunCancelled):
+            pass
+        elif scan_error is not None:
+            raise scan_error
+    except run_control.RunCancelled:
+        # ダウンロード済みの分は下で後処理する
+        pass
+    except BaseException:
+        finish_transcoder()
+        raise
+    finally:
+        breaker.untrack(futures)
+        # 解析スレッドを止め、キューに残っていた (台帳で取った) 分も戻す
+        stop.set()
+        while scanning:
+            parsed = parsed_queue.get()
+            if parsed[0] is _SCAN_DONE:
+                scanning = False
+            elif parsed[0] is not None:
+                held.add(parsed[0])
+        producer.join()
+        finish_pool()
+        if manifest is not None:
+            manifest.close()
+            manifest = None
+        if ledger is not None:
+            for unit in held:
+                ledger.release(unit)
+            ledger.stop_heartbeat()
+
+    if ledger is None and not breaker.tripped:
+        try:
+            for asset in retry_pass(downloaded_ogg_files, wait_first=not retry_only):
+                counts["retried"] += 1
+                if asset["status"] == "downloaded":
+                    counts["recovered"] += 1
+                total_bytes += asset["bytes"]
+                yield asset
+        except run_control.RunCancelled:
+            pass
+        if len(retry_links):
+            logging.warning("%d assets still failed; they are retried on the next run", len(retry_links))
+
+    if ledger is None:
+        # 分担モードでは他のワーカーが同じファイルに追記している (書き直すとその行が消える) ので、
+        # 詰め直しは 1 台で動かしたときに任せる
+        ignore_links.maybe_compact()
+        retry_links.maybe_compact()
+
+    logging.info("Concurrency at end: %s", http_client.describe_concurrency())
+    # ダウンロード中に直し始めた分を待ち、残り (プールが無かった分) をまとめて直す
+    streamed = finish_transcoder()
+    if streamed:
+        logging.info("Fixed %d ogg files during download", streamed)
     logging.info("Encoding %d ogg files...", len(downloaded_ogg_files))
 
-    fix_ogg_files(list(set(downloaded_ogg_files)))
+    ogg_files = list(set(downloaded_ogg_files))
+    store_transcoded(ogg_files, fix_ogg_files(ogg_files))
+    store = blob_store.get_store(asset_folder)
+    if store is not None:
+        store.close()
 
-    return {
+    result = {
+        "kind": "summary",
         "success": True,
+        "cancelled": False,
+        "reason": "",
         "ignored": len(ignore_links),
-        "message": "Assets download completed"
+        "retry_pending": len(retry_links),
+        "counts": counts,
+        "bytes": total_bytes,
+        "message": "Assets download completed" + (
+            f" ({len(retry_links)} assets failed, use Retry Failed Assets later)" if len(retry_links) else ""
+        )
     }
+
+    if breaker.tripped:
+        result.update({
+            "success": False,
+            "cancelled": True,
+            "reason": breaker.reason,
+            "message": f"Assets download cancelled: {breaker.reason}"
+        })
+
+    yield result
+
+
+def run_download_assets(
+    data_directory: str,
+    plan=None,
+    reset_breaker: bool = True,
+    ledger=None,
+    retry_only: bool = False
+) -> dict:
+    """全件終わるまで待って summary を返す (引数は iter_download_assets と同じ)"""
+
+    result = None
+    for record in iter_download_assets(data_directory, plan=plan, reset_breaker=reset_breaker,
+                                       ledger=ledger, retry_only=retry_only):
+        if record["kind"] == "summary":
+            result = record
+
+    result.pop("kind", None)
+    return result
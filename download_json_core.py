@@ -4,15 +4,24 @@ import requests
 import os
 import json
 import sys
+import time
 import urllib3
 import logging
 import configparser
 import threading
 import concurrent.futures as cf
 import re
+import shutil
+import hashlib
 import write_csv
 import modifi_json
 import ksd_postprocess
+import http_client
+import run_control
+import format_hints
+import job_journal
+import resumable
+import download_portrait as portrait
 from download_portrait import download_portrait
 
 # base urls (original)
@@ -50,6 +59,40 @@ if not os.path.exists(SETTING_PATH):
 config = configparser.RawConfigParser()
 config.read(SETTING_PATH)
 thread_num = config.getint('script', 'threads', fallback=8)
+# 1 ID (キャラ/エピソード) あたりの通信の持ち時間 (秒)。0 なら無制限
+id_budget = config.getfloat('network', 'id_budget', fallback=300)
+# KSD の復号・展開を並行して行うスレッド数
+ksd_threads = config.getint('script', 'ksd_threads', fallback=2)
+
+# 接続先 ([network] api_base / static_base で差し替え可。mock_server.py など)
+API_BASE = 'https://r.kamihimeproject.net'
+STATIC_BASE = 'https://static-r.kamihimeproject.net'
+
+def set_base_urls(api=None, static=None):
+    """base_url / static_base の接続先を差し替える。None の側はそのまま"""
+    global API_BASE, STATIC_BASE, static_base
+    if api:
+        api = api.rstrip('/')
+        for table in (base_url['kamihime'], base_url['eidolon'], base_url):
+            for key, url in table.items():
+                if isinstance(url, str):
+                    table[key] = api + url[len(API_BASE):]
+        API_BASE = api
+        http_client.register_host(api, "api")
+    if static:
+        static = static.rstrip('/')
+        static_base = static + static_base[len(STATIC_BASE):]
+        STATIC_BASE = static
+        portrait.set_static_base(static)
+
+set_base_urls(
+    config.get('network', 'api_base', fallback=None),
+    config.get('network', 'static_base', fallback=None)
+)
+
+ASSETS_ROOT = os.path.join(BASE_DIR, "assets")
+# 受信途中の gameData.ksd (URL ごと)。切れても次は続きから受け取る (resumable.py)
+PARTIAL_DIR = os.path.join(BASE_DIR, "partial")
 
 ADV_TYPES = {
     "soul": {
@@ -78,6 +121,25 @@ ADV_TYPES = {
     }
 }
 
+# -----------------------------
+# latest.txt (app / watch / shard_worker 共通)
+# -----------------------------
+def load_latest_txt(path: str) -> dict:
+    latest = {}
+    if not os.path.exists(path):
+        return latest
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            latest[key.strip()] = value.strip()
+    return latest
+
 # -----------------------------
 # band parsing helpers
 # -----------------------------
@@ -214,6 +276,160 @@ def write_index_csv(path='index.csv'):
                 f.write(line)
     logging.error(f"Wrote index to {path}")
 
+# -----------------------------
+# asset plan collection (thread-safe)
+# -----------------------------
+# JSON 段階で新しく保存したシナリオを、アセット段階にそのまま渡すための作業計画
+asset_plan_lock = threading.Lock()
+asset_plan = []
+asset_plan_sink = None  # run_download_json(on_scenario=...) で渡されたコールバック
+
+def add_asset_plan(entry):
+    with asset_plan_lock:
+        asset_plan.append(entry)
+        sink = asset_plan_sink
+    if sink is not None:
+        sink(entry)
+
+# -----------------------------
+# staging / commit (job journal)
+# -----------------------------
+# キャラ/エピソードフォルダは save_root/.staging/ 以下に書き、全部そろってから
+# os.replace で本来の場所へ移す。本来のフォルダがある = 完了済み、となるので
+# 途中で落ちたキャラが「既存フォルダ」としてスキップされ続けることはない。
+STAGING_DIR = ".staging"
+# 分担モード (run_download_json(ledger=...)) ではワーカーごとに一時フォルダを分ける
+staging_owner = ""
+
+def staging_path(save_root, save_dir):
+    return os.path.join(save_root, STAGING_DIR, staging_owner, os.path.relpath(save_dir, save_root))
+
+def stage_dir(save_root, save_dir):
+    """
+    save_dir の代わりに書き込む一時フォルダを用意する (前回の残骸は消す)。
+    このスレッドで保存したシナリオは commit_dir まで保留される。
+    """
+    stage = staging_path(save_root, save_dir)
+    if os.path.exists(stage):
+        logging.warning("Discarding unfinished %s", stage)
+        shutil.rmtree(stage, ignore_errors=True)
+    os.makedirs(stage, exist_ok=True)
+    job_journal.start("json", save_dir)
+    _job_local.saved = []
+    return stage
+
+def scenario_saved(stage, file_name, scene_info, save_file, ext):
+    """シナリオ本体を一時フォルダに保存した直後に呼ぶ (後続処理は commit_dir で)"""
+    saved = getattr(_job_local, 'saved', None)
+    if saved is None:
+        saved = _job_local.saved = []
+    saved.append((file_name, scene_info, os.path.basename(save_file), ext))
+
+def commit_dir(save_root, stage, save_dir):
+    """
+    一時フォルダを save_dir に確定し、保存したシナリオの後続処理を行う。
+    - 後続の作業 (KSD 展開 / アセット取得) をジャーナルに planned として記録
+    - os.replace でフォルダを確定し、json 段階を committed に
+    - 確定後のパスで ID ごとの結果への記録、KSD プール投入、アセット作業計画への追加
+    return: 確定できたら True
+    """
+    saved = getattr(_job_local, 'saved', None) or []
+    _job_local.saved = None
+
+    if not saved:
+        logging.error("Nothing saved for %s", save_dir)
+        shutil.rmtree(stage, ignore_errors=True)
+        return False
+
+    scenario_type, character = os.path.relpath(save_dir, save_root).split(os.sep)[:2]
+    follow_ups = []
+    for file_name, scene_info, save_name, ext in saved:
+        save_file = os.path.join(save_dir, save_name)
+        if ext == 'ksd':
+            job_journal.plan("ksd", save_file)
+            follow_ups.append((file_name, save_file, None))
+            continue
+
+        entry = {
+            "scenario_type": scenario_type,
+            "character": character,
+            "filename": f"{file_name}.json",
+            "script_path": save_file,
+            "resource_directory": scene_info.get("resource_directory") or "",
+            "scenario_path": scene_info.get("scenario_path", ""),
+        }
+        job_journal.plan("asset", save_file, entry=entry)
+        follow_ups.append((file_name, save_file, entry))
+
+    os.makedirs(os.path.dirname(save_dir), exist_ok=True)
+    try:
+        os.replace(stage, save_dir)
+    except OSError as e:
+        # 同名キャラを別ワーカーが先に確定した場合など
+        logging.warning("Could not commit %s : %s", save_dir, e)
+        shutil.rmtree(stage, ignore_errors=True)
+        note_job(status="skipped")
+        return False
+    job_journal.commit("json", save_dir)
+    note_job(save_dir=save_dir)
+
+    for file_name, save_file, entry in follow_ups:
+        note_job(path=os.path.join(save_dir, f"{file_name}.json"))
+        note_job(path=save_file)
+        if entry is None:
+            submit_ksd(save_file)
+        else:
+            add_asset_plan(entry)
+    return True
+
+def abort_dir(stage, save_dir):
+    """
+    commit_dir まで行かなかった (途中で return / 例外) ときの後始末。
+    一時フォルダを消し、json 段階を aborted にする (確定済みなら何もしない)。
+    """
+    _job_local.saved = None
+    if job_journal.status("json", save_dir) == job_journal.COMMITTED:
+        return
+    shutil.rmtree(stage, ignore_errors=True)
+    job_journal.abort("json", save_dir)
+
+def submit_ksd(ksd_path):
+    """KSD プールへ。展開が終わったらジャーナルに committed を記録"""
+    job_journal.start("ksd", ksd_path)
+    ksd_postprocess.submit_ksd(ksd_path, ASSETS_ROOT, on_done=_ksd_done)
+
+def _ksd_done(ksd_path, ok):
+    if ok:
+        job_journal.commit("ksd", ksd_path)
+
+def resume_journal():
+    """
+    前回落ちたときに committed にならなかった作業を拾い直す。
+    - json : フォルダ確定後に落ちた分は committed に (確定前の分は ID の処理でやり直し)
+    - ksd  : .ksd が残っていれば再投入 (展開後は .ksd が消えるので committed に)
+    - asset: アセット作業計画に戻す
+    """
+    for rec in job_journal.pending("json"):
+        if os.path.isdir(rec["unit"]):
+            job_journal.commit("json", rec["unit"])
+
+    resumed = 0
+    for rec in job_journal.pending("ksd"):
+        if os.path.exists(rec["unit"]):
+            submit_ksd(rec["unit"])
+            resumed += 1
+        else:
+            job_journal.commit("ksd", rec["unit"])
+
+    for rec in job_journal.pending("asset"):
+        entry = rec.get("data", {}).get("entry")
+        if entry and os.path.exists(rec["unit"]):
+            add_asset_plan(entry)
+            resumed += 1
+
+    if resumed:
+        logging.info("Resumed %d unfinished KSD/asset jobs from the journal", resumed)
+
 # -----------------------------
 # download_info helper (no file save unless requested)
 # -----------------------------
@@ -223,20 +439,24 @@ def download_info_nosave(id_str, url, s, headers, save=False, save_folder=None):
     Returns parsed JSON or None on error.
     """
     try:
-        r = s.get(url, headers=headers, verify=False, timeout=15)
+        r = http_client.get(s, url, headers=headers, verify=False, timeout=15)
     except Exception as e:
         logging.error("Request failed %s : %s", url, e)
+        note_job(status="error")
         return None
     if r.status_code == 440:
-        logging.error("Token incorrect or expired (440). Exiting.")
-        sys.exit(1)
+        # 他のワーカーも含めて実行全体を止める
+        logging.error("Token incorrect or expired (440). Cancelling run.")
+        run_control.session_expired()
     if r.status_code != 200:
         logging.error("Info not found or error (%s) for %s", r.status_code, url)
+        note_unavailable(r.status_code)
         return []
     try:
         info = r.json()
     except Exception as e:
         logging.error("JSON parse failed for %s : %s", url, e)
+        note_job(status="error")
         return []
     if 'errors' in info:
         logging.error("API returned errors for %s : %s", url, info.get('errors'))
@@ -251,6 +471,83 @@ def download_info_nosave(id_str, url, s, headers, save=False, save_folder=None):
             logging.error("Failed to save info %s : %s", file_path, e)
     return info
 
+# -----------------------------
+# scenario file fetch (scenario.json / gameData.ksd)
+# -----------------------------
+def fetch_scenario_file(s, headers, scenario_path, hint_keys):
+    """
+    static からシナリオ本体を取得する。
+    .json の場合は scenario.json / gameData.ksd のうち format_hints が
+    前回当たったと覚えている方から試し、外れたらもう一方を試す。
+    return: (body, ext) / 取れなければ (None, None)
+      body は本文の bytes (ksd だけは受け取ったファイルのパス)。save_scenario_file で保存する
+    """
+    if not scenario_path.endswith('.json'):
+        ks_url = static_base + scenario_path
+        try:
+            rsc = http_client.get(s, ks_url, headers=headers, verify=False, timeout=20)
+        except Exception as e:
+            logging.error("Failed to get static %s : %s", ks_url, e)
+            return None, None
+        if rsc.status_code != 200:
+            logging.error("Scenario file missing (%s): %s", rsc.status_code, ks_url)
+            return None, None
+        return rsc.content, 'ks'
+
+    candidates = {
+        'json': scenario_path,
+        # scenario.json → gameData.ksd
+        'ksd': re.sub(r'[^/]+$', 'gameData.ksd', scenario_path),
+    }
+    first = format_hints.predict(hint_keys)
+    order = [first] + [fmt for fmt in format_hints.FORMATS if fmt != first]
+
+    urls = []
+    for fmt in order:
+        url = static_base + candidates[fmt]
+        urls.append(url)
+        try:
+            if fmt == 'ksd':
+                body = fetch_ksd(s, headers, url)
+            else:
+                rsc = http_client.get(s, url, headers=headers, verify=False, timeout=20)
+                body = rsc.content if rsc.status_code == 200 else None
+        except Exception as e:
+            logging.error("Failed to get static %s : %s", url, e)
+            continue
+
+        if body is not None:
+            format_hints.record(hint_keys, fmt)
+            return body, fmt
+
+        logging.warning("Scenario file missing (%s). Trying other format...", url)
+
+    logging.error("Both scenario and gameData.ksd missing: %s", " / ".join(urls))
+    return None, None
+
+def fetch_ksd(s, headers, url):
+    """
+    gameData.ksd は大きいので PARTIAL_DIR に続きから取れる形で受け取る
+    (メモリには読み込まない)。return: 受け取ったファイルのパス / 取れなければ None
+    """
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    dst = os.path.join(PARTIAL_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".ksd")
+    got = resumable.fetch(s, url, dst, headers=headers, verify=False, timeout=20)
+    if not got["saved"]:
+        return None
+    if got["resumed"]:
+        logging.info("Resumed %s from %d bytes", url, got["resumed"])
+    return dst
+
+def save_scenario_file(body, ext, save_file):
+    """fetch_scenario_file の本文を save_file に置く (ksd は受け取ったファイルを移すだけ)"""
+    if ext == 'ksd':
+        # 保存先は別のドライブのこともある
+        shutil.move(body, save_file)
+        return
+    with open(save_file, 'wb') as f:
+        f.write(body)
+
 # -----------------------------
 # Core per-category workflow (reused original logic with small edits)
 # -----------------------------
@@ -294,192 +591,164 @@ def process_kamihime_id(kh_id, s, headers, save_root):
     save_dir = os.path.join(save_root, f"{rarity} Kamihime", name)
     if os.path.exists(save_dir):
         logging.warning(f"Skip {kh_id} — already exists.")
+        note_job(status="skipped", save_dir=save_dir)
         return []
-    os.makedirs(save_dir, exist_ok=True)
-
-    # ★ ポートレートダウンロード
-    download_portrait(
-        char_type="kamihime",
-        char_id=kh_id,
-        char_name=name
-    )
-
-    # skip non SR/SSR? original code only targeted SR/SSR for third episode logic,
-    # but original script attempted all characters. We keep downloading but skip non-targeted?
-    # For safety, proceed but later filter as needed.
-    # get scenes
-    url_scenes = base_url['kamihime']['scenes'] + id_str
-    r = s.get(url_scenes, headers=headers, verify=False)
-    if r.status_code != 200:
-        logging.error("No scenes for kh_id %s (%s)", id_str, r.status_code)
-        return []
-    try:
-        info_ep_1 = r.json()
-    except:
-        logging.error("Invalid scenes JSON for %s", url_scenes)
-        return []
-    # derive episode ids similarly to original
+    stage = stage_dir(save_root, save_dir)
+    committed = False
     try:
-        ep_1_id = int(info_ep_1['episode_id'].split('_')[0])
-    except Exception:
-        logging.error("Invalid episode_id structure for %s", url_scenes)
-        return []
-    eps = []
-    if ep_1_id and isinstance(ep_1_id, int):
-        name = info.get('name', '')
-        rare = info.get('rare', '')
-
-        # ベースは2話（例: R / 一部SSR）
-        eps = [ep_1_id - 1, ep_1_id]
 
-        # SRは必ず3話
-        if rare == 'SR':
-            eps.append(ep_1_id + 1)
-
-        # SSRは条件分岐
-        elif rare == 'SSR':
-            if any(k in name for k in ['神化覚醒', '反心想', '純想悪', '心想昇華']):
-                # これらは2話固定（既に2話リスト済み）
-                pass
-            elif '神想真化' in name:
-                # 神想真化は1話だけ
-                eps = [ep_1_id]
-            else:
-                # 通常SSRは3話
-                eps.append(ep_1_id + 1)
-    else:
-        print(f"Warning: invalid ep_1_id for {info.get('name','Unknown')}")
-    scenes = []
-    for ep in eps:
-        url_ep = base_url['episode'] + str(ep) + "_harem-character"
-        r2 = s.get(url_ep, headers=headers, verify=False)
-        if r2.status_code != 200:
-            logging.error("episode detail missing %s", url_ep)
-            continue
-        try:
-            data = r2.json()
-
-        except Exception as e:
-            logging.error("Invalid episode detail JSON %s: %s", url_ep, e)
-            continue
+        # ★ ポートレートダウンロード
+        download_portrait(
+            char_type="kamihime",
+            char_id=kh_id,
+            char_name=name
+        )
 
-        # extract scenarios/harem_scenes
+        # skip non SR/SSR? original code only targeted SR/SSR for third episode logic,
+        # but original script attempted all characters. We keep downloading but skip non-targeted?
+        # For safety, proceed but later filter as needed.
+        # get scenes
+        url_scenes = base_url['kamihime']['scenes'] + id_str
+        r = http_client.get(s, url_scenes, headers=headers, verify=False)
+        if r.status_code != 200:
+            logging.error("No scenes for kh_id %s (%s)", id_str, r.status_code)
+            note_unavailable(r.status_code)
+            return []
         try:
-            chapter = data['chapters'][0]
-            if 'scenarios' in chapter and chapter['scenarios']:
-                scenario = chapter['scenarios'][0]
-                scenes.append({
-                    "id": scenario['scenario_id'],
-                    "resource_directory": scenario.get('resource_directory')
-                })
-            if 'harem_scenes' in chapter and chapter['harem_scenes']:
-                hs = chapter['harem_scenes'][0]
-                scenes.append({
-                    "id": hs['harem_scene_id'],
-                    "resource_directory": hs.get('resource_directory')
-                })
-        except Exception as e:
-            logging.error("Failed parsing chapter for %s: %s", url_ep, e)
-
-    if not scenes:
-        logging.error("No scenes resolved for %s", kh_id)
-        return []
-
-    # for each scene, fetch scenario_info or construct path, then download static file
-    saved_paths = []
-    for scene in scenes:
-        file_name = scene['id']
-        # attempt to fetch scene meta via base_url['scene'] + file_name
+            info_ep_1 = r.json()
+        except:
+            logging.error("Invalid scenes JSON for %s", url_scenes)
+            return []
+        # derive episode ids similarly to original
         try:
-            scene_url = base_url['scene'] + file_name
-            r3 = s.get(scene_url, headers=headers, verify=False)
-            if r3.status_code == 200:
-                scene_info = r3.json()
-            else:
-                # fallback to construct scenario_path
-                resource_directory = scene.get('resource_directory','')
-                resource_code = '/'.join([resource_directory[-6:][i:i+3] for i in range(0, len(resource_directory[-6:]), 3)])
-                scene_info = {"scenario_path": f"{resource_code}/{resource_directory}/scenario.json", "resource_directory": resource_directory}
-        except Exception as e:
-            logging.error("Scene meta fetch failed for %s: %s", file_name, e)
-            continue
-
-        # build static url and download .ks/.json
-        scenario_path = scene_info.get('scenario_path')
-        if not scenario_path:
-            logging.info("No scenario_path for %s", file_name)
-            continue
-        ks_url = static_base + scenario_path
+            ep_1_id = int(info_ep_1['episode_id'].split('_')[0])
+        except Exception:
+            logging.error("Invalid episode_id structure for %s", url_scenes)
+            return []
+        eps = []
+        if ep_1_id and isinstance(ep_1_id, int):
+            name = info.get('name', '')
+            rare = info.get('rare', '')
+
+            # ベースは2話（例: R / 一部SSR）
+            eps = [ep_1_id - 1, ep_1_id]
+
+            # SRは必ず3話
+            if rare == 'SR':
+                eps.append(ep_1_id + 1)
 
-        try:
-            rsc = s.get(ks_url, headers=headers, verify=False, timeout=20)
-        except Exception as e:
-            logging.error("Failed to get static %s : %s", ks_url, e)
-            continue
+            # SSRは条件分岐
+            elif rare == 'SSR':
+                if any(k in name for k in ['神化覚醒', '反心想', '純想悪', '心想昇華']):
+                    # これらは2話固定（既に2話リスト済み）
+                    pass
+                elif '神想真化' in name:
+                    # 神想真化は1話だけ
+                    eps = [ep_1_id]
+                else:
+                    # 通常SSRは3話
+                    eps.append(ep_1_id + 1)
+        else:
+            print(f"Warning: invalid ep_1_id for {info.get('name','Unknown')}")
+        scenes = []
+        for ep in eps:
+            url_ep = base_url['episode'] + str(ep) + "_harem-character"
+            r2 = http_client.get(s, url_ep, headers=headers, verify=False)
+            if r2.status_code != 200:
+                logging.error("episode detail missing %s", url_ep)
+                continue
+            try:
+                data = r2.json()
 
-        # ==================================================
-        # Helix fallback:
-        # scenario.json が無い場合 gameData.ksd を試す
-        # ==================================================
-        if rsc.status_code != 200:
+            except Exception as e:
+                logging.error("Invalid episode detail JSON %s: %s", url_ep, e)
+                continue
 
-            logging.warning(
-                "Scenario file missing (%s). Trying gameData.ksd fallback...",
-                ks_url
-            )
+            # extract scenarios/harem_scenes
+            try:
+                chapter = data['chapters'][0]
+                if 'scenarios' in chapter and chapter['scenarios']:
+                    scenario = chapter['scenarios'][0]
+                    scenes.append({
+                        "id": scenario['scenario_id'],
+                        "resource_directory": scenario.get('resource_directory')
+                    })
+                if 'harem_scenes' in chapter and chapter['harem_scenes']:
+                    hs = chapter['harem_scenes'][0]
+                    scenes.append({
+                        "id": hs['harem_scene_id'],
+                        "resource_directory": hs.get('resource_directory')
+                    })
+            except Exception as e:
+                logging.error("Failed parsing chapter for %s: %s", url_ep, e)
 
-            # scenario.json → gameData.ksd
-            ksd_path = re.sub(r'[^/]+$', 'gameData.ksd', scenario_path)
-            ksd_url = static_base + ksd_path
+        if not scenes:
+            logging.error("No scenes resolved for %s", kh_id)
+            return []
 
+        # for each scene, fetch scenario_info or construct path, then download static file
+        saved_paths = []
+        for scene in scenes:
+            file_name = scene['id']
+            # attempt to fetch scene meta via base_url['scene'] + file_name
             try:
-                rsc = s.get(ksd_url, headers=headers, verify=False, timeout=20)
+                scene_url = base_url['scene'] + file_name
+                r3 = http_client.get(s, scene_url, headers=headers, verify=False)
+                if r3.status_code == 200:
+                    scene_info = r3.json()
+                else:
+                    # fallback to construct scenario_path
+                    resource_directory = scene.get('resource_directory','')
+                    resource_code = '/'.join([resource_directory[-6:][i:i+3] for i in range(0, len(resource_directory[-6:]), 3)])
+                    scene_info = {"scenario_path": f"{resource_code}/{resource_directory}/scenario.json", "resource_directory": resource_directory}
             except Exception as e:
-                logging.error("Fallback gameData.ksd failed %s : %s", ksd_url, e)
+                logging.error("Scene meta fetch failed for %s: %s", file_name, e)
                 continue
 
-            if rsc.status_code != 200:
-                logging.error(
-                    "Both scenario and gameData.ksd missing: %s / %s",
-                    ks_url,
-                    ksd_url
-                )
+            # build static url and download .ks/.json
+            scenario_path = scene_info.get('scenario_path')
+            if not scenario_path:
+                logging.info("No scenario_path for %s", file_name)
+                continue
+            # Helix (Harem 2.0) は scenario.json / gameData.ksd のどちらか
+            hint_keys = format_hints.keys_for('kamihime', kh_id, scene_info.get('resource_directory', ''))
+            body, ext = fetch_scenario_file(s, headers, scenario_path, hint_keys)
+            if body is None:
                 continue
 
-            # fallback 成功
-            ext = "ksd"
-
-        else:
-            # 通常処理
-            is_json = scenario_path.endswith('.json')
-            ext = 'json' if is_json else 'ks'
-
-        save_file = os.path.join(save_dir, f"{file_name}_script.{ext}")
+            save_file = os.path.join(stage, f"{file_name}_script.{ext}")
         
-        # CSV用のデータ格納処理
-        # EPxID は必ず保存
-        csv_row[f"EP{ep_no}ID"] = file_name
+            # CSV用のデータ格納処理
+            # EPxID は必ず保存
+            csv_row[f"EP{ep_no}ID"] = file_name
 
-        # Title / Info は代表EPのみ
-        if ep_no in TITLE_INFO_EP:
-            csv_row[f"EP{ep_no}Title"] = scene_info.get("title", "")
-            csv_row[f"EP{ep_no}Info"] = scene_info.get("summary", "")
+            # Title / Info は代表EPのみ
+            if ep_no in TITLE_INFO_EP:
+                csv_row[f"EP{ep_no}Title"] = scene_info.get("title", "")
+                csv_row[f"EP{ep_no}Info"] = scene_info.get("summary", "")
 
-        ep_no += 1
+            ep_no += 1
 
-        # ★ jsonの元ファイルもここで保存する
-        ep_json_path = os.path.join(save_dir, f"{file_name}.json")
-        with open(ep_json_path, 'w', encoding='utf-8') as f:
-            json.dump(scene_info, f, ensure_ascii=False, indent=2)
+            # ★ jsonの元ファイルもここで保存する
+            ep_json_path = os.path.join(stage, f"{file_name}.json")
+            with open(ep_json_path, 'w', encoding='utf-8') as f:
+                json.dump(scene_info, f, ensure_ascii=False, indent=2)
 
-        try:
-            with open(save_file, 'wb') as f:
-                f.write(rsc.content)
-            saved_paths.append(save_file)
-        except Exception as e:
-            logging.error("Failed to save static %s : %s", save_file, e)
-            continue
+            try:
+                save_scenario_file(body, ext, save_file)
+                saved_paths.append(save_file)
+            except Exception as e:
+                logging.error("Failed to save static %s : %s", save_file, e)
+                continue
+
+            scenario_saved(stage, file_name, scene_info, save_file, ext)
 
+        committed = commit_dir(save_root, stage, save_dir)
+    finally:
+        if not committed:
+            abort_dir(stage, save_dir)
+    if not committed:
+        return []
     return csv_row
 
 
@@ -513,110 +782,115 @@ def process_eidolon_id(eid_id, s, headers, save_root):
     save_dir = os.path.join(save_root, f"Eidolon", name)
     if os.path.exists(save_dir):
         logging.warning(f"Skip {eid_id} — already exists.")
+        note_job(status="skipped", save_dir=save_dir)
         return []
-    os.makedirs(save_dir, exist_ok=True)
+    stage = stage_dir(save_root, save_dir)
+    committed = False
+    try:
 
-    # ★ ポートレートダウンロード
-    download_portrait(
-        char_type="eidolon",
-        char_id=eid_id,
-        char_name=name
-    )
+        # ★ ポートレートダウンロード
+        download_portrait(
+            char_type="eidolon",
+            char_id=eid_id,
+            char_name=name
+        )
 
-    # these info dicts in original used 'summon_id'
-    # get scenes via base_url['eidolon']['scenes'] + id
-    url_scenes = base_url['eidolon']['scenes'] + id_str
-    r = s.get(url_scenes, headers=headers, verify=False)
-    if r.status_code != 200:
-        logging.error("No eidolon scenes for %s", id_str)
-        return []
-    try:
-        info_ep_1 = r.json()
-    except:
-        logging.error("Invalid eidolon scenes JSON %s", url_scenes)
-        return []
-    try:
-        ep_1_id = int(info_ep_1['episode_id'].split('_')[0])
-    except Exception:
-        logging.error("Bad episode_id for eidolon %s", id_str)
-        return []
-    eps = [ep_1_id - 1, ep_1_id]
-    scenes = []
-    for ep in eps:
-        url_ep = base_url['episode'] + str(ep) + "_harem-summon"
-        r2 = s.get(url_ep, headers=headers, verify=False)
-        if r2.status_code != 200:
-            logging.error("eidolon episode missing %s", url_ep)
-            continue
+        # these info dicts in original used 'summon_id'
+        # get scenes via base_url['eidolon']['scenes'] + id
+        url_scenes = base_url['eidolon']['scenes'] + id_str
+        r = http_client.get(s, url_scenes, headers=headers, verify=False)
+        if r.status_code != 200:
+            logging.error("No eidolon scenes for %s", id_str)
+            note_unavailable(r.status_code)
+            return []
         try:
-            data = r2.json()
+            info_ep_1 = r.json()
         except:
-            continue
-        chapter = data['chapters'][0]
-        if 'scenarios' in chapter and chapter['scenarios']:
-            sc = chapter['scenarios'][0]
-            scenes.append({"id": sc['scenario_id'], "resource_directory": sc.get('resource_directory')})
-        if 'harem_scenes' in chapter and chapter['harem_scenes']:
-            hs = chapter['harem_scenes'][0]
-            scenes.append({"id": hs['harem_scene_id'], "resource_directory": hs.get('resource_directory')})
-    if not scenes:
-        logging.error("No scenes for eidolon %s", eid_id)
-        return []
-    
-    saved_paths = []
-    for scene in scenes:
-        file_name = scene['id']
+            logging.error("Invalid eidolon scenes JSON %s", url_scenes)
+            return []
         try:
-            r3 = s.get(base_url['scene'] + file_name, headers=headers, verify=False)
-            if r3.status_code == 200:
-                scene_info = r3.json()
+            ep_1_id = int(info_ep_1['episode_id'].split('_')[0])
+        except Exception:
+            logging.error("Bad episode_id for eidolon %s", id_str)
+            return []
+        eps = [ep_1_id - 1, ep_1_id]
+        scenes = []
+        for ep in eps:
+            url_ep = base_url['episode'] + str(ep) + "_harem-summon"
+            r2 = http_client.get(s, url_ep, headers=headers, verify=False)
+            if r2.status_code != 200:
+                logging.error("eidolon episode missing %s", url_ep)
+                continue
+            try:
+                data = r2.json()
+            except:
+                continue
+            chapter = data['chapters'][0]
+            if 'scenarios' in chapter and chapter['scenarios']:
+                sc = chapter['scenarios'][0]
+                scenes.append({"id": sc['scenario_id'], "resource_directory": sc.get('resource_directory')})
+            if 'harem_scenes' in chapter and chapter['harem_scenes']:
+                hs = chapter['harem_scenes'][0]
+                scenes.append({"id": hs['harem_scene_id'], "resource_directory": hs.get('resource_directory')})
+        if not scenes:
+            logging.error("No scenes for eidolon %s", eid_id)
+            return []
+    
+        saved_paths = []
+        for scene in scenes:
+            file_name = scene['id']
+            try:
+                r3 = http_client.get(s, base_url['scene'] + file_name, headers=headers, verify=False)
+                if r3.status_code == 200:
+                    scene_info = r3.json()
+
+                else:
+                    resource_directory = scene.get('resource_directory','')
+                    resource_code = '/'.join([resource_directory[-6:][i:i+3] for i in range(0, len(resource_directory[-6:]), 3)])
+                    scene_info = {"scenario_path": f"{resource_code}/{resource_directory}/scenario.json", "resource_directory": resource_directory}
+            except Exception as e:
+                logging.error("Scene meta fetch failed %s : %s", file_name, e)
+                continue
+            scenario_path = scene_info.get('scenario_path')
+            if not scenario_path:
+                continue
+            hint_keys = format_hints.keys_for('eidolon', eid_id, scene_info.get('resource_directory', ''))
+            body, ext = fetch_scenario_file(s, headers, scenario_path, hint_keys)
+            if body is None:
+                continue
+            save_file = os.path.join(stage, f"{file_name}_script.{ext}")
 
-            else:
-                resource_directory = scene.get('resource_directory','')
-                resource_code = '/'.join([resource_directory[-6:][i:i+3] for i in range(0, len(resource_directory[-6:]), 3)])
-                scene_info = {"scenario_path": f"{resource_code}/{resource_directory}/scenario.json", "resource_directory": resource_directory}
-        except Exception as e:
-            logging.error("Scene meta fetch failed %s : %s", file_name, e)
-            continue
-        scenario_path = scene_info.get('scenario_path')
-        if not scenario_path:
-            continue
-        ks_url = static_base + scenario_path
-        try:
-            rsc = s.get(ks_url, headers=headers, verify=False, timeout=20)
-        except Exception as e:
-            logging.error("Static fetch failed %s : %s", ks_url, e)
-            continue
-        if rsc.status_code != 200:
-            continue
-        is_json = scenario_path.endswith('.json')
-        ext = 'json' if is_json else 'ks'
-        save_file = os.path.join(save_dir, f"{file_name}_script.{ext}")
+            # CSV用のデータ格納処理
+            # EPxID は必ず保存
+            csv_row[f"EP{ep_no}ID"] = file_name
 
-        # CSV用のデータ格納処理
-        # EPxID は必ず保存
-        csv_row[f"EP{ep_no}ID"] = file_name
+            # Title / Info は代表EPのみ
+            if ep_no in TITLE_INFO_EP:
+                csv_row[f"EP{ep_no}Title"] = scene_info.get("title", "")
+                csv_row[f"EP{ep_no}Info"] = scene_info.get("summary", "")
 
-        # Title / Info は代表EPのみ
-        if ep_no in TITLE_INFO_EP:
-            csv_row[f"EP{ep_no}Title"] = scene_info.get("title", "")
-            csv_row[f"EP{ep_no}Info"] = scene_info.get("summary", "")
+            ep_no += 1
 
-        ep_no += 1
+            # ★ jsonの元ファイルもここで保存する
+            ep_json_path = os.path.join(stage, f"{file_name}.json")
+            with open(ep_json_path, 'w', encoding='utf-8') as f:
+                json.dump(scene_info, f, ensure_ascii=False, indent=2)
 
-        # ★ jsonの元ファイルもここで保存する
-        ep_json_path = os.path.join(save_dir, f"{file_name}.json")
-        with open(ep_json_path, 'w', encoding='utf-8') as f:
-            json.dump(scene_info, f, ensure_ascii=False, indent=2)
+            try:
+                save_scenario_file(body, ext, save_file)
+                saved_paths.append(save_file)
+            except Exception as e:
+                logging.error("Failed to save %s : %s", save_file, e)
+                continue
 
-        try:
-            with open(save_file, 'wb') as f:
-                f.write(rsc.content)
-            saved_paths.append(save_file)
-        except Exception as e:
-            logging.error("Failed to save %s : %s", save_file, e)
-            continue
-    
+            scenario_saved(stage, file_name, scene_info, save_file, ext)
+
+        committed = commit_dir(save_root, stage, save_dir)
+    finally:
+        if not committed:
+            abort_dir(stage, save_dir)
+    if not committed:
+        return []
     return csv_row
 
 def process_adv_episode_id(ep_id: int, adv_type: str, s, headers, save_root):
@@ -638,9 +912,10 @@ def process_adv_episode_id(ep_id: int, adv_type: str, s, headers, save_root):
 
     scenes = []
     url_ep = base_url["episode"] + f"{ep_id}_{suffix}"
-    r = s.get(url_ep, headers=headers, verify=False)
+    r = http_client.get(s, url_ep, headers=headers, verify=False)
     if r.status_code != 200:
         logging.error(f"{rank} episode missing %s", url_ep)
+        note_unavailable(r.status_code)
         return []
     try:
         data = r.json()
@@ -660,82 +935,95 @@ def process_adv_episode_id(ep_id: int, adv_type: str, s, headers, save_root):
     # --- スキップ処理（既存フォルダがあればスキップ） ---
     if os.path.exists(save_dir):
         logging.warning(f"Skip {adv_type} {ep_id} — already exists.")
+        note_job(status="skipped", save_dir=save_dir)
         return []
-    os.makedirs(save_dir, exist_ok=True)
+    stage = stage_dir(save_root, save_dir)
+    committed = False
+    try:
 
-    # ★ポートレートダウンロード
-    if adv_type == "soul":
-        download_portrait(
-            char_type="soul",
-            char_id=ep_id,
-            char_name=dir_name
-        )
-    if adv_type in ("memorial", "burst", "concierge"):
-        download_portrait(
-            char_type=adv_type,
-            char_id=ep_id,
-            char_name=dir_name
-        )
+        # ★ポートレートダウンロード
+        if adv_type == "soul":
+            download_portrait(
+                char_type="soul",
+                char_id=ep_id,
+                char_name=dir_name
+            )
+        if adv_type in ("memorial", "burst", "concierge"):
+            download_portrait(
+                char_type=adv_type,
+                char_id=ep_id,
+                char_name=dir_name
+            )
 
-    # ===============================
-    # adv 用 CSV 正規化ロジック
-    # ===============================
-    ep2_id = None
-    ep2_title = ""
-    ep2_info = ""
-    ep3_id = None
+        # ===============================
+        # adv 用 CSV 正規化ロジック
+        # ===============================
+        ep2_id = None
+        ep2_title = ""
+        ep2_info = ""
+        ep3_id = None
 
-    for scene in scenes:
-        file_name = scene['id']
-        try:
-            r3 = s.get(base_url['scene'] + file_name, headers=headers, verify=False)
-            if r3.status_code == 200:
-                scene_info = r3.json()
+        for scene in scenes:
+            file_name = scene['id']
+            try:
+                r3 = http_client.get(s, base_url['scene'] + file_name, headers=headers, verify=False)
+                if r3.status_code == 200:
+                    scene_info = r3.json()
+
+                else:
+                    resource_directory = scene.get('resource_directory','')
+                    resource_code = '/'.join([resource_directory[-6:][i:i+3] for i in range(0, len(resource_directory[-6:]), 3)])
+                    scene_info = {"scenario_path": f"{resource_code}/{resource_directory}/scenario.json", "resource_directory": resource_directory}
+            except Exception as e:
+                logging.error("Scene meta fetch failed %s : %s", file_name, e)
+                continue
 
-            else:
-                resource_directory = scene.get('resource_directory','')
-                resource_code = '/'.join([resource_directory[-6:][i:i+3] for i in range(0, len(resource_directory[-6:]), 3)])
-                scene_info = {"scenario_path": f"{resource_code}/{resource_directory}/scenario.json", "resource_directory": resource_directory}
-        except Exception as e:
-            logging.error("Scene meta fetch failed %s : %s", file_name, e)
-            continue
+            scenario_path = scene_info.get("scenario_path", "")
+            if not scenario_path:
+                continue
+            is_ks = scenario_path.endswith(".ks")
+
+            title = scene_info.get("title", "")
+            summary = scene_info.get("summary", "")
+
+            # --- EP2（代表） ---
+            if title or summary:
+                if is_ks:
+                    ep2_id = file_name
+                    ep2_title = title
+                    ep2_info = summary
+
+                # --- EP3（重複） ---
+                elif not is_ks:
+                    ep2_title = title
+                    ep2_info = summary
+                    ep3_id = file_name
+
+            # --- 生 json 保存 ---
+            ep_json_path = os.path.join(stage, f"{file_name}.json")
+            with open(ep_json_path, "w", encoding="utf-8") as f:
+                json.dump(scene_info, f, ensure_ascii=False, indent=2)
+
+            # --- script 保存 ---
+            hint_keys = format_hints.keys_for(adv_type, ep_id, scene_info.get('resource_directory', ''))
+            body, ext = fetch_scenario_file(s, headers, scenario_path, hint_keys)
+            if body is None:
+                continue
+            try:
+                save_file = os.path.join(stage, f"{file_name}_script.{ext}")
+                save_scenario_file(body, ext, save_file)
+            except Exception as e:
+                logging.error("Failed to save %s : %s", save_file, e)
+                continue
 
-        scenario_path = scene_info.get("scenario_path", "")
-        if not scenario_path:
-            continue
-        is_ks = scenario_path.endswith(".ks")
-
-        title = scene_info.get("title", "")
-        summary = scene_info.get("summary", "")
-
-        # --- EP2（代表） ---
-        if title or summary:
-            if is_ks:
-                ep2_id = file_name
-                ep2_title = title
-                ep2_info = summary
-
-            # --- EP3（重複） ---
-            elif not is_ks:
-                ep2_title = title
-                ep2_info = summary
-                ep3_id = file_name
-
-        # --- 生 json 保存 ---
-        ep_json_path = os.path.join(save_dir, f"{file_name}.json")
-        with open(ep_json_path, "w", encoding="utf-8") as f:
-            json.dump(scene_info, f, ensure_ascii=False, indent=2)
-
-        # --- script 保存 ---
-        try:
-            rsc = s.get(static_base + scenario_path, headers=headers, verify=False, timeout=20)
-            if rsc.status_code == 200:
-                ext = "json" if scenario_path.endswith(".json") else "ks"
-                save_file = os.path.join(save_dir, f"{file_name}_script.{ext}")
-                with open(save_file, "wb") as f:
-                    f.write(rsc.content)
-        except Exception:
-            pass
+            scenario_saved(stage, file_name, scene_info, save_file, ext)
+
+        committed = commit_dir(save_root, stage, save_dir)
+    finally:
+        if not committed:
+            abort_dir(stage, save_dir)
+    if not committed:
+        return []
 
     # --- CSV 反映 ---
     if ep2_id:
@@ -759,15 +1047,264 @@ def process_adv_episode_id(ep_id: int, adv_type: str, s, headers, save_root):
 # -----------------------------
 # main orchestration
 # -----------------------------
-def run_download_json(
+# -----------------------------
+# per-job record (thread local)
+# -----------------------------
+# ワーカー内で保存したファイル・バイト数を 1 ID 分の結果として集める
+_job_local = threading.local()
+
+def current_job():
+    return getattr(_job_local, 'record', None)
+
+def note_job(status=None, path=None, save_dir=None):
+    record = current_job()
+    if record is None:
+        return
+    if status:
+        record["status"] = status
+    if save_dir:
+        record["save_dir"] = save_dir
+    if path and os.path.exists(path):
+        record["paths"].append(path)
+        record["bytes"] += os.path.getsize(path)
+
+def note_unavailable(status_code):
+    """
+    取れなかった応答を記録する。404 なら (何も付けずに) missing のまま、
+    5xx などは error にする (watch の ID 台帳で missing_ttl の間止めずに次回やり直す)。
+    """
+    if status_code != 404:
+        note_job(status="error")
+
+def run_job(category, func, item_id, *args):
+    """
+    1 ID 分の処理。id_budget 秒以内に収め (超過分のリクエストは DeadlineExceeded)、
+    結果を dict で返す:
+      kind, category, id, status (saved/skipped/missing/error/cancelled),
+      save_dir (saved/skipped のとき), paths, bytes, elapsed, row (CSV 行), error
+    """
+    record = {
+        "kind": "id",
+        "category": category,
+        "id": item_id,
+        "status": None,
+        "save_dir": None,
+        "paths": [],
+        "bytes": 0,
+        "elapsed": 0.0,
+        "row": None,
+        "error": "",
+    }
+    _job_local.record = record
+    started = time.monotonic()
+
+    try:
+        with http_client.deadline(id_budget):
+            res = func(item_id, *args)
+        if isinstance(res, dict):
+            record["row"] = res
+            record["status"] = "saved"
+        elif record["status"] is None:
+            record["status"] = "missing"
+    except run_control.RunCancelled:
+        record["status"] = "cancelled"
+    except Exception as e:
+        logging.error("Error in %s worker: %s", category, e)
+        record["status"] = "error"
+        record["error"] = str(e)
+    finally:
+        record["elapsed"] = time.monotonic() - started
+        _job_local.record = None
+
+    return record
+
+def build_jobs(target, latest_dict, s, headers, save_root):
+    """
+    選択カテゴリの全 ID を 1 本の作業キューにまとめる。
+    yield: (category, func, item_id, args)
+    """
+    # Kamihime
+    if 'kamihime' in target:
+        logging.info("Generating Kamihime ID list from latest.txt ...")
+        kh_list = generate_kamihime_ids(latest_dict)     # latestから探索するIDを抽出
+        for tpl in kh_list:
+            yield ('kamihime', process_kamihime_id, tpl[2], (s, headers, save_root))
+
+    # Eidolon
+    if 'eidolon' in target:
+        logging.info("Generating Eidolon ID list from latest.txt ...")
+        eid_list = generate_eidolon_ids(latest_dict)
+        for tpl in eid_list:
+            yield ('eidolon', process_eidolon_id, tpl[2], (s, headers, save_root))
+
+    # Soul Skin / Memorial / Burst / Concierge
+    for adv_type in ('soul', 'memorial', 'burst', 'concierge'):
+        if adv_type not in target:
+            continue
+        for ep_id in generate_adv_episode_ids(latest_dict, adv_type):
+            yield (adv_type, process_adv_episode_id, ep_id, (adv_type, s, headers, save_root))
+
+class ShardedJobs:
+    """
+    複数ワーカーでの分担 (work_ledger)。
+    build_jobs の ID をカテゴリ + shard_size ごとの帯にまとめ、台帳から取れた帯の
+    ID だけを流す。帯の全 ID の結果が出たら done (error / cancelled があれば
+    他のワーカーに戻す)。
+    """
+
+    def __init__(self, ledger, jobs, shard_size):
+        self.ledger = ledger
+        self.jobs = jobs
+        self.shard_size = max(1, shard_size)
+        self._lock = threading.Lock()
+        self._remaining = {}   # unit -> 残り ID 数
+        self._failed = set()
+
+    def unit_of(self, category, item_id):
+        start = item_id // self.shard_size * self.shard_size
+        return f"{category}:{start}"
+
+    def _units(self):
+        # 帯の ID は latest.txt の並びによっては離れて出てくるので、並びに関係なく帯ごとにまとめる
+        grouped = {}
+        for job in self.jobs:
+            grouped.setdefault(self.unit_of(job[0], job[2]), []).append(job)
+        yield from grouped.items()
+
+    def __iter__(self):
+        for claimed in self.ledger.claim_iter(self._units()):
+            if claimed is None:
+                # 他のワーカーの帯が終わる (か lease が切れる) のを待っている
+                yield None
+                continue
+            unit, group = claimed
+            logging.info("Claimed %s (%d ids)", unit, len(group))
+            with self._lock:
+                # 同じ帯をもう一度取った (lease 切れの取り直しなど) ときは足す
+                self._remaining[unit] = self._remaining.get(unit, 0) + len(group)
+            yield from group
+
+    def finished(self, record):
+        unit = self.unit_of(record["category"], record["id"])
+        with self._lock:
+            if record["status"] in ("error", "cancelled"):
+                self._failed.add(unit)
+            self._remaining[unit] -= 1
+            if self._remaining[unit] > 0:
+                return
+            del self._remaining[unit]
+            failed = unit in self._failed
+            self._failed.discard(unit)
+
+        if failed:
+            self.ledger.release(unit)
+        else:
+            self.ledger.complete(unit)
+
+    def release_all(self):
+        """中断時: 終わっていない帯を戻す"""
+        with self._lock:
+            units = list(self._remaining)
+            self._remaining.clear()
+        for unit in units:
+            self.ledger.release(unit)
+
+_EXHAUSTED = object()
+
+def iter_jobs(jobs):
+    """
+    全カテゴリの ID を 1 つの ThreadPoolExecutor で処理し、終わった順に run_job の結果を yield する。
+    カテゴリの切れ目でプールが空くことはなく、API / static の並列数は
+    http_client のホスト別ゲート (api_concurrency / static_concurrency) で絞る。
+    未完了の future はワーカー数の数倍までしか持たないので、ID 数が多くてもメモリは一定。
+    jobs が None を返したら「今は無い」の意味で、少し待ってからまた取りに行く。
+    run_control.breaker が落ちたら未着手分はキャンセルされる。
+    """
+    breaker = run_control.breaker
+    if breaker.tripped:
+        return
+
+    workers = http_client.worker_count('api', 'static')
+    max_pending = workers * 4
+    logging.info("Scheduling jobs on %d workers", workers)
+
+    jobs = iter(jobs)
+    idle_wait = 1.0
+
+    with cf.ThreadPoolExecutor(max_workers=workers) as exc:
+        pending = set()
+        breaker.track(pending)
+        try:
+            exhausted = False
+            while True:
+                idle = False
+                while not exhausted and not breaker.tripped and len(pending) < max_pending:
+                    job = next(jobs, _EXHAUSTED)
+                    if job is _EXHAUSTED:
+                        exhausted = True
+                        break
+                    if job is None:
+                        # 今は取れる仕事が無い (ShardedJobs が他のワーカー待ち)
+                        idle = True
+                        break
+                    category, func, item_id, args = job
+                    pending.add(exc.submit(run_job, category, func, item_id, *args))
+
+                if not pending:
+                    if idle and not breaker.tripped:
+                        breaker.sleep(idle_wait)
+                        continue
+                    break
+
+                done, _ = cf.wait(pending, timeout=idle_wait if idle else None,
+                                  return_when=cf.FIRST_COMPLETED)
+                pending.difference_update(done)
+
+                for fut in done:
+                    if fut.cancelled():
+                        continue
+                    yield fut.result()
+        finally:
+            for fut in pending:
+                fut.cancel()
+            breaker.untrack(pending)
+
+def iter_download_json(
     session: str,
     target: list[str],
     latest_dict: dict,
     save_root: str,
-    modify_json: bool):
+    modify_json: bool,
+    on_scenario=None,
+    reset_breaker: bool = True,
+    ledger=None,
+    shard_size: int = 50,
+    http_session=None,
+    skip_id=None,
+    modify_new_only: bool = False):
+    """
+    run_download_json の逐次版。ID ごとの結果 (run_job 参照) を終わった順に yield し、
+    最後に {"kind": "summary", ...} (run_download_json の戻り値と同じ内容) を yield する。
+    on_scenario: 新しく保存したシナリオごとに (ワーカースレッドから) 呼ばれる。
+    引数はアセット作業計画 1 件分の dict。
+    summary の "asset_plan" にも同じものが全件入る (run_download_assets(plan=...) 用)。
+    reset_breaker: pipeline から他の段階と並走させる場合は False
+    ledger: work_ledger.Ledger (stage "json")。渡すと ID を shard_size ごとの帯に分け、
+    同じ台帳を使う他のワーカーと分担する (ShardedJobs 参照)。
+    http_session: 使い回す requests.Session (常駐モード用。None なら毎回作る)
+    skip_id: skip_id(category, id) が True の ID は問い合わせもしない (常駐モードの ID 台帳)
+    modify_new_only: modify_json を保存先全体ではなく今回保存したファイルだけに行う
+    (ledger を渡したときは常にこちら。全体を直すと各ワーカーが同じファイルを書き換え合う)
+    """
+    global asset_plan_sink, staging_owner
+
+    if ledger is not None:
+        modify_new_only = True
 
     result = {
         "success": True,
+        "cancelled": False,
+        "reason": "",
         "message": "",
         "errors": [],
         "counts": {
@@ -777,169 +1314,117 @@ def run_download_json(
             "memorial": 0,
             "burst": 0,
             "concierge": 0
-        }
+        },
+        "asset_plan": []
     }
 
+    with asset_plan_lock:
+        asset_plan.clear()
+        asset_plan_sink = on_scenario
+
     headers = {
         'x-kh-session': session,
         'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.113 Safari/537.36'
     }
-    s = requests.Session()
-    s.headers.update(headers)
+    s = http_session or http_client.new_session(headers)
+
+    breaker = run_control.breaker
+    if reset_breaker:
+        breaker.reset()
+
+    logging.info("Concurrency mode: %s (%s)",
+                 http_client.concurrency_mode, http_client.describe_concurrency())
 
     # 保存先ディレクトリ
     os.makedirs(save_root, exist_ok=True)
 
     csv_rows = []
+    saved_paths = []
 
-    # Kamihime
-    if 'kamihime' in target:
-        logging.info("Generating Kamihime ID list from latest.txt ...")
-        kh_list = generate_kamihime_ids(latest_dict)     # latestから探索するIDを抽出
-        kh_ids = [tpl[2] for tpl in kh_list]
-        with cf.ThreadPoolExecutor(max_workers=thread_num) as exc:
-            futures = [exc.submit(process_kamihime_id, kh, s, headers, save_root) for kh in kh_ids]
-            for fut in cf.as_completed(futures):
-                try:
-                    res = fut.result()
-                    if isinstance(res, dict):
-                        csv_rows.append(res)
-                        result["counts"]["kamihime"] += 1
-                except Exception as e:
-                    logging.error("Error in kamihime worker: %s", e)
-                    result["success"] = False
-                    result["errors"].append(str(e))
+    shard = None
+    if ledger is not None:
+        staging_owner = re.sub(r'[^\w.-]', '_', ledger.owner)
+        ledger.start_heartbeat()
 
-    # Eidolon
-    if 'eidolon' in target:
-        logging.info("Generating Eidolon ID list from latest.txt ...")
-        eid_list = generate_eidolon_ids(latest_dict)
-        eid_ids = [tpl[2] for tpl in eid_list]
-        with cf.ThreadPoolExecutor(max_workers=thread_num) as exc:
-            futures = [exc.submit(process_eidolon_id, eid, s, headers, save_root) for eid in eid_ids]
-            for fut in cf.as_completed(futures):
-                try:
-                    res = fut.result()
-                    if isinstance(res, dict):
-                        csv_rows.append(res)
-                        result["counts"]["eidolon"] += 1
-
-                except Exception as e:
-                    logging.error("Error in eidolon worker: %s", e)
-                    result["success"] = False
-                    result["errors"].append(str(e))
-
-    # Soul Skin
-    if 'soul' in target:
-        ep_ids = generate_adv_episode_ids(latest_dict, 'soul')
-        # logging.info(f"Soul Skin episodes to try: {len(ep_ids)}")
-
-        with cf.ThreadPoolExecutor(max_workers=thread_num) as exc:
-            futures = [
-                exc.submit(process_adv_episode_id, ep_id, 'soul', s, headers, save_root)
-                for ep_id in ep_ids
-            ]
-            for fut in cf.as_completed(futures):
-                try:
-                    res = fut.result()
-                    if isinstance(res, dict):
-                        csv_rows.append(res)
-                        result["counts"]["soul"] += 1
-
-                except Exception as e:
-                    logging.error("Error in soul worker: %s", e)
-                    result["success"] = False
-                    result["errors"].append(str(e))
-
-    # Memorial
-    if 'memorial' in target:
-        ep_ids = generate_adv_episode_ids(latest_dict, 'memorial')
-        # logging.info(f"memorial episodes to try: {len(ep_ids)}")
-
-        with cf.ThreadPoolExecutor(max_workers=thread_num) as exc:
-            futures = [
-                exc.submit(process_adv_episode_id, ep_id, 'memorial', s, headers ,save_root)
-                for ep_id in ep_ids
-            ]
-            for fut in cf.as_completed(futures):
-                try:
-                    res = fut.result()
-                    if isinstance(res, dict):
-                        csv_rows.append(res)
-                        result["counts"]["memorial"] += 1
-
-                except Exception as e:
-                    logging.error("Error in memorial worker: %s", e)
-                    result["success"] = False
-                    result["errors"].append(str(e))
-
-    # Burst
-    if 'burst' in target:
-        ep_ids = generate_adv_episode_ids(latest_dict, 'burst')
-        # logging.info(f"burst episodes to try: {len(ep_ids)}")
-
-        with cf.ThreadPoolExecutor(max_workers=thread_num) as exc:
-            futures = [
-                exc.submit(process_adv_episode_id, ep_id, 'burst', s, headers, save_root)
-                for ep_id in ep_ids
-            ]
-            for fut in cf.as_completed(futures):
-                try:
-                    res = fut.result()
-                    if isinstance(res, dict):
-                        csv_rows.append(res)
-                        result["counts"]["burst"] += 1
-                        
-                except Exception as e:
-                    logging.error("Error in burst worker: %s", e)
-                    result["success"] = False
-                    result["errors"].append(str(e))
-    
-    # Concierge
-    if 'concierge' in target:
-        ep_ids = generate_adv_episode_ids(latest_dict, 'concierge')
-        # logging.info(f"concierge episodes to try: {len(ep_ids)}")
-
-        with cf.ThreadPoolExecutor(max_workers=thread_num) as exc:
-            futures = [
-                exc.submit(process_adv_episode_id, ep_id, 'concierge', s, headers, save_root)
-                for ep_id in ep_ids
-            ]
-            for fut in cf.as_completed(futures):
-                try:
-                    res = fut.result()
-                    if isinstance(res, dict):
-                        csv_rows.append(res)
-                        result["counts"]["concierge"] += 1
-                        
-                except Exception as e:
-                    logging.error("Error in concierge worker: %s", e)
-                    result["success"] = False
-                    result["errors"].append(str(e))
-
-    write_csv.write_rows(csv_rows)
+    # .ksd はダウンロードされた時点で KSD プールに渡す
+    ksd_postprocess.start_pool(ASSETS_ROOT, ksd_threads)
+    # ポートレートは別キューで (シナリオ取得のワーカーを待たせない)
+    portrait.start_queue()
+
+    try:
+        # 前回途中で終わった作業を先に戻す
+        try:
+            job_journal.compact()
+        except OSError as e:
+            logging.error("Failed to compact journal: %s", e)
+        resume_journal()
+
+        jobs = build_jobs(target, latest_dict, s, headers, save_root)
+        if skip_id is not None:
+            jobs = (job for job in jobs if not skip_id(job[0], job[2]))
+        if ledger is not None:
+            shard = jobs = ShardedJobs(ledger, jobs, shard_size)
+        for record in iter_jobs(jobs):
+            if shard is not None:
+                shard.finished(record)
+            if record["status"] == "saved":
+                csv_rows.append(record["row"])
+                saved_paths.extend(record["paths"])
+                result["counts"][record["category"]] += 1
+            elif record["status"] == "error":
+                result["success"] = False
+                result["errors"].append(record["error"])
+            yield record
+    finally:
+        if shard is not None:
+            shard.release_all()
+        if ledger is not None:
+            ledger.stop_heartbeat()
+            staging_owner = ""
+        ksd_postprocess.finish_pool()
+        portrait.finish_queue()
+        with asset_plan_lock:
+            asset_plan_sink = None
+            result["asset_plan"] = list(asset_plan)
+
+    logging.info("Concurrency at end: %s", http_client.describe_concurrency())
+
+    try:
+        format_hints.save()
+    except Exception as e:
+        logging.error("Failed to save format hints: %s", e)
+
+    if ledger is not None:
+        # 他のワーカーと同時に index.csv へ追記しない
+        with ledger.exclusive():
+            write_csv.write_rows(csv_rows)
+    else:
+        write_csv.write_rows(csv_rows)
     logging.info("CSV written via write_csv.py")
 
-    if modify_json:
+    if modify_json and modify_new_only:
+        # .ksd は展開後に同じ名前の .json になっている
+        paths = [re.sub(r'\.ksd$', '.json', path) for path in saved_paths]
+        logging.info("Start JSON modification of %d new files", len(paths))
+        try:
+            modifi_json.process_files(paths)
+        except Exception:
+            logging.exception("JSON modification failed")
+    elif modify_json:
         logging.info("Start JSON modification under %s", save_root)
         try:
             modifi_json.process_root(save_root)
         except Exception:
             logging.exception("JSON modification failed")
 
-    assets_root = os.path.join(
-        BASE_DIR,
-        "assets"
-    )
+    if breaker.tripped:
+        result["success"] = False
+        result["cancelled"] = True
+        result["reason"] = breaker.reason
 
-    ksd_postprocess.process_root(
-        save_root,
-        assets_root
-    )
-    
     # message 組み立て
     result["message"] = (
-        f"Completed.\n"
+        (f"Cancelled: {breaker.reason}\n" if breaker.tripped else "Completed.\n") +
         f"Kamihime: {result['counts']['kamihime']}\n"
         f"Eidolon: {result['counts']['eidolon']}\n"
         f"Soul: {result['counts']['soul']}\n"
@@ -948,5 +1433,105 @@ def run_download_json(
         f"Concierge: {result['counts']['concierge']}\n"
     )
 
+    yield dict(result, kind="summary")
+
+def run_download_json(
+    session: str,
+    target: list[str],
+    latest_dict: dict,
+    save_root: str,
+    modify_json: bool,
+    on_scenario=None,
+    reset_breaker: bool = True,
+    ledger=None,
+    shard_size: int = 50,
+    http_session=None,
+    skip_id=None,
+    modify_new_only: bool = False):
+    """全件終わるまで待って summary を返す (引数は iter_download_json と同じ)"""
+
+    result = None
+    for record in iter_download_json(session, target, latest_dict, save_root, modify_json,
+                                     on_scenario=on_scenario, reset_breaker=reset_breaker,
+                                     ledger=ledger, shard_size=shard_size,
+                                     http_session=http_session, skip_id=skip_id,
+                                     modify_new_only=modify_new_only):
+        if record["kind"] == "summary":
+            result = record
+
+    result.pop("kind", None)
     return result
 
+# -----------------------------
+# portrait bulk sync
+# -----------------------------
+def sync_portrait_id(item_id, category, s, headers, save_root):
+    """
+    保存先にあるキャラ/エピソードのポートレートだけを取得する (既存の画像は download_portrait 側でスキップ)。
+    神姫・幻獣はフォルダ名 (= 名前) を知るために info を 1 回問い合わせる。
+    """
+    if category not in portrait.PORTRAIT_RULES:
+        return []
+
+    if category in ADV_TYPES:
+        conf = ADV_TYPES[category]
+        name = conf["dir_name"].format(ep_id=item_id)
+        save_dir = os.path.join(save_root, conf["folder"], name)
+    else:
+        id_str = str(item_id)
+        info = download_info_nosave(id_str, base_url[category]['info'] + id_str, s, headers, save=False)
+        if not info:
+            return []
+        raw_name = info.get('name') or f"ID_{id_str}"
+        name = raw_name.replace('[', '(').replace(']', ')')
+        if category == 'kamihime':
+            rarity = info.get('rare') or info.get('rarity') or ""
+            save_dir = os.path.join(save_root, f"{rarity} Kamihime", name)
+        else:
+            save_dir = os.path.join(save_root, "Eidolon", name)
+
+    if not os.path.isdir(save_dir):
+        return []
+
+    note_job(save_dir=save_dir)
+    if not portrait.fetch_portrait(category, item_id, name):
+        note_job(status="error")
+        return []
+    return {"Name": name}
+
+def run_sync_portraits(
+    session: str,
+    target: list[str],
+    latest_dict: dict,
+    save_root: str) -> dict:
+    """ポートレートだけをまとめて取得する (シナリオは取得しない)"""
+
+    headers = {
+        'x-kh-session': session,
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.113 Safari/537.36'
+    }
+    s = http_client.new_session(headers)
+
+    breaker = run_control.breaker
+    breaker.reset()
+
+    counts = {}
+    jobs = (
+        (category, sync_portrait_id, item_id, (category, s, headers, save_root))
+        for category, _, item_id, _ in build_jobs(target, latest_dict, s, headers, save_root)
+    )
+    for record in iter_jobs(jobs):
+        if record["status"] == "saved":
+            counts[record["category"]] = counts.get(record["category"], 0) + 1
+
+    result = {
+        "success": not breaker.tripped,
+        "cancelled": breaker.tripped,
+        "reason": breaker.reason,
+        "counts": counts,
+        "message": (
+            (f"Cancelled: {breaker.reason}\n" if breaker.tripped else "Portraits synced.\n") +
+            "".join(f"{category}: {count}\n" for category, count in counts.items())
+        )
+    }
+    return result
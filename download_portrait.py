@@ -1,9 +1,18 @@
 import os
-import urllib.request
+import logging
+import threading
+import configparser
+import concurrent.futures as cf
+import urllib3
+from email.utils import formatdate
+from functools import lru_cache
 from Crypto.Cipher import Blowfish
 from Crypto.Util.Padding import pad
 import sys
 from pathlib import Path
+import http_client
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 def get_base_dir():
     if getattr(sys, 'frozen', False):
@@ -23,6 +32,21 @@ ILLUST_DIR = os.path.join(BASE_DIR, "portrait_full")
 os.makedirs(ICON_DIR, exist_ok=True)
 os.makedirs(ILLUST_DIR, exist_ok=True)
 
+config = configparser.RawConfigParser()
+config.read(os.path.join(BASE_DIR, "setting.ini"))
+# 既にある画像: False ならそのまま使う / True なら If-Modified-Since で更新を確認する
+portrait_revalidate = config.getboolean('portrait', 'revalidate', fallback=False)
+# CDN の接続先 ([network] static_base で差し替え可)
+STATIC_BASE = config.get('network', 'static_base', fallback='https://static-r.kamihimeproject.net').rstrip('/')
+RESOURCE_BASE = STATIC_BASE + "/resources/pc/normal/"
+
+def set_static_base(static: str):
+    global STATIC_BASE, RESOURCE_BASE
+    STATIC_BASE = static.rstrip('/')
+    RESOURCE_BASE = STATIC_BASE + "/resources/pc/normal/"
+    build_url.cache_clear()
+    http_client.register_host(STATIC_BASE, "static")
+
 # =============================
 # タイプ別ルール（設計の核）
 # =============================
@@ -59,11 +83,14 @@ PORTRAIT_RULES = {
 # 暗号化処理（既存仕様そのまま）
 # =============================
 
+# ECB なので 1 つを使い回せる (暗号化自体はロックで直列化)
+_CIPHER = Blowfish.new(b"bLoWfIsH", Blowfish.MODE_ECB)
+_cipher_lock = threading.Lock()
+
 def kamihime_encrypt(data: str) -> str:
-    key = b"bLoWfIsH"
-    cipher = Blowfish.new(key, Blowfish.MODE_ECB)
     padded = pad(data.encode("utf-8"), 8)
-    return cipher.encrypt(padded).hex()
+    with _cipher_lock:
+        return _CIPHER.encrypt(padded).hex()
 
 def get_path(t: str, p: str) -> str:
     r = t.rfind(".")
@@ -73,6 +100,7 @@ def get_path(t: str, p: str) -> str:
     ext = ".png" if ("illust" in p or "harem" in p) else ".jpg"
     return f"{part1}/{part2}/{t}{ext}"
 
+@lru_cache(maxsize=8192)
 def build_url(type_str: str, x: str) -> str:
     if "corecard_item_" in type_str:
         data = type_str + x
@@ -83,40 +111,117 @@ def build_url(type_str: str, x: str) -> str:
 
     final = kamihime_encrypt(data)
     path = get_path(final, type_str)
-    return "https://static-r.kamihimeproject.net/resources/pc/normal/" + path
+    return RESOURCE_BASE + path
 # https://gnkh-resource-r.prod.nkh.dmmgames.com/resources/pc/normal/
 # https://gnkh-resource-r.prod.nkh.dmmgames.com/resources/pc/normal/1ef/750/8b12ce67eb09c39d5eab986c2a64547a510d683a1d1ef750.jpg
 # https://static-r.kamihimeproject.net/resources/pc/normal/75d/25c/2c93eebb4a79e124bc0f15fd6ea534d9169c384ae475d25c.jpg
 
+if STATIC_BASE != 'https://static-r.kamihimeproject.net':
+    http_client.register_host(STATIC_BASE, "static")
+
 # =============================
 # ダウンロード処理
 # =============================
 
+_PORTRAIT_SESSION = None
+
+def get_portrait_session():
+    global _PORTRAIT_SESSION
+    if _PORTRAIT_SESSION is None:
+        _PORTRAIT_SESSION = http_client.new_session({
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.113 Safari/537.36'
+        })
+    return _PORTRAIT_SESSION
+
 def download_image(url: str, save_path: str) -> bool:
+    """
+    既にあればスキップ (portrait_revalidate なら If-Modified-Since で確認し、更新されていれば取り直す)。
+    書きかけのファイルを「既にある」と見なさないよう一時ファイル経由で置き換える。
+    """
+    headers = {}
+    if os.path.exists(save_path):
+        if not portrait_revalidate:
+            return True
+        headers["If-Modified-Since"] = formatdate(os.path.getmtime(save_path), usegmt=True)
+
+    # portrait ホストのレート制限・リトライは http_client 側で行う
     try:
-        urllib.request.urlretrieve(url, save_path)
+        r = http_client.get(get_portrait_session(), url, headers=headers, verify=False, timeout=30)
+        if r.status_code == 304:
+            return True
+        if r.status_code != 200:
+            return False
+        tmp_path = save_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(r.content)
+        os.replace(tmp_path, save_path)
         return True
     except Exception:
         return False
 
-# =============================
-# 外部API（0_download_json から呼ぶ）
-# =============================
-
-def download_portrait(char_type: str, char_id: int, char_name: str):
+def fetch_portrait(char_type: str, char_id: int, char_name: str) -> bool:
     rule = PORTRAIT_RULES.get(char_type)
     if not rule:
-        return
+        return False
 
     real_id = char_id + rule["id_offset"]
 
     # --- アイコン ---
     icon_url = build_url(rule["icon"], str(real_id))
     icon_path = os.path.join(ICON_DIR, f"{char_name}.jpg")
-    download_image(icon_url, icon_path)
+    ok = download_image(icon_url, icon_path)
 
     # --- 立ち絵（必要なタイプのみ） ---
     if rule["illust"]:
         illust_url = build_url(rule["illust"], str(real_id))
         illust_path = os.path.join(ILLUST_DIR, f"{char_name}.png")
-        download_image(illust_url, illust_path)
+        ok = download_image(illust_url, illust_path) and ok
+
+    return ok
+
+# =============================
+# バックグラウンドキュー
+# =============================
+# シナリオ取得のワーカーを画像のダウンロードで待たせないよう、
+# start_queue() 中は download_portrait() をキューに積むだけにする。
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def start_queue(workers: int = None):
+    global _queue
+    if workers is None:
+        workers = http_client.worker_count('portrait')
+    with _queue_lock:
+        if _queue is None:
+            _queue = (cf.ThreadPoolExecutor(max_workers=max(1, workers)), [])
+    return _queue
+
+def finish_queue() -> int:
+    """キューに積んだ分が終わるまで待つ。return: 取得/確認できたキャラ数"""
+    global _queue
+    with _queue_lock:
+        queue = _queue
+        _queue = None
+    if queue is None:
+        return 0
+
+    executor, futures = queue
+    executor.shutdown(wait=True)
+    count = sum(1 for fut in futures if not fut.cancelled() and fut.exception() is None and fut.result())
+    logging.info("Portraits: %d / %d", count, len(futures))
+    return count
+
+# =============================
+# 外部API（0_download_json から呼ぶ）
+# =============================
+
+def download_portrait(char_type: str, char_id: int, char_name: str):
+    with _queue_lock:
+        queue = _queue
+        if queue is not None:
+            executor, futures = queue
+            futures.append(executor.submit(fetch_portrait, char_type, char_id, char_name))
+            return
+
+    fetch_portrait(char_type, char_id, char_name)
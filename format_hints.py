@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import logging
+import threading
+
+# format_hints.py
+# Harem 2.0 のシナリオは scenario.json と gameData.ksd のどちらかしか無い。
+# 前回どちらが当たったかを
+#   dir:<resource_directory の先頭>   (最優先)
+#   range:<category>:<ID // 100>     (同じ帯の ID)
+#   category:<category>               (最後の手段)
+# の単位で覚えておき、当たりそうな方から先に取りに行く。
+
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+HINTS_PATH = os.path.join(BASE_DIR, "format_hints.json")
+
+FORMATS = ("json", "ksd")
+DIR_PREFIX_LEN = 8
+
+_lock = threading.Lock()
+_hints = None
+_dirty = False
+
+
+def _load():
+    global _hints
+    if _hints is not None:
+        return _hints
+
+    _hints = {}
+    if os.path.exists(HINTS_PATH):
+        try:
+            with open(HINTS_PATH, encoding="utf-8") as f:
+                _hints = json.load(f)
+        except Exception as e:
+            logging.warning("Failed to read %s : %s", HINTS_PATH, e)
+            _hints = {}
+    return _hints
+
+
+def keys_for(category: str, item_id: int, resource_directory: str = "") -> list:
+    keys = []
+    if resource_directory:
+        keys.append(f"dir:{resource_directory[:DIR_PREFIX_LEN]}")
+    keys.append(f"range:{category}:{int(item_id) // 100}")
+    keys.append(f"category:{category}")
+    return keys
+
+
+def predict(keys: list) -> str:
+    with _lock:
+        hints = _load()
+        for key in keys:
+            fmt = hints.get(key)
+            if fmt in FORMATS:
+                return fmt
+    return "json"
+
+
+def record(keys: list, fmt: str):
+    global _dirty
+    with _lock:
+        hints = _load()
+        for key in keys:
+            if hints.get(key) != fmt:
+                hints[key] = fmt
+                _dirty = True
+
+
+def save():
+    global _dirty
+    with _lock:
+        if not _dirty or _hints is None:
+            return
+        tmp_path = HINTS_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(_hints, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, HINTS_PATH)
+        _dirty = False
@@ -0,0 +1,642 @@
+import os
+import sys
+import time
+import random
+import logging
+import threading
+import configparser
+import contextlib
+import concurrent.futures as cf
+from collections import deque, OrderedDict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+
+import run_control
+import http_replay
+
+# http_client.py
+# 全ワーカー共通の HTTP 呼び出し口
+#   - ホスト別 token bucket (requests/sec + burst)
+#   - 429/5xx/timeout の指数バックオフ + jitter リトライ (Retry-After 優先)
+#   - ホスト別 in-flight 上限 (concurrency = adaptive なら AIMD で自動調整)
+#   - 440 / エラー多発時は run_control.breaker で実行全体を止める
+#   - 全リクエストに connect/read timeout、deadline() で ID ごとの持ち時間
+#   - hedge = true なら遅い GET に複製リクエストを投げて先着を採用
+#   - response_cache を入れると api への GET を ETag / Last-Modified で条件付きにする
+#   - [network] record / replay で通信の記録・再生 (http_replay.py)
+
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+SETTING_PATH = os.path.join(BASE_DIR, "setting.ini")
+
+config = configparser.RawConfigParser()
+config.read(SETTING_PATH)
+
+# host key -> (requests/sec, burst)
+# r.kamihimeproject.net            : api
+# static-r.../scenarios/           : static
+# static-r.../resources/ (portrait): portrait
+HOST_DEFAULTS = {
+    "api": (10.0, 20),
+    "static": (20.0, 40),
+    "portrait": (10.0, 20),
+}
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+max_retries = config.getint('network', 'retries', fallback=3)
+backoff_base = config.getfloat('network', 'backoff_base', fallback=1.0)
+backoff_max = config.getfloat('network', 'backoff_max', fallback=30.0)
+retry_after_max = config.getfloat('network', 'retry_after_max', fallback=300.0)
+
+# fixed:    threads 本で固定
+# adaptive: min_threads〜max_threads の間で AIMD 調整 (初期値は threads)
+concurrency_mode = config.get('script', 'concurrency', fallback='fixed').strip().lower()
+thread_num = config.getint('script', 'threads', fallback=8)
+min_threads = config.getint('script', 'min_threads', fallback=1)
+max_threads = config.getint('script', 'max_threads', fallback=32)
+aimd_decrease = config.getfloat('script', 'aimd_decrease', fallback=0.5)
+aimd_latency_tolerance = config.getfloat('script', 'aimd_latency_tolerance', fallback=2.0)
+
+# timeout 未指定のリクエストに使う (connect, read)
+connect_timeout = config.getfloat('network', 'connect_timeout', fallback=10.0)
+read_timeout = config.getfloat('network', 'read_timeout', fallback=30.0)
+
+# hedged request: 直近レイテンシの hedge_percentile パーセンタイルを超えたら複製を送る
+hedge_enabled = config.getboolean('network', 'hedge', fallback=False)
+hedge_percentile = config.getfloat('network', 'hedge_percentile', fallback=95.0)
+hedge_min_samples = config.getint('network', 'hedge_min_samples', fallback=20)
+
+# 通信の記録先 / 再生元 (gzip JSONL)。replay_speed は記録の所要時間に掛ける倍率 (0 で待たない)
+record_path = config.get('network', 'record', fallback='')
+replay_path = config.get('network', 'replay', fallback='')
+replay_speed = config.getfloat('network', 'replay_speed', fallback=1.0)
+
+if replay_path:
+    http_replay.start_replay(os.path.join(BASE_DIR, replay_path), replay_speed)
+elif record_path:
+    http_replay.start_recording(os.path.join(BASE_DIR, record_path))
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """deadline() の持ち時間切れ。既存の Timeout 処理でそのまま扱える"""
+    pass
+
+
+class TokenBucket:
+    """
+    スレッド間で共有するトークンバケット。
+    rate <= 0 なら無制限。
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    elapsed = now - self._updated
+                    self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+                    self._updated = now
+
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Retry-After を全ワーカーで守るため、バケット自体を止める"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class AdaptiveLimit:
+    """
+    ホスト別の in-flight リクエスト数ゲート。
+    adaptive の場合、健全なレスポンスごとに +1/limit (1 RTT あたり +1)、
+    timeout/429/5xx で limit * aimd_decrease に縮める (AIMD)。
+    """
+
+    def __init__(self, name: str, initial: int, minimum: int, maximum: int, adaptive: bool):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.adaptive = adaptive
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self._in_flight = 0
+        self._ewma = None
+        self._best_ewma = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self):
+        with self._cond:
+            while self._in_flight >= int(self.limit):
+                self._cond.wait()
+            self._in_flight += 1
+
+    def try_acquire(self) -> bool:
+        """空きがあれば acquire して True / 上限なら待たずに False"""
+        with self._cond:
+            if self._in_flight >= int(self.limit):
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self, overloaded: bool, latency: float):
+        with self._cond:
+            self._in_flight -= 1
+
+            if self.adaptive:
+                before = int(self.limit)
+
+                if overloaded:
+                    self._decrease(latency)
+                else:
+                    self._observe(latency)
+
+                if int(self.limit) != before:
+                    logging.info("Concurrency %s: %d -> %d", self.name, before, int(self.limit))
+
+            self._cond.notify_all()
+
+    def _observe(self, latency: float):
+        if self._ewma is None:
+            self._ewma = latency
+        else:
+            self._ewma = 0.8 * self._ewma + 0.2 * latency
+
+        if self._best_ewma is None or self._ewma < self._best_ewma:
+            self._best_ewma = self._ewma
+
+        # レイテンシが悪化している間は増やさない
+        if self._ewma <= self._best_ewma * aimd_latency_tolerance:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def _decrease(self, latency: float):
+        # 同じ混雑で何度も半減しないよう、1 リクエスト分の時間は待つ
+        now = time.monotonic()
+        if now - self._last_decrease < max(latency, 1.0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * aimd_decrease)
+
+
+def _load_limits():
+    # ホスト別の並列数: {key}_concurrency (未指定なら threads)
+    adaptive = concurrency_mode == 'adaptive'
+    limits = {}
+    for key in HOST_DEFAULTS:
+        initial = config.getint('network', f'{key}_concurrency', fallback=thread_num)
+        maximum = max(initial, max_threads) if adaptive else initial
+        limits[key] = AdaptiveLimit(key, initial, min_threads, maximum, adaptive)
+    return limits
+
+limits = _load_limits()
+
+
+def pool_size(default: int) -> int:
+    """ThreadPoolExecutor の max_workers。adaptive なら上限まで用意し、実際の並列数はゲートで絞る"""
+    if concurrency_mode == 'adaptive':
+        return max(default, max_threads)
+    return default
+
+
+def worker_count(*keys) -> int:
+    """
+    複数ホストを順に叩くワーカー用のスレッド数。
+    各ホストの上限の合計にしておけば、どちらのホストも遊ばない。
+    """
+    return sum(limits[key].maximum for key in keys)
+
+
+def new_session(headers: dict = None):
+    """接続プールをスレッド数に合わせた Session (既定の pool_maxsize=10 では足りない)"""
+    s = requests.Session()
+    size = max(10, pool_size(thread_num), worker_count(*limits))
+    adapter = http_replay.wrap(requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size))
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    if headers:
+        s.headers.update(headers)
+    return s
+
+
+def concurrency_snapshot() -> dict:
+    return {key: (limit.current, limit.in_flight) for key, limit in limits.items()}
+
+
+def describe_concurrency() -> str:
+    return " / ".join(
+        f"{key} {current}" for key, (current, _) in concurrency_snapshot().items()
+    )
+
+
+class LatencyStats:
+    """ホスト別の直近レイテンシ (hedge の閾値計算用)"""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, p: float):
+        with self._lock:
+            if len(self._samples) < hedge_min_samples:
+                return None
+            samples = sorted(self._samples)
+
+        index = min(len(samples) - 1, int(len(samples) * p / 100.0))
+        return samples[index]
+
+latency_stats = {key: LatencyStats() for key in HOST_DEFAULTS}
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+def _get_hedge_pool():
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            # 1 本目も複製もホスト別のゲートを通るので、各ホストの上限の合計 x 2 で足りる
+            _hedge_pool = cf.ThreadPoolExecutor(max_workers=2 * worker_count(*limits))
+        return _hedge_pool
+
+
+# -----------------------------
+# deadline (thread local)
+# -----------------------------
+_local = threading.local()
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """
+    with deadline(300): ...
+    ブロック内の全リクエストの合計時間を seconds 以内に収める。
+    入れ子の場合は短い方が有効。seconds <= 0 なら無制限。
+    """
+    previous = getattr(_local, 'deadline', None)
+
+    if seconds and seconds > 0:
+        expires = time.monotonic() + seconds
+        if previous is not None:
+            expires = min(expires, previous)
+        _local.deadline = expires
+
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def remaining_time():
+    expires = getattr(_local, 'deadline', None)
+    if expires is None:
+        return None
+    return expires - time.monotonic()
+
+
+def _apply_timeout(kwargs: dict, url: str) -> dict:
+    timeout = kwargs.get('timeout')
+
+    if timeout is None:
+        connect, read = connect_timeout, read_timeout
+    elif isinstance(timeout, tuple):
+        connect, read = timeout
+    else:
+        connect, read = min(connect_timeout, timeout), timeout
+
+    remaining = remaining_time()
+    if remaining is not None:
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline exceeded before request: {url}")
+        connect = min(connect, remaining)
+        read = min(read, remaining)
+
+    kwargs = dict(kwargs)
+    kwargs['timeout'] = (connect, read)
+    return kwargs
+
+
+def _discard(fut):
+    if fut.cancelled() or fut.exception() is not None:
+        return
+    fut.result().close()
+
+
+def _overloaded(fut) -> bool:
+    """AdaptiveLimit.release に渡す混雑判定 (request() と同じ基準)"""
+    if fut.cancelled():
+        return False
+    exc = fut.exception()
+    if exc is not None:
+        return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+    return fut.result().status_code in RETRY_STATUS
+
+
+def _send(s, method: str, url: str, key: str, kwargs: dict):
+    """
+    1回分の送信。冪等な GET はレイテンシが閾値を超えたら複製を送り、先に成功した方を返す。
+    return: (response, handed_off)
+      handed_off: 複製が勝って 1 本目がまだ送信中。1 本目のゲートの枠は終わったときに
+      (future の callback で) 返すので、呼び出し側は release しない
+    """
+    hedgeable = (
+        hedge_enabled
+        and method.upper() == 'GET'
+        and not kwargs.get('stream')
+    )
+    threshold = latency_stats[key].percentile(hedge_percentile) if hedgeable else None
+
+    if threshold is None:
+        return s.request(method, url, **kwargs), False
+
+    breaker = run_control.breaker
+    pool = _get_hedge_pool()
+    sent = time.monotonic()
+    primary = pool.submit(s.request, method, url, **kwargs)
+    # 中止されたらプールで待っている分をキャンセルする (複製も後から append する)
+    candidates = [primary]
+    breaker.track(candidates)
+
+    try:
+        try:
+            return primary.result(timeout=threshold), False
+        except cf.TimeoutError:
+            pass
+        except cf.CancelledError:
+            breaker.check()
+            raise
+
+        # 複製も 1 本としてホスト別のゲートを通す。上限まで使っているなら複製は送らない
+        limit = limits[key]
+        if breaker.tripped or not limit.try_acquire():
+            return primary.result(), False
+
+        buckets[key].acquire()
+        logging.info("Hedging slow request (> %.2fs): %s", threshold, url)
+        started = time.monotonic()
+        secondary = pool.submit(s.request, method, url, **kwargs)
+        secondary.add_done_callback(
+            lambda fut: limit.release(_overloaded(fut), time.monotonic() - started))
+        candidates.append(secondary)
+
+        winner = None
+        for fut in cf.as_completed(candidates):
+            if not fut.cancelled() and fut.exception() is None:
+                winner = fut
+                break
+
+        if winner is None:
+            breaker.check()
+            raise primary.exception()
+
+        for fut in candidates:
+            if fut is not winner:
+                fut.add_done_callback(_discard)
+
+        if winner is primary:
+            return winner.result(), False
+        # 1 本目はまだ送信中なので、枠は 1 本目が終わったときに返す
+        primary.add_done_callback(
+            lambda fut: limit.release(_overloaded(fut), time.monotonic() - sent))
+        return winner.result(), True
+    finally:
+        breaker.untrack(candidates)
+
+
+def _load_buckets():
+    buckets = {}
+    for key, (rate, burst) in HOST_DEFAULTS.items():
+        buckets[key] = TokenBucket(
+            config.getfloat('network', f'{key}_rate', fallback=rate),
+            config.getint('network', f'{key}_burst', fallback=burst)
+        )
+    return buckets
+
+buckets = _load_buckets()
+
+
+# netloc -> "api" / "static" (接続先を差し替えたとき用。register_host で登録)
+host_overrides = {}
+
+
+def register_host(base: str, key: str):
+    """base (例: http://127.0.0.1:8082) への通信を key のホストとして扱う"""
+    host_overrides[urlsplit(base).netloc.lower()] = key
+
+
+def host_key(url: str) -> str:
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    override = host_overrides.get(host)
+    if override == "api":
+        return "api"
+
+    if override == "static" or host.startswith('static') or 'resource' in host:
+        if parts.path.startswith('/resources/'):
+            return "portrait"
+        return "static"
+
+    return "api"
+
+
+def backoff_delay(attempt: int) -> float:
+    # full jitter
+    return random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+
+def parse_retry_after(r) -> float:
+    value = r.headers.get('Retry-After')
+    if not value:
+        return 0.0
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return 0.0
+
+    return min(max(seconds, 0.0), retry_after_max)
+
+
+def request(s, method: str, url: str, **kwargs):
+    """
+    s.request() のラッパー。
+    レート制限を通してから送信し、429/5xx/timeout/接続エラーはリトライする。
+    リトライし尽くした場合は最後のレスポンスを返すか、最後の例外を送出する。
+    440 を受けた場合、または実行が中止済みの場合は RunCancelled を送出する。
+    """
+    breaker = run_control.breaker
+    key = host_key(url)
+    bucket = buckets[key]
+    limit = limits[key]
+    attempt = 0
+
+    while True:
+        breaker.check()
+        send_kwargs = _apply_timeout(kwargs, url)
+        bucket.acquire()
+        limit.acquire()
+        started = time.monotonic()
+
+        try:
+            r, handed_off = _send(s, method, url, key, send_kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            limit.release(True, time.monotonic() - started)
+            if attempt >= max_retries:
+                breaker.record(True)
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning("%s: %s (retry %d/%d in %.1fs)",
+                            url, e, attempt + 1, max_retries, delay)
+        except Exception:
+            limit.release(False, time.monotonic() - started)
+            breaker.record(True)
+            raise
+        else:
+            elapsed = time.monotonic() - started
+            if not handed_off:
+                limit.release(r.status_code in RETRY_STATUS, elapsed)
+            if r.status_code < 500:
+                latency_stats[key].add(elapsed)
+
+            if r.status_code == 440:
+                r.close()
+                run_control.session_expired()
+
+            if r.status_code not in RETRY_STATUS or attempt >= max_retries:
+                breaker.record(r.status_code in RETRY_STATUS)
+                return r
+
+            retry_after = parse_retry_after(r)
+            delay = max(backoff_delay(attempt), retry_after)
+            if retry_after:
+                bucket.pause(retry_after)
+            r.close()
+            logging.warning("%s (%s) (retry %d/%d in %.1fs)",
+                            url, r.status_code, attempt + 1, max_retries, delay)
+
+        remaining = remaining_time()
+        if remaining is not None and remaining <= delay:
+            raise DeadlineExceeded(f"Deadline exceeded while retrying: {url}")
+
+        attempt += 1
+        breaker.sleep(delay)
+
+
+class HttpCache:
+    """
+    api の GET 応答を URL ごとに覚えておき、次からは If-None-Match /
+    If-Modified-Since を付けて送る。304 なら覚えておいた本文を返す。
+    ETag も Last-Modified も無い応答は覚えない。max_entries を超えたら古い順に捨てる。
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def validators(self, url: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return {}
+            self._entries.move_to_end(url)
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url: str, r):
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        with self._lock:
+            self._entries[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "headers": dict(r.headers),
+                "content": r.content,
+                "encoding": r.encoding,
+            }
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def replay(self, url: str, r):
+        """304 を覚えておいた 200 に差し替える"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return r
+            self.hits += 1
+        cached = requests.models.Response()
+        cached.status_code = 200
+        cached.url = url
+        cached.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        cached._content = entry["content"]
+        cached.encoding = entry["encoding"]
+        cached.request = r.request
+        return cached
+
+
+response_cache = None  # HttpCache (watch.py が常駐中に使う)
+
+
+def get(s, url: str, **kwargs):
+    cache = response_cache
+    if cache is None or kwargs.get('stream') or host_key(url) != 'api':
+        return request(s, 'GET', url, **kwargs)
+
+    validators = cache.validators(url)
+    if validators:
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **validators)
+
+    r = request(s, 'GET', url, **kwargs)
+    if r.status_code == 304 and validators:
+        return cache.replay(url, r)
+    if r.status_code == 200:
+        cache.store(url, r)
+    return r
@@ -0,0 +1,279 @@
+import io
+import gzip
+import json
+import time
+import base64
+import atexit
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+
+# http_replay.py
+# 通信の記録と再生 (requests のトランスポートアダプタとして http_client.new_session に挟む)。
+#   record: 実際の通信をそのまま行い、リクエスト/レスポンスと所要時間を
+#           gzip 圧縮の JSONL (traffic.jsonl.gz など) に追記する
+#   replay: 記録から応答を返す (サーバーには繋がない)。所要時間は記録どおり、
+#           または speed 倍 (0 なら待たない)
+# x-kh-session / Cookie は記録しない。同じ本文は 1 回だけ保存する (sha1 で参照)。
+# 同じ URL の記録が複数あれば (リトライで 503 → 200 など) 記録順に返し、
+# 使い切ったら最後のものを返し続ける。記録に無い URL は 404 + X-Replay-Miss。
+# 照合はパス + クエリで行う (api と CDN でパスは重ならないので、接続先を
+# 差し替えて記録したもの (mock_server.py 等) も本番の URL で再生できる)。
+#
+# new_session() で作る Session だけが対象なので、start_* は最初の Session を
+# 作る前に呼ぶこと (setting.ini の [network] record / replay なら自動)。
+
+REDACT_HEADERS = {"x-kh-session", "cookie", "authorization"}
+DROP_RESPONSE_HEADERS = {"set-cookie"}
+
+_lock = threading.Lock()
+recorder = None
+replayer = None
+
+
+def _match_key(method: str, url: str):
+    parts = urlsplit(url)
+    return method, parts.path + ("?" + parts.query if parts.query else "")
+
+
+def _redact(headers) -> dict:
+    return {
+        k: ("REDACTED" if k.lower() in REDACT_HEADERS else v)
+        for k, v in headers.items()
+    }
+
+
+class Recorder:
+
+    def __init__(self, path: str, flush_every: int = 50):
+        self.path = path
+        self.flush_every = flush_every
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._blobs = set()
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._pending = 0
+        self.count = 0
+
+    def _write(self, rec: dict):
+        self._file.write(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def add(self, request, response=None, error=None, started=0.0, elapsed=0.0):
+        rec = {
+            "t": round(started - self._started, 4),
+            "method": request.method,
+            "url": request.url,
+            "request_headers": _redact(request.headers),
+            "elapsed": round(elapsed, 4),
+        }
+        blob = None
+        if response is not None:
+            body = response.content or b""
+            blob = hashlib.sha1(body).hexdigest()
+            rec.update({
+                "status": response.status_code,
+                "reason": response.reason,
+                "headers": {
+                    k: v for k, v in response.headers.items()
+                    if k.lower() not in DROP_RESPONSE_HEADERS
+                },
+                "ttfb": round(response.elapsed.total_seconds(), 4),
+                "body": blob,
+            })
+        else:
+            rec["error"] = type(error).__name__
+            rec["message"] = str(error)
+
+        with self._lock:
+            if blob is not None and blob not in self._blobs:
+                self._blobs.add(blob)
+                self._write({"blob": blob, "data": base64.b64encode(body).decode("ascii")})
+            self._write(rec)
+            self.count += 1
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._file.flush()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class RecordingAdapter(requests.adapters.BaseAdapter):
+
+    def __init__(self, inner, recorder: Recorder):
+        super().__init__()
+        self.inner = inner
+        self.recorder = recorder
+
+    def send(self, request, **kwargs):
+        started = time.time()
+        t0 = time.monotonic()
+        try:
+            r = self.inner.send(request, **kwargs)
+            # 本文まで読んだ時間を記録する (stream でもここで読み切る)
+            r.content
+        except requests.exceptions.RequestException as e:
+            self.recorder.add(request, error=e, started=started, elapsed=time.monotonic() - t0)
+            raise
+        self.recorder.add(request, response=r, started=started, elapsed=time.monotonic() - t0)
+        return r
+
+    def close(self):
+        self.inner.close()
+
+
+# 記録の error 名 -> 再生で投げる例外
+REPLAY_ERRORS = {
+    "ConnectTimeout": requests.exceptions.ConnectTimeout,
+    "ReadTimeout": requests.exceptions.ReadTimeout,
+    "Timeout": requests.exceptions.Timeout,
+    "SSLError": requests.exceptions.SSLError,
+    "ConnectionError": requests.exceptions.ConnectionError,
+    "ChunkedEncodingError": requests.exceptions.ChunkedEncodingError,
+}
+
+
+class Replayer:
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.path = path
+        self.speed = speed
+        self._entries = {}   # (method, path?query) -> [rec, ...]
+        self._cursor = {}
+        self._blobs = {}
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.served = 0
+        self.misses = 0
+        self._load(path)
+
+    def _load(self, path: str):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # 記録中に落ちた最終行
+                        continue
+                    if "blob" in rec:
+                        self._blobs[rec["blob"]] = base64.b64decode(rec["data"])
+                        continue
+                    self._entries.setdefault(_match_key(rec["method"], rec["url"]), []).append(rec)
+                    self.responses += 1
+            except EOFError:
+                # gzip の末尾が書ききれていない (記録中に落ちた)
+                pass
+        logging.info("Replay: %d responses for %d URLs from %s", self.responses, len(self._entries), path)
+
+    def next(self, method: str, url: str):
+        key = _match_key(method, url)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                return None
+            i = self._cursor.get(key, 0)
+            self._cursor[key] = min(i + 1, len(entries) - 1)
+            self.served += 1
+            return entries[i]
+
+    def body(self, blob: str) -> bytes:
+        return self._blobs.get(blob, b"")
+
+    def rewind(self):
+        with self._lock:
+            self._cursor.clear()
+            self.served = 0
+            self.misses = 0
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+
+    def __init__(self, replayer: Replayer):
+        super().__init__()
+        self.replayer = replayer
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        rec = self.replayer.next(request.method, request.url)
+        if rec is None:
+            logging.warning("Replay: no recording for %s %s", request.method, request.url)
+            return self._response(request, 404, "Not Found", {"X-Replay-Miss": "1"}, b"", 0.0)
+
+        if self.replayer.speed > 0 and rec["elapsed"] > 0:
+            time.sleep(rec["elapsed"] * self.replayer.speed)
+
+        if "error" in rec:
+            exc = REPLAY_ERRORS.get(rec["error"], requests.exceptions.ConnectionError)
+            raise exc(rec.get("message", rec["error"]), request=request)
+
+        return self._response(
+            request, rec["status"], rec.get("reason", ""), rec.get("headers", {}),
+            self.replayer.body(rec.get("body")), rec.get("ttfb", 0.0) * self.replayer.speed
+        )
+
+    def _response(self, request, status, reason, headers, body, ttfb):
+        r = requests.models.Response()
+        r.status_code = status
+        r.reason = reason
+        r.url = request.url
+        r.request = request
+        r.headers = requests.structures.CaseInsensitiveDict(headers)
+        # 記録は復号済みの本文なので、圧縮ヘッダは外す
+        r.headers.pop("Content-Encoding", None)
+        r.headers["Content-Length"] = str(len(body))
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.raw = io.BytesIO(body)
+        r._content = body
+        r._content_consumed = True
+        r.elapsed = timedelta(seconds=ttfb)
+        r.connection = self
+        return r
+
+    def close(self):
+        pass
+
+
+def start_recording(path: str) -> Recorder:
+    global recorder
+    with _lock:
+        if recorder is not None:
+            recorder.close()
+        recorder = Recorder(path)
+    logging.info("Recording HTTP traffic to %s", path)
+    return recorder
+
+
+def start_replay(path: str, speed: float = 1.0) -> Replayer:
+    global replayer
+    with _lock:
+        replayer = Replayer(path, speed)
+    return replayer
+
+
+def stop():
+    global recorder, replayer
+    with _lock:
+        if recorder is not None:
+            recorder.close()
+            logging.info("Recorded %d requests to %s", recorder.count, recorder.path)
+        recorder = None
+        replayer = None
+
+atexit.register(stop)
+
+
+def wrap(adapter):
+    """new_session 用: 再生中なら ReplayAdapter、記録中なら RecordingAdapter で包む"""
+    if replayer is not None:
+        return ReplayAdapter(replayer)
+    if recorder is not None:
+        return RecordingAdapter(adapter, recorder)
+    return adapter
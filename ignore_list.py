@@ -0,0 +1,121 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# ignore_list.py
+# CDN に無かったアセット (404) の一覧。ignore.jsonl に 1 件 1 行で追記する。
+#   {"link", "status", "first_seen", "checked"}   追加・再確認
+#   {"link", "removed": true, "checked"}          再確認で公開されていた
+# 同じ link は後の行が優先。読み込み後はメモリ上の dict で引くので件数によらず O(1)。
+# 古い ignore.txt (1 行 1 URL) は ignore.jsonl が無いときに一度だけ取り込む。
+
+class IgnoreList:
+
+    def __init__(self, path: str, legacy_path: str = None):
+        self.path = path
+        self._entries = {}
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+        if os.path.exists(path):
+            self._load()
+        elif legacy_path and os.path.exists(legacy_path):
+            self._import_legacy(legacy_path)
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた最終行
+                    continue
+                self._lines += 1
+                if rec.get("removed"):
+                    self._entries.pop(rec["link"], None)
+                else:
+                    self._entries[rec["link"]] = rec
+
+    def _import_legacy(self, legacy_path: str):
+        first_seen = os.path.getmtime(legacy_path)
+        with open(legacy_path, encoding="utf-8") as f:
+            for link in f.read().splitlines():
+                link = link.strip()
+                if link:
+                    self._entries[link] = {
+                        "link": link, "status": 404,
+                        "first_seen": first_seen, "checked": first_seen
+                    }
+        self.compact()
+        logging.info("Imported %d links from %s", len(self._entries), legacy_path)
+
+    def _append(self, rec: dict):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        # 1 行を 1 回の write で書く (分担モードの他プロセスの行と混ざらないように)
+        self._file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._lines += 1
+
+    def __contains__(self, link: str) -> bool:
+        return link in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, link: str, status=404):
+        now = time.time()
+        with self._lock:
+            prev = self._entries.get(link)
+            rec = {
+                "link": link,
+                "status": status,
+                "first_seen": prev["first_seen"] if prev else now,
+                "checked": now,
+            }
+            self._entries[link] = rec
+            try:
+                self._append(rec)
+            except OSError as e:
+                logging.error("Failed to write %s : %s", self.path, e)
+
+    def remove(self, link: str):
+        with self._lock:
+            if self._entries.pop(link, None) is None:
+                return
+            try:
+                self._append({"link": link, "removed": True, "checked": time.time()})
+            except OSError as e:
+                logging.error("Failed to write %s : %s", self.path, e)
+
+    def expired(self, ttl: float) -> list:
+        """最後の確認から ttl 秒以上たった link (古い順)"""
+        limit = time.time() - ttl
+        with self._lock:
+            entries = [rec for rec in self._entries.values() if rec["checked"] <= limit]
+        return [rec["link"] for rec in sorted(entries, key=lambda rec: rec["checked"])]
+
+    def compact(self):
+        """有効な行だけで書き直す (再確認・削除の行が溜まったとき)"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                # 他のプロセス (分担モード) が追記した行も拾ってから書き直す
+                self._entries = {}
+                self._lines = 0
+                self._load()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for rec in self._entries.values():
+                    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+            self._lines = len(self._entries)
+
+    def maybe_compact(self):
+        if self._lines > 2 * len(self._entries) + 100:
+            self.compact()
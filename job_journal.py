@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+
+# job_journal.py
+# 追記専用のジョブジャーナル (journal.jsonl)。
+# JSON / アセット / KSD の各段階の作業単位 (unit) について
+#   planned  : 後続段階でやるべき作業として登録
+#   started  : 着手
+#   committed: 完了 (フォルダの確定、KSD 展開完了、アセット取得完了)
+#   aborted  : 途中でやめた (一時フォルダは消してある。次回は普通に最初から)
+# を 1 行ずつ追記する。途中で落ちても、次回起動時に committed になっていない
+# 単位だけをやり直せる。
+#   stage "json" : unit = キャラ/エピソードフォルダ (確定後のパス)
+#   stage "ksd"  : unit = *_script.ksd のパス
+#   stage "asset": unit = *_script.json / *_script.ks のパス
+
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+JOURNAL_PATH = os.path.join(BASE_DIR, "journal.jsonl")
+
+PLANNED = "planned"
+STARTED = "started"
+COMMITTED = "committed"
+ABORTED = "aborted"
+# これ以上やることがない event
+FINISHED = (COMMITTED, ABORTED)
+
+_lock = threading.Lock()
+_state = None   # (stage, unit) -> 最新の記録
+_file = None
+
+
+def set_path(path: str):
+    """ジャーナルファイルを切り替える (分担モードではワーカーごとに別ファイル)"""
+    global JOURNAL_PATH, _state, _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+        JOURNAL_PATH = path
+        _state = None
+        _file = None
+
+
+def unit_key(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _load():
+    global _state
+    if _state is not None:
+        return _state
+
+    _state = {}
+    if not os.path.exists(JOURNAL_PATH):
+        return _state
+
+    with open(JOURNAL_PATH, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # 書き込み途中で落ちた最終行
+                continue
+            key = (rec.get("stage"), rec.get("unit"))
+            prev = _state.get(key)
+            if prev is not None and not rec.get("data"):
+                rec["data"] = prev.get("data", {})
+            _state[key] = rec
+    return _state
+
+
+def _append(rec: dict):
+    global _file
+    if _file is None:
+        _file = open(JOURNAL_PATH, "a", encoding="utf-8")
+    _file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    _file.flush()
+    # fsync は committed のときだけ (それより前の planned / started の行もまとめてディスクに載る)。
+    # 落ちて消えるのは最後の committed より後の行だけで、それらはやり直せば済む
+    if rec["event"] == COMMITTED:
+        os.fsync(_file.fileno())
+
+
+def _event(stage: str, unit: str, event: str, data: dict):
+    unit = unit_key(unit)
+    rec = {"time": time.time(), "stage": stage, "unit": unit, "event": event}
+    if data:
+        rec["data"] = data
+
+    with _lock:
+        state = _load()
+        try:
+            _append(rec)
+        except OSError as e:
+            logging.error("Failed to write %s : %s", JOURNAL_PATH, e)
+        prev = state.get((stage, unit))
+        if prev is not None and not data:
+            rec = dict(rec, data=prev.get("data", {}))
+        state[(stage, unit)] = rec
+
+
+def plan(stage: str, unit: str, **data):
+    _event(stage, unit, PLANNED, data)
+
+
+def start(stage: str, unit: str, **data):
+    _event(stage, unit, STARTED, data)
+
+
+def commit(stage: str, unit: str, **data):
+    _event(stage, unit, COMMITTED, data)
+
+
+def abort(stage: str, unit: str, **data):
+    _event(stage, unit, ABORTED, data)
+
+
+def status(stage: str, unit: str):
+    """最後の event 名 (記録が無ければ None)"""
+    with _lock:
+        rec = _load().get((stage, unit_key(unit)))
+    return rec["event"] if rec else None
+
+
+def is_pending(stage: str, unit: str) -> bool:
+    return status(stage, unit) in (PLANNED, STARTED)
+
+
+def pending(stage: str) -> list:
+    """committed / aborted になっていない単位の記録 (unit, event, data) の一覧"""
+    with _lock:
+        return [
+            rec for (st, _), rec in _load().items()
+            if st == stage and rec["event"] not in FINISHED
+        ]
+
+
+def compact():
+    """committed / aborted 済みの行を落として書き直す (未完了分だけ残す)"""
+    global _file
+    with _lock:
+        state = _load()
+        keep = [rec for rec in state.values() if rec["event"] not in FINISHED]
+
+        if _file is not None:
+            _file.close()
+            _file = None
+
+        tmp_path = JOURNAL_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for rec in keep:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, JOURNAL_PATH)
+
+        _state.clear()
+        for rec in keep:
+            _state[(rec["stage"], rec["unit"])] = rec
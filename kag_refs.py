@@ -0,0 +1,82 @@
+import re
+from collections import namedtuple
+
+# kag_refs.py
+# シナリオスクリプトから素材の参照を取り出す。
+#   ks_refs     : .ks (KAG の [tag attr="..."] / @tag attr=...) を 1 回の走査でトークン化
+#   hscene_refs : Harem の scenario.json (bgm / film / talk.voice)
+# どちらも AssetRef(kind, name) の重複なしリスト (出てきた順) を返す。
+# kind -> URL の組み立ては download_assets_core 側。
+
+AssetRef = namedtuple("AssetRef", "kind name")
+
+# .ks のタグ名 -> kind
+KS_TAG_KINDS = {
+    "chara_face": "fgimage",
+    "playbgm": "bgm",
+    "bg": "bg",
+    "playse": "se",
+}
+
+# [tag ...] (属性値の "..." 内の ] は区切りにしない) と、行頭の @tag ...。
+# タグは 1 行に収まる前提 (閉じていないタグで次の行以降まで読みに行かない)
+_TAG = re.compile(r'\[(\w+)((?:[^\]"\'\r\n]|"[^"\r\n]*"|\'[^\'\r\n]*\')*)\]|^[ \t]*@(\w+)([^\r\n]*)', re.M)
+_ATTR = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s\]]+))')
+
+
+def tokenize(text: str):
+    """yield: (タグ名, {属性名: 値})"""
+    for m in _TAG.finditer(text):
+        if m.group(1) is not None:
+            name, body = m.group(1), m.group(2)
+        else:
+            name, body = m.group(3), m.group(4)
+        attrs = {}
+        for a in _ATTR.finditer(body):
+            value = a.group(2)
+            if value is None:
+                value = a.group(3) if a.group(3) is not None else a.group(4)
+            attrs[a.group(1)] = value
+        yield name, attrs
+
+
+def unique_refs(refs) -> list:
+    seen = set()
+    result = []
+    for ref in refs:
+        if ref.name and ref not in seen:
+            seen.add(ref)
+            result.append(ref)
+    return result
+
+
+def ks_refs(text: str) -> list:
+    def walk():
+        for name, attrs in tokenize(text):
+            kind = KS_TAG_KINDS.get(name)
+            if kind and attrs.get("storage"):
+                yield AssetRef(kind, attrs["storage"].strip())
+    return unique_refs(walk())
+
+
+def hscene_refs(script: dict) -> list:
+    def walk():
+        for section in script.get("scenario", []):
+            if not isinstance(section, dict):
+                continue
+            # `bgm` の処理
+            if isinstance(section.get("bgm"), str):
+                yield AssetRef("bgm", section["bgm"])
+
+            # `film` の処理（新形式はリスト、旧形式は文字列。.jpg のみ）
+            film = section.get("film")
+            films = film if isinstance(film, list) else [film]
+            for f in films:
+                if isinstance(f, str) and f.endswith(".jpg"):
+                    yield AssetRef("film", f)
+
+            # `talk` の処理（ボイスファイル）
+            for part in section.get("talk") or []:
+                if isinstance(part, dict) and isinstance(part.get("voice"), str):
+                    yield AssetRef("voice", part["voice"])
+    return unique_refs(walk())
@@ -1,4 +1,5 @@
 import gzip
+import hashlib
 import json
 import logging
 import os
@@ -6,6 +7,9 @@ import struct
 import shutil
 import subprocess
 import sys
+import threading
+import concurrent.futures as cf
+import blob_store
 
 KEY = bytes([
     0,1,17,33,0,1,17,33,16,2,18,161,0,1,17,33,
@@ -15,10 +19,12 @@ KEY = bytes([
 ])
 
 # process_root()
+# start_pool() / submit_ksd() / finish_pool()
 # process_ksd()
 # get_resource_directory()
 # decrypt_ksd()
 # extract_assets()
+# store_transcoded()
 # rename_scenario_json()
 # cleanup_files()
 # convert_ktx2()
@@ -92,6 +98,149 @@ def process_root(
         count
     )
 
+class KsdPool:
+    """
+    ダウンロード済みの .ksd を受け取り次第処理するワーカープール。
+    ダウンロードと復号・展開を並行させ、process_root の全走査を不要にする。
+    """
+
+    def __init__(
+        self,
+        assets_root: str,
+        workers: int
+    ):
+        self.assets_root = assets_root
+        self._executor = cf.ThreadPoolExecutor(
+            max_workers=max(1, workers)
+        )
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        ksd_path: str,
+        on_done=None
+    ):
+        fut = self._executor.submit(
+            self._process,
+            ksd_path,
+            on_done
+        )
+
+        with self._lock:
+            self._futures.append(fut)
+
+        return fut
+
+    def _process(
+        self,
+        ksd_path: str,
+        on_done=None
+    ) -> bool:
+
+        ok = _process_one(
+            ksd_path,
+            self.assets_root
+        )
+
+        if on_done is not None:
+            on_done(ksd_path, ok)
+
+        return ok
+
+    def wait(self) -> int:
+
+        self._executor.shutdown(wait=True)
+
+        with self._lock:
+            futures = list(self._futures)
+
+        return sum(
+            1 for fut in futures
+            if not fut.cancelled() and fut.result()
+        )
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def start_pool(
+    assets_root: str,
+    workers: int = 2
+):
+    global _pool
+
+    with _pool_lock:
+        _pool = KsdPool(
+            assets_root,
+            workers
+        )
+
+    return _pool
+
+def _process_one(
+    ksd_path: str,
+    assets_root: str
+) -> bool:
+
+    try:
+        process_ksd(
+            ksd_path,
+            assets_root
+        )
+        return True
+
+    except Exception:
+
+        logging.exception(
+            "Failed to process %s",
+            ksd_path
+        )
+        return False
+
+def submit_ksd(
+    ksd_path: str,
+    assets_root: str,
+    on_done=None
+):
+    """
+    プールが動いていればキューに積む。
+    無ければその場で処理する。
+    on_done(ksd_path, ok) は処理後に (ワーカースレッドから) 呼ばれる。
+    """
+
+    with _pool_lock:
+        pool = _pool
+
+    if pool is not None:
+        return pool.submit(ksd_path, on_done)
+
+    ok = _process_one(
+        ksd_path,
+        assets_root
+    )
+
+    if on_done is not None:
+        on_done(ksd_path, ok)
+
+def finish_pool() -> int:
+    global _pool
+
+    with _pool_lock:
+        pool = _pool
+        _pool = None
+
+    if pool is None:
+        return 0
+
+    count = pool.wait()
+
+    logging.info(
+        "Processed %d KSD files",
+        count
+    )
+
+    return count
+
 def process_ksd(
     ksd_path: str,
     assets_root: str
@@ -125,14 +274,26 @@ def process_ksd(
         )
     )
 
-    transcode_files, ogg_files = extract_assets(
+    store = blob_store.get_store(
+        assets_root
+    )
+
+    transcode_files, ogg_files, raw_sha1 = extract_assets(
         game_json_path,
         game_bin_path,
-        output_dir
+        output_dir,
+        store
     )
 
-    convert_ktx2(transcode_files)
-    fix_ogg_files(ogg_files)
+    converted = convert_ktx2(transcode_files)
+    fixed = fix_ogg_files(ogg_files)
+
+    if store is not None:
+        store_transcoded(
+            store,
+            raw_sha1,
+            set(converted) | set(fixed)
+        )
 
     rename_scenario_json(
         game_json_path,
@@ -236,10 +397,17 @@ def decrypt_ksd(
 def extract_assets(
     game_json_path: str,
     game_bin_path: str,
-    output_dir: str
+    output_dir: str,
+    store=None
 ):
+    """
+    store (blob_store.BlobStore) を渡すと、同じ中身 (変換が要るものは変換後の中身) が
+    既にあるファイルは書き出さずにリンクし、変換もしない。
+    return: (変換する .png, 直す .ogg, 変換するファイル -> 変換前の sha1)
+    """
     transcode_files = []
     ogg_files = []
+    raw_sha1 = {}
 
     logging.info(
         "Extracting assets from %s",
@@ -279,11 +447,50 @@ def extract_assets(
             exist_ok=True
         )
 
+        transcode = (
+            asset.get("needTranscoding")
+            or out_path.lower().endswith(".ogg")
+        )
+
+        if store is not None:
+
+            sha1 = hashlib.sha1(data).hexdigest()
+
+            final = (
+                store.lookup("sha1:" + sha1)
+                if transcode
+                else sha1
+            )
+
+            if final is not None and store.place(
+                final,
+                out_path
+            ):
+                return
+
+            if transcode:
+                raw_sha1[out_path] = sha1
+
+        # 既存のファイルは他のフォルダとリンクしていることがあるので、
+        # その場で書き換えずに別名に書いてから置き換える
+        tmp_path = out_path + ".part"
+
         with open(
-            out_path,
+            tmp_path,
             "wb"
         ) as f:
             f.write(data)
+
+        os.replace(
+            tmp_path,
+            out_path
+        )
+
+        if store is not None and not transcode:
+            store.ingest(
+                out_path,
+                sha1
+            )
         
         if asset.get("needTranscoding"):
             transcode_files.append(out_path)
@@ -305,14 +512,49 @@ def extract_assets(
             output_dir
         )
 
-    return transcode_files, ogg_files
+    return transcode_files, ogg_files, raw_sha1
+
+def store_transcoded(
+    store,
+    raw_sha1,
+    done
+):
+    """
+    変換し終えたファイルを blob store に入れ、変換前の sha1 -> 変換後の中身 を記録する。
+    変換できなかったもの (ktx.exe / ffmpeg.exe が無い等) は中身だけ入れる。
+    """
+
+    for path, sha1 in raw_sha1.items():
+
+        if not os.path.exists(path):
+            continue
+
+        try:
+            store.ingest(
+                path,
+                key=(
+                    "sha1:" + sha1
+                    if path in done
+                    else None
+                )
+            )
+
+        except OSError:
+
+            logging.exception(
+                "Failed to store %s",
+                path
+            )
 
 def convert_ktx2(
     transcode_files
 ):
+    """return: 変換できた .png のリスト"""
+
+    converted = []
 
     if not transcode_files:
-        return
+        return converted
 
     if not os.path.exists(KTX_EXE):
 
@@ -321,7 +563,7 @@ def convert_ktx2(
             KTX_EXE
         )
 
-        return
+        return converted
 
     logging.info(
         "Converting %d KTX2 textures",
@@ -364,6 +606,8 @@ def convert_ktx2(
                     ktx2_path
                 )
 
+            converted.append(png_path)
+
             logging.info(
                 "Converted: %s",
                 os.path.basename(
@@ -379,10 +623,15 @@ def convert_ktx2(
                 png_path
             )
 
+    return converted
+
 def fix_ogg_files(ogg_files):
+    """return: 直せた .ogg のリスト"""
+
+    fixed = []
 
     if not ogg_files:
-        return
+        return fixed
     
     if not os.path.exists(
         FFMPEG_EXE
@@ -393,7 +642,7 @@ def fix_ogg_files(ogg_files):
             FFMPEG_EXE
         )
 
-        return
+        return fixed
 
     logging.info(
         "Fixing %d ogg files",
@@ -435,6 +684,8 @@ def fix_ogg_files(ogg_files):
                     ogg_path
                 )
 
+                fixed.append(ogg_path)
+
             logging.info(
                 "Fixed: %s",
                 os.path.basename(
@@ -449,6 +700,8 @@ def fix_ogg_files(ogg_files):
                 ogg_path
             )
 
+    return fixed
+
 def rename_scenario_json(
     game_json_path,
     ksd_path
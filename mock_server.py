@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+# mock_server.py
+# 本番に繋がずに JSON 段階を試す・測るためのローカルの API / CDN もどき。
+#   api    : /v1/characters, /v1/summons, /v1/gacha/harem_episodes/..., /v1/episodes, /v1/scenarios
+#   static : /scenarios/... (シナリオ本体), /resources/... (ポートレート)
+# 応答は fixtures (キャラ・エピソード・シーン・静的ファイル) から返す。
+# fixtures は synthetic_fixtures() で ID 一覧から作るか、JSON ファイルから読む。
+# latency / error_rate (503) / expire_after (440) で本番の癖を再現できる。
+#
+#   python mock_server.py --latest latest.txt --api-port 8081 --static-port 8082 --latency 0.05
+#   setting.ini の [network] に api_base = http://127.0.0.1:8081 / static_base = http://127.0.0.1:8082
+
+ADV_SUFFIX = {
+    "soul": "harem-job",
+    "memorial": "harem-memorial",
+    "burst": "harem-burst",
+    "concierge": "harem-concierge",
+}
+
+KS_TEMPLATE = (
+    '[chara_face name="a" storage="face_{rd}.png"]\n'
+    '[playbgm storage="bgm_{rd}.ogg"]\n'
+    '[bg storage="room-{rd}.jpg"]\n'
+    '[playse storage="se_{rd}.ogg"]\n'
+)
+
+JPEG_STUB = b"\xff\xd8\xff\xe0mock-portrait\xff\xd9"
+
+
+def _resource_directory(seed: int) -> str:
+    return "%032x" % (seed * 2654435761 % (1 << 128))
+
+
+def _scenario_path(rd: str, ext: str) -> str:
+    return f"{rd[-6:-3]}/{rd[-3:]}/{rd}/scenario.{ext}"
+
+
+def synthetic_fixtures(ids: dict, exist_ratio: float = 0.8, seed: int = 0) -> dict:
+    """
+    ids: {"kamihime": [id, ...], "eidolon": [...], "soul": [...], ...}
+    exist_ratio の割合の ID にキャラ/エピソードを作り、残りは 404 にする。
+    """
+    rng = random.Random(seed)
+    fixtures = {"characters": {}, "episodes": {}, "scenes": {}, "static": {}}
+
+    def add_scene(scene_id: str, ext: str):
+        rd = _resource_directory(len(fixtures["scenes"]) + 1)
+        path = _scenario_path(rd, ext)
+        fixtures["scenes"][scene_id] = {
+            "scenario_path": path,
+            "resource_directory": rd,
+            "title": f"Title {scene_id}",
+            "summary": f"Summary {scene_id}",
+        }
+        if ext == "ks":
+            fixtures["static"][path] = KS_TEMPLATE.format(rd=rd[:6])
+        else:
+            fixtures["static"][path] = json.dumps([
+                {"bgm": f"bgm_{rd[:6]}.ogg", "film": [f"{rd[:6]}_1.jpg"],
+                 "talk": [{"voice": f"{rd[:6]}_v1.ogg"}]}
+            ])
+
+    def add_episode(key: str, ep: int):
+        chapter = {}
+        if ep % 2:
+            scene_id = f"s{key}"
+            chapter["scenarios"] = [{"scenario_id": scene_id, "resource_directory": ""}]
+            add_scene(scene_id, "ks")
+        else:
+            scene_id = f"h{key}"
+            chapter["harem_scenes"] = [{"harem_scene_id": scene_id, "resource_directory": ""}]
+            add_scene(scene_id, "json")
+        for field in ("scenarios", "harem_scenes"):
+            for scene in chapter.get(field, []):
+                scene["resource_directory"] = fixtures["scenes"][scene.get("scenario_id") or scene.get("harem_scene_id")]["resource_directory"]
+        fixtures["episodes"][key] = {"chapters": [chapter]}
+
+    for category, suffix in (("kamihime", "harem-character"), ("eidolon", "harem-summon")):
+        for item_id in ids.get(category, []):
+            if rng.random() >= exist_ratio:
+                continue
+            rare = "SSR" if category == "eidolon" else rng.choice(["SSR", "SR", "R"])
+            fixtures["characters"][f"{category}:{item_id}"] = {
+                "name": f"Mock {category} {item_id}",
+                "rare": rare,
+                "description": f"Mock {category} {item_id}",
+            }
+            ep1 = item_id * 10
+            fixtures["characters"][f"{category}:{item_id}"]["episode_id"] = f"{ep1}_{suffix}"
+            for ep in (ep1 - 1, ep1, ep1 + 1):
+                add_episode(f"{ep}_{suffix}", ep)
+
+    for category, suffix in ADV_SUFFIX.items():
+        for item_id in ids.get(category, []):
+            if rng.random() >= exist_ratio:
+                continue
+            key = f"{item_id}_{suffix}"
+            add_episode(key, 1)
+            add_episode(key + "_2", 2)
+            # adv はエピソード 1 つに scenarios と harem_scenes の両方が入る
+            fixtures["episodes"][key]["chapters"][0].update(
+                fixtures["episodes"].pop(key + "_2")["chapters"][0]
+            )
+
+    return fixtures
+
+
+class MockState:
+
+    def __init__(self, fixtures: dict, latency: float = 0.0, jitter: float = 0.5,
+                 error_rate: float = 0.0, expire_after: int = 0, seed: int = 0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.expire_after = expire_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.api_requests = 0
+        self.errors = 0
+        self.paths = {}  # "api:/v1/..." / "static:/..." -> 回数 (同じものを二重に取っていないかの確認用)
+
+    def delay(self):
+        if self.latency <= 0:
+            return
+        with self._lock:
+            spread = self._rng.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, self.latency * (1 + spread)))
+
+    def count(self, api: bool, path: str = ""):
+        with self._lock:
+            self.requests += 1
+            if api:
+                self.api_requests += 1
+            key = ("api:" if api else "static:") + path
+            self.paths[key] = self.paths.get(key, 0) + 1
+            return self.api_requests
+
+    def fail(self) -> bool:
+        with self._lock:
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "api_requests": self.api_requests, "errors": self.errors}
+
+    def path_counts(self) -> dict:
+        with self._lock:
+            return dict(self.paths)
+
+
+def _make_handler(state: MockState, kind: str):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # ヘッダと本文を別々に送るので、Nagle + delayed ACK の 40ms 待ちを避ける
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status: int, body=b"", ctype="application/json"):
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            elif not isinstance(body, bytes):
+                body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            api = kind == "api"
+            n = state.count(api, path)
+            state.delay()
+
+            if api and state.expire_after and n > state.expire_after:
+                return self._reply(440, {"errors": [{"message": "session expired"}]})
+            if state.fail():
+                return self._reply(503, b"<html>busy</html>", "text/html")
+
+            if api:
+                return self._api(path)
+            return self._static(path)
+
+        def _api(self, path):
+            fx = state.fixtures
+            parts = path.strip("/").split("/")
+            # v1/characters/<id>, v1/summons/<id>
+            if len(parts) == 3 and parts[1] in ("characters", "summons"):
+                category = "kamihime" if parts[1] == "characters" else "eidolon"
+                char = fx["characters"].get(f"{category}:{parts[2]}")
+                if char is None:
+                    return self._reply(404, {"errors": [{"message": "not found"}]})
+                return self._reply(200, {k: v for k, v in char.items() if k != "episode_id"})
+            # v1/gacha/harem_episodes/characters|summons/<id>
+            if len(parts) == 5 and parts[1] == "gacha":
+                category = "kamihime" if parts[3] == "characters" else "eidolon"
+                char = fx["characters"].get(f"{category}:{parts[4]}")
+                if char is None:
+                    return self._reply(404, {"errors": [{"message": "not found"}]})
+                return self._reply(200, {"episode_id": char["episode_id"]})
+            # v1/episodes/<ep>_<suffix>
+            if len(parts) == 3 and parts[1] == "episodes":
+                episode = fx["episodes"].get(parts[2])
+                if episode is None:
+                    return self._reply(404, {"errors": [{"message": "not found"}]})
+                return self._reply(200, episode)
+            # v1/scenarios/<scene_id>
+            if len(parts) == 3 and parts[1] == "scenarios":
+                scene = fx["scenes"].get(parts[2])
+                if scene is None:
+                    return self._reply(404, {"errors": [{"message": "not found"}]})
+                return self._reply(200, scene)
+            return self._reply(404, {"errors": [{"message": "unknown endpoint"}]})
+
+        def _static(self, path):
+            if path.startswith("/resources/"):
+                return self._reply(200, JPEG_STUB, "image/jpeg")
+            if path.startswith("/scenarios/"):
+                body = state.fixtures["static"].get(path[len("/scenarios/"):])
+                if body is not None:
+                    ctype = "application/json" if path.endswith(".json") else "text/plain"
+                    return self._reply(200, body, ctype)
+            return self._reply(404, b"<html>not found</html>", "text/html")
+
+    return Handler
+
+
+class MockServer:
+    """API と static を別ポートで立てる (http_client のホスト別ゲートが本番と同じに効くように)"""
+
+    def __init__(self, fixtures: dict, host: str = "127.0.0.1", api_port: int = 0,
+                 static_port: int = 0, **options):
+        self.state = MockState(fixtures, **options)
+        self._api = ThreadingHTTPServer((host, api_port), _make_handler(self.state, "api"))
+        self._static = ThreadingHTTPServer((host, static_port), _make_handler(self.state, "static"))
+        self._api.daemon_threads = True
+        self._static.daemon_threads = True
+        self._threads = []
+
+    @property
+    def api_base(self) -> str:
+        host, port = self._api.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def static_base(self) -> str:
+        host, port = self._static.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        for server in (self._api, self._static):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in (self._api, self._static):
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def ids_from_latest(latest_dict: dict, target: list) -> dict:
+    """latest.txt と同じ規則で ID 一覧を作る (download_json_core の生成関数を使う)"""
+    import download_json_core as core
+
+    ids = {}
+    if "kamihime" in target:
+        ids["kamihime"] = [tpl[2] for tpl in core.generate_kamihime_ids(latest_dict)]
+    if "eidolon" in target:
+        ids["eidolon"] = [tpl[2] for tpl in core.generate_eidolon_ids(latest_dict)]
+    for adv_type in ADV_SUFFIX:
+        if adv_type in target:
+            ids[adv_type] = core.generate_adv_episode_ids(latest_dict, adv_type)
+    return ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local mock of the game API and CDN")
+    parser.add_argument("--latest", default="latest.txt")
+    parser.add_argument("--target", default="all")
+    parser.add_argument("--fixtures", help="load fixtures from this JSON file (or save them there with --save)")
+    parser.add_argument("--save", action="store_true", help="write generated fixtures to --fixtures and exit")
+    parser.add_argument("--exist-ratio", type=float, default=0.8)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--static-port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 503 responses")
+    parser.add_argument("--expire-after", type=int, default=0, help="answer 440 after this many API requests")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+    if args.fixtures and os.path.exists(args.fixtures) and not args.save:
+        with open(args.fixtures, encoding="utf-8") as f:
+            fixtures = json.load(f)
+    else:
+        from download_json_core import load_latest_txt
+        target = list(ADV_SUFFIX) + ["kamihime", "eidolon"] if args.target == "all" else args.target.split(",")
+        fixtures = synthetic_fixtures(ids_from_latest(load_latest_txt(args.latest), target), args.exist_ratio)
+        if args.save and args.fixtures:
+            with open(args.fixtures, "w", encoding="utf-8") as f:
+                json.dump(fixtures, f, ensure_ascii=False)
+            logging.info("Wrote %s", args.fixtures)
+            return 0
+
+    server = MockServer(fixtures, args.host, args.api_port, args.static_port,
+                        latency=args.latency, error_rate=args.error_rate,
+                        expire_after=args.expire_after)
+    server.start()
+    logging.info("API %s / static %s (%d characters, %d episodes)",
+                 server.api_base, server.static_base,
+                 len(fixtures["characters"]), len(fixtures["episodes"]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -67,9 +67,11 @@ def process_json_file(file_path: str):
         # ⑤ 最終検証
         json.dumps(wrapped, ensure_ascii=False)
 
-        # ⑥ 保存
-        with open(file_path, "w", encoding="utf-8") as f:
+        # ⑥ 保存 (読み手がいても壊れた JSON を見せないよう一時ファイル経由で置き換え)
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(wrapped, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, file_path)
 
 
         print(f"[OK] {file_path}")
@@ -78,11 +80,19 @@ def process_json_file(file_path: str):
         print(f"[ERROR] {file_path}: {e}")
 
 def process_root(root_dir: str):
-    for root, _, files in os.walk(root_dir):
+    for root, dirs, files in os.walk(root_dir):
+        # .staging (書きかけのフォルダ) は触らない
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
         for name in files:
             if name.endswith(TARGET_EXT):
                 file_path = os.path.join(root, name)
                 process_json_file(file_path)
 
+def process_files(paths):
+    """指定したファイルだけ処理する (常駐モードで今回保存した分だけ直す用)"""
+    for file_path in paths:
+        if file_path.endswith(TARGET_EXT) and os.path.exists(file_path):
+            process_json_file(file_path)
+
 def main():
     process_root(ROOT_DIR)
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import queue
+import threading
+
+import run_control
+from download_json_core import iter_download_json
+from download_assets_core import run_download_assets, iter_download_assets
+
+# pipeline.py
+# JSON 段階 → アセット段階の連結実行。
+# アセット段階は保存先全体を走査せず、JSON 段階が今回保存したシナリオだけを処理する。
+#   streaming=True : JSON 段階の保存ごとにキュー経由でアセット段階へ流す (並走)
+#   streaming=False: JSON 段階の完了後、asset_plan をまとめてアセット段階へ渡す
+# aiter_download_json / aiter_download_assets は iter_* の async 版 (別スレッドで回して
+# 上限付きキュー経由で受け取るので、読む側が遅ければダウンロード側も待つ)
+
+_DONE = object()
+
+
+def run_pipeline(
+    session: str,
+    target: list[str],
+    latest_dict: dict,
+    save_root: str,
+    modify_json: bool,
+    streaming: bool = True,
+    on_record=None,
+    **json_options
+) -> dict:
+    """
+    on_record: JSON 段階の ID ごとの結果 (iter_download_json 参照) を受け取るコールバック
+    json_options: そのまま iter_download_json へ (http_session / skip_id など)
+    """
+
+    breaker = run_control.breaker
+    breaker.reset()
+
+    def json_run(on_scenario=None):
+        result = None
+        for record in iter_download_json(
+            session=session,
+            target=target,
+            latest_dict=latest_dict,
+            save_root=save_root,
+            modify_json=modify_json,
+            on_scenario=on_scenario,
+            reset_breaker=False,
+            **json_options
+        ):
+            if record["kind"] == "summary":
+                result = record
+            elif on_record is not None:
+                on_record(record)
+        result.pop("kind", None)
+        return result
+
+    if not streaming:
+        json_result = json_run()
+        logging.info("Asset plan: %d scenarios", len(json_result["asset_plan"]))
+        assets_result = run_download_assets(
+            data_directory=save_root,
+            plan=json_result["asset_plan"],
+            reset_breaker=False
+        )
+        return _merge(json_result, assets_result)
+
+    plan_queue = queue.Queue()
+    holder = {}
+
+    def json_stage():
+        try:
+            holder["json"] = json_run(on_scenario=plan_queue.put)
+        except BaseException as e:
+            holder["error"] = e
+        finally:
+            plan_queue.put(_DONE)
+
+    def plan_iter():
+        while True:
+            entry = plan_queue.get()
+            if entry is _DONE:
+                return
+            yield entry
+
+    thread = threading.Thread(target=json_stage, daemon=True)
+    thread.start()
+
+    assets_result = run_download_assets(
+        data_directory=save_root,
+        plan=plan_iter(),
+        reset_breaker=False
+    )
+
+    thread.join()
+
+    if "error" in holder:
+        raise holder["error"]
+
+    return _merge(holder["json"], assets_result)
+
+
+def _merge(json_result: dict, assets_result: dict) -> dict:
+    result = dict(json_result)
+    result["assets"] = assets_result
+    result["success"] = json_result.get("success", True) and assets_result.get("success", True)
+    result["cancelled"] = json_result.get("cancelled", False) or assets_result.get("cancelled", False)
+    result["message"] = json_result.get("message", "") + assets_result.get("message", "")
+    return result
+
+
+async def _aiter_thread(make_iter, maxsize: int):
+    """
+    make_iter() を別スレッドで回し、上限付きキュー経由で受け取る。
+    読む側が途中で抜けた / キャンセルされたら stop を立て、ダウンロード側は次の
+    put で止まって iter_* を close する (iter_* の finally でプール・台帳・ジャーナルを片付ける)
+    """
+    records = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+
+    def put(item) -> bool:
+        """return: 入れられたら True / 読む側が止まったら False"""
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get():
+        while not stop.is_set():
+            try:
+                return records.get(timeout=0.2)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def producer():
+        gen = make_iter()
+        try:
+            for record in gen:
+                if not put(record):
+                    break
+        except BaseException as e:
+            put(e)
+        finally:
+            gen.close()
+            put(_DONE)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            record = await loop.run_in_executor(None, get)
+            if record is _DONE:
+                break
+            if isinstance(record, BaseException):
+                raise record
+            yield record
+    finally:
+        stop.set()
+
+
+def aiter_download_json(maxsize: int = 256, **kwargs):
+    """iter_download_json の async 版 (引数は run_download_json と同じ)"""
+    return _aiter_thread(lambda: iter_download_json(**kwargs), maxsize)
+
+
+def aiter_download_assets(maxsize: int = 256, **kwargs):
+    """iter_download_assets の async 版 (引数は run_download_assets と同じ)"""
+    return _aiter_thread(lambda: iter_download_assets(**kwargs), maxsize)
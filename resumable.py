@@ -0,0 +1,209 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+import configparser
+
+import requests
+
+import http_client
+import run_control
+
+# resumable.py
+# 大きいファイル (BGM や gameData.ksd) を、接続が切れても続きから受け取れるように保存する。
+#   <dst>.part       受信中の本文
+#   <dst>.part.json  その検証子 {"url", "etag", "last_modified", "length"}
+# 切れたときは .part を残し、次 (同じ呼び出しの中で resume_retries 回まで、以後は
+# retry_pass や次の実行) は Range: bytes=<受信済み>- と If-Range を付けて続きを受け取る。
+#   206 (Content-Range が受信済みの位置から) → 追記
+#   200 (Range 非対応 / ファイルが差し替わった) → 最初から書き直す
+#   416 → .part を捨てて最初から
+# If-Range に使える検証子 (強い ETag か Last-Modified) が無い応答と、圧縮して送られてきた
+# 応答は続きを頼めないので、.part を残さない。
+
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+config = configparser.RawConfigParser()
+config.read(os.path.join(BASE_DIR, "setting.ini"))
+# 1 回の fetch の中で続きから取り直す回数
+resume_retries = config.getint('network', 'resume_retries', fallback=2)
+# これより小さい .part は続きを頼まずに最初から取る (bytes)
+resume_min = config.getint('network', 'resume_min', fallback=64 * 1024)
+
+CHUNK_SIZE = 256 * 1024
+
+# 本文の途中で切れたときの例外 (これ以外は .part を残しても続きから取り直さない)
+RESUMABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+def _validator(meta: dict):
+    """If-Range に使う値 (弱い ETag は使えない)"""
+    etag = meta.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return meta.get("last_modified")
+
+
+def resume_point(url: str, part: str):
+    """return: (受信済みの bytes, If-Range の値) / 続きから取れなければ (0, None)"""
+    try:
+        size = os.path.getsize(part)
+        with open(part + ".json", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return 0, None
+    validator = _validator(meta)
+    if meta.get("url") != url or not validator or size < resume_min:
+        return 0, None
+    if meta.get("length") and size >= meta["length"]:
+        return 0, None
+    return size, validator
+
+
+def discard(part: str):
+    for path in (part, part + ".json"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_meta(url: str, part: str, r, length):
+    meta = {
+        "url": url,
+        "etag": r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "length": length,
+    }
+    encoding = r.headers.get("Content-Encoding", "identity").lower()
+    if not _validator(meta) or encoding != "identity":
+        # 続きを頼めない
+        if os.path.exists(part + ".json"):
+            os.remove(part + ".json")
+        return False
+    with open(part + ".json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return True
+
+
+def _fetch_once(s, url: str, dst: str, check, chunk_size: int, kwargs: dict, result: dict):
+    part = dst + ".part"
+    offset, validator = resume_point(url, part)
+    headers = dict(kwargs.get("headers") or {})
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+
+    r = http_client.get(s, url, **dict(kwargs, headers=headers, stream=True))
+    with r:
+        result["status"] = r.status_code
+        length = None
+        if r.status_code == 206 and offset:
+            m = _CONTENT_RANGE.match(r.headers.get("Content-Range", ""))
+            if not m or int(m.group(1)) != offset:
+                # 頼んでいない範囲が来た。最初から取り直す
+                logging.warning("%s: unexpected Content-Range %r", url, r.headers.get("Content-Range"))
+                discard(part)
+                return None
+            length = int(m.group(3)) if m.group(3) != "*" else None
+            mode = "ab"
+        elif r.status_code == 200:
+            if offset:
+                logging.info("%s: server sent the whole file instead of a range", url)
+            offset = 0
+            # 圧縮して送られてきたときの Content-Length は圧縮後の大きさで、iter_content が返す
+            # (展開後の) 量とは比べられない。その応答は続きも頼めないので長さを見ない
+            encoding = r.headers.get("Content-Encoding", "identity").lower()
+            if encoding == "identity" and r.headers.get("Content-Length", "").isdigit():
+                length = int(r.headers["Content-Length"])
+            mode = "wb"
+        elif r.status_code == 416 and offset:
+            discard(part)
+            return None
+        else:
+            if r.status_code not in http_client.RETRY_STATUS:
+                discard(part)
+            return result
+
+        chunks = r.iter_content(chunk_size)
+        head = next(chunks, b"")
+        if mode == "wb" and check is not None and not check(r, head):
+            discard(part)
+            result["rejected"] = True
+            return result
+
+        h = hashlib.sha1()
+        if mode == "ab":
+            with open(part, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(block)
+            keep = True
+        else:
+            keep = _write_meta(url, part, r, length)
+
+        size = offset
+        try:
+            with open(part, mode) as f:
+                f.write(head)
+                h.update(head)
+                size += len(head)
+                result["bytes"] += len(head)
+                for chunk in chunks:
+                    f.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+                    result["bytes"] += len(chunk)
+            if length is not None and size != length:
+                raise requests.exceptions.ChunkedEncodingError(
+                    f"Incomplete body: {size}/{length} bytes", request=r.request)
+        except BaseException:
+            if not keep or (length is not None and size > length):
+                discard(part)
+            raise
+
+    os.replace(part, dst)
+    discard(part)
+    if mode == "ab":
+        result["resumed"] = offset
+    result["saved"] = True
+    result["sha1"] = h.hexdigest()
+    return result
+
+
+def fetch(s, url: str, dst: str, check=None, chunk_size: int = CHUNK_SIZE, **kwargs) -> dict:
+    """
+    url を dst に保存する。.part に受け取り、最後まで来たら dst に置き換える。
+    check(response, head): 最初の塊を見て False なら保存しない (エラーページ等)。
+    kwargs は http_client.get にそのまま渡す (stream は常に True)。
+    return: {"status": 最後の応答の HTTP status, "saved", "bytes": 今回受け取った量,
+             "resumed": 続きから受け取ったときの開始位置 (0 = 最初から), "sha1": 保存したファイル全体}
+    本文の途中で切れたら resume_retries 回まで続きから取り直し、それでもだめなら送出する
+    (.part は残るので、次に同じ dst を取るときに続きから受け取る)。
+    """
+    result = {"status": None, "saved": False, "bytes": 0, "resumed": 0, "sha1": None}
+    attempt = 0
+    while True:
+        try:
+            done = _fetch_once(s, url, dst, check, chunk_size, kwargs, result)
+        except RESUMABLE_ERRORS as e:
+            if attempt >= resume_retries or resume_point(url, dst + ".part")[0] == 0:
+                raise
+            delay = http_client.backoff_delay(attempt)
+            attempt += 1
+            logging.warning("%s: %s (resume %d/%d in %.1fs)", url, e, attempt, resume_retries, delay)
+            run_control.breaker.sleep(delay)
+            continue
+        if done is not None:
+            return done
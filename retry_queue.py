@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# retry_queue.py
+# 通信エラー等で取れなかったアセットの再試行待ち (retry.jsonl に 1 件 1 行で追記)。
+#   {"link", "resource_directory", "attempts", "error", "failed_at"}   失敗
+#   {"link", "done": true}                                             取れた / 404 だった
+# 同じ link は後の行が優先。アセット実行の最後にまとめて取り直し (download_assets_core.retry_pass)、
+# 取れなかった分は次の実行 (または retry_only の実行) に持ち越す。
+
+class RetryQueue:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = {}
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._file = None
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた最終行
+                    continue
+                self._lines += 1
+                if rec.get("done"):
+                    self._entries.pop(rec["link"], None)
+                else:
+                    self._entries[rec["link"]] = rec
+
+    def _append(self, rec: dict):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._lines += 1
+
+    def __contains__(self, link: str) -> bool:
+        return link in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, link: str, resource_directory: str, error: str = ""):
+        with self._lock:
+            prev = self._entries.get(link)
+            rec = {
+                "link": link,
+                "resource_directory": resource_directory,
+                "attempts": (prev["attempts"] if prev else 0) + 1,
+                "error": error,
+                "failed_at": time.time(),
+            }
+            self._entries[link] = rec
+            try:
+                self._append(rec)
+            except OSError as e:
+                logging.error("Failed to write %s : %s", self.path, e)
+
+    def done(self, link: str):
+        if link not in self._entries:
+            return
+        with self._lock:
+            if self._entries.pop(link, None) is None:
+                return
+            try:
+                self._append({"link": link, "done": True})
+            except OSError as e:
+                logging.error("Failed to write %s : %s", self.path, e)
+
+    def items(self) -> list:
+        """(link, resource_directory) の一覧 (失敗の古い順)"""
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda rec: rec["failed_at"])
+        return [(rec["link"], rec["resource_directory"]) for rec in entries]
+
+    def compact(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                self._entries = {}
+                self._lines = 0
+                self._load()
+            if not self._entries:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                self._lines = 0
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for rec in self._entries.values():
+                    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+            self._lines = len(self._entries)
+
+    def maybe_compact(self):
+        if self._lines > 2 * len(self._entries) + 100 or (self._lines and not self._entries):
+            self.compact()
@@ -0,0 +1,132 @@
+import os
+import sys
+import logging
+import threading
+import configparser
+from collections import deque
+
+# run_control.py
+# 実行全体のキャンセル (circuit breaker)
+#   - 440 (セッション切れ) で即停止
+#   - 直近 error_window 件のエラー率が error_rate_threshold を超えたら停止
+# 停止すると登録済みの全 future のうち未着手のものをキャンセルし、
+# 以降のリクエストは RunCancelled を送出する。
+
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+SETTING_PATH = os.path.join(BASE_DIR, "setting.ini")
+
+config = configparser.RawConfigParser()
+config.read(SETTING_PATH)
+
+error_rate_threshold = config.getfloat('network', 'error_rate_threshold', fallback=0.5)
+error_window = config.getint('network', 'error_window', fallback=50)
+
+
+class RunCancelled(BaseException):
+    """
+    実行中止。元の sys.exit(1) と同じく except Exception をすり抜けて
+    ワーカーの外まで伝わるよう BaseException を継承する。
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class SessionExpired(RunCancelled):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold: float, window: int):
+        self.threshold = threshold
+        self.window = max(1, window)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._event = threading.Event()
+            self._exc = None
+            self._results = deque(maxlen=self.window)
+            self._futures = []
+
+    @property
+    def tripped(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def reason(self) -> str:
+        return self._exc.reason if self._exc else ""
+
+    @property
+    def expired(self) -> bool:
+        """440 (セッション切れ) で止まったか"""
+        return isinstance(self._exc, SessionExpired)
+
+    def check(self):
+        if self._event.is_set():
+            raise type(self._exc)(self._exc.reason)
+
+    def sleep(self, seconds: float):
+        """中止されたら待機を打ち切って RunCancelled"""
+        if self._event.wait(seconds):
+            self.check()
+
+    def track(self, futures: list):
+        """
+        trip 時にキャンセルする future のリストを登録 (登録後に append した分も対象)。
+        executor.shutdown(cancel_futures=True) はキューから外した future を
+        as_completed に通知しないため、future.cancel() を個別に呼ぶ。
+        """
+        with self._lock:
+            self._futures.append(futures)
+            tripped = self._event.is_set()
+
+        if tripped:
+            for fut in list(futures):
+                fut.cancel()
+
+    def untrack(self, futures: list):
+        with self._lock:
+            self._futures = [f for f in self._futures if f is not futures]
+
+    def trip(self, reason: str, exc_type=RunCancelled):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._exc = exc_type(reason)
+            self._event.set()
+            tracked = list(self._futures)
+
+        logging.error("Run cancelled: %s", reason)
+
+        for futures in tracked:
+            for fut in list(futures):
+                fut.cancel()
+
+    def record(self, failed: bool):
+        with self._lock:
+            self._results.append(failed)
+            if len(self._results) < self.window:
+                return
+            rate = sum(self._results) / len(self._results)
+
+        if rate > self.threshold:
+            self.trip(
+                f"Error rate {rate:.0%} over the last {self.window} requests"
+            )
+
+
+breaker = CircuitBreaker(error_rate_threshold, error_window)
+
+
+def session_expired():
+    breaker.trip("Token incorrect or expired (440)", SessionExpired)
+    breaker.check()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import logging
+import argparse
+
+import job_journal
+import work_ledger
+import download_json_core
+import download_assets_core
+from download_json_core import run_download_json, load_latest_txt
+from download_assets_core import run_download_assets
+
+# shard_worker.py
+# 分担モードのワーカー (コマンドライン)。同じ台帳 (--ledger) と同じ保存先を
+# 指定したワーカーを何個でも (別プロセス・別マシンで) 起動でき、
+# 作業は台帳から早い者勝ちで取るので重複しない。
+#
+#   python shard_worker.py json   --session XXX --target all --save-root D:/scenariosForBeta --ledger D:/ledger.db
+#   python shard_worker.py assets --save-root D:/scenariosForBeta --ledger D:/ledger.db
+#
+# アセット・KSD の展開先と ignore.jsonl / retry.jsonl / asset_manifest.db は --assets-root
+# (省略すると台帳と同じフォルダの assets) に置くので、全ワーカーで 1 つのライブラリになる。
+#
+# --worker を省略するとホスト名-PID。落ちたワーカーを同じ --worker で
+# 起動し直すと、自分の lease と自分のジャーナル (journal-<worker>.jsonl) を引き継ぐ。
+
+TARGETS = ["kamihime", "eidolon", "soul", "memorial", "burst", "concierge"]
+
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+LATEST_PATH = os.path.join(BASE_DIR, "latest.txt")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded KP Downloader worker")
+    parser.add_argument("stage", choices=["json", "assets"])
+    parser.add_argument("--save-root", required=True)
+    parser.add_argument("--ledger", required=True, help="shared SQLite ledger file")
+    parser.add_argument("--assets-root", default=None,
+                        help="shared assets folder (default: 'assets' next to the ledger)")
+    parser.add_argument("--worker", default=None, help="worker id (default: host-pid)")
+    parser.add_argument("--lease", type=float, default=60.0, help="lease seconds")
+    parser.add_argument("--session", default=os.environ.get("KH_SESSION", ""))
+    parser.add_argument("--target", default="all")
+    parser.add_argument("--latest", default=LATEST_PATH)
+    parser.add_argument("--shard-size", type=int, default=50, help="IDs per work unit")
+    parser.add_argument("--no-modify-json", action="store_true")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    logging.getLogger().addHandler(console)
+    logging.getLogger().setLevel(logging.INFO)
+
+    stage = "asset" if args.stage == "assets" else "json"
+    ledger = work_ledger.Ledger(args.ledger, stage, owner=args.worker, lease=args.lease)
+
+    # ジャーナルはワーカーごとに分ける (他のワーカーの途中作業を拾わない)
+    job_journal.set_path(os.path.join(
+        BASE_DIR, "journal-%s.jsonl" % re.sub(r'[^\w.-]', '_', ledger.owner)
+    ))
+
+    # アセット・KSD の展開先は全ワーカー共通 (各自の BASE_DIR/assets に散らばらないように)
+    assets_root = args.assets_root or os.path.join(os.path.dirname(os.path.abspath(args.ledger)), "assets")
+    download_assets_core.set_assets_root(assets_root)
+    download_json_core.ASSETS_ROOT = assets_root
+
+    logging.info("Worker %s: %s stage, ledger %s, assets %s", ledger.owner, stage, args.ledger, assets_root)
+
+    if args.stage == "json":
+        if not args.session:
+            logging.error("--session (or KH_SESSION) is required.")
+            return 2
+        target = TARGETS if args.target == "all" else args.target.split(",")
+        result = run_download_json(
+            session=args.session,
+            target=target,
+            latest_dict=load_latest_txt(args.latest),
+            save_root=args.save_root,
+            modify_json=not args.no_modify_json,
+            ledger=ledger,
+            shard_size=args.shard_size
+        )
+    else:
+        result = run_download_assets(
+            data_directory=args.save_root,
+            ledger=ledger
+        )
+
+    print(result["message"])
+    logging.info("Ledger (%s): %s", stage, ledger.summary())
+    return 0 if result.get("success", True) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
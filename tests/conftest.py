@@ -0,0 +1,21 @@
+import os
+import sys
+import tempfile
+
+# tests/ からリポジトリ直下のモジュールを import できるようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# download_json_core は import 時にカレントに 0_error.log を作るので、作業フォルダの外で動かす
+os.chdir(tempfile.mkdtemp(prefix="kp-tests-"))
+
+# setting.ini が無いと download_json_core / download_assets_core が既定値で作るので、
+# テストが作った分は最後に消す
+SETTING_PATH = os.path.join(ROOT, "setting.ini")
+_had_setting = os.path.exists(SETTING_PATH)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if not _had_setting and os.path.exists(SETTING_PATH):
+        os.remove(SETTING_PATH)
@@ -0,0 +1,62 @@
+import threading
+
+import http_client
+
+
+class _Response:
+    status_code = 200
+
+    def close(self):
+        pass
+
+
+class _SlowFirstSession:
+    """1 本目だけ release されるまで返さない (複製が先に勝つ)"""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.primary_done = threading.Event()
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self.calls += 1
+            first = self.calls == 1
+        if first:
+            self.release.wait(10)
+            self.primary_done.set()
+        return _Response()
+
+
+class _FixedLatency:
+    def percentile(self, p):
+        return 0.05
+
+    def add(self, latency):
+        pass
+
+
+def test_hedge_keeps_primary_slot_until_it_finishes(monkeypatch):
+    monkeypatch.setattr(http_client, "hedge_enabled", True)
+    monkeypatch.setattr(http_client, "latency_stats",
+                        {key: _FixedLatency() for key in http_client.latency_stats})
+    url = "https://api.example.invalid/v1/characters/1"
+    limit = http_client.limits[http_client.host_key(url)]
+    before = limit.in_flight
+
+    s = _SlowFirstSession()
+    r = http_client.request(s, "GET", url)
+
+    assert r.status_code == 200
+    assert s.calls == 2
+    # 複製が勝って戻っても、まだ送信中の 1 本目の枠は返していない
+    assert limit.in_flight == before + 1
+
+    s.release.set()
+    assert s.primary_done.wait(10)
+    for _ in range(100):
+        if limit.in_flight == before:
+            break
+        threading.Event().wait(0.01)
+    assert limit.in_flight == before
@@ -0,0 +1,53 @@
+import gzip
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+import resumable
+
+BODY = b"gameData" * 25000
+
+
+class _GzipHandler(BaseHTTPRequestHandler):
+    """BODY を Content-Encoding: gzip で返す (Content-Length は圧縮後の大きさ)"""
+
+    def do_GET(self):
+        payload = gzip.compress(BODY)
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gzip_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _GzipHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    yield f"http://{host}:{port}/gameData.ksd"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_gzip_encoded_response(gzip_server, tmp_path):
+    dst = str(tmp_path / "gameData.ksd")
+    with requests.Session() as s:
+        got = resumable.fetch(s, gzip_server, dst, timeout=10)
+
+    assert got["status"] == 200
+    assert got["saved"]
+    assert got["bytes"] == len(BODY)
+    with open(dst, "rb") as f:
+        assert f.read() == BODY
+    # 圧縮された応答は続きを頼めないので .part は残らない
+    assert not os.path.exists(dst + ".part")
+    assert not os.path.exists(dst + ".part.json")
@@ -0,0 +1,95 @@
+import os
+import sys
+import sqlite3
+import subprocess
+
+from conftest import ROOT
+from mock_server import MockServer, synthetic_fixtures, ids_from_latest
+
+LATEST = {"kamihime_5": "30", "soul": "15"}
+TARGET = ["kamihime", "soul"]
+SHARD_SIZE = 4
+WORKERS = 3
+
+# ワーカー 1 つ分。接続先を mock に向け、保存先以外の書き込み (ポートレート・index.csv・
+# 形式の学習・ジャーナル) も一時フォルダに向けてから shard_worker.main を呼ぶ
+LAUNCHER = """
+import os, sys
+sys.path.insert(0, sys.argv[1])
+api, static, work = sys.argv[2:5]
+import http_client, format_hints, write_csv, shard_worker
+import download_json_core as core
+import download_portrait as portrait
+core.set_base_urls(api, static)
+portrait.ICON_DIR = os.path.join(work, "portrait")
+portrait.ILLUST_DIR = os.path.join(work, "portrait_full")
+format_hints.HINTS_PATH = os.path.join(work, "format_hints-%d.json" % os.getpid())
+write_csv.INDEX_PATH = os.path.join(work, "index.csv")
+shard_worker.BASE_DIR = work
+for bucket in http_client.buckets.values():
+    bucket.rate = 0
+sys.exit(shard_worker.main(sys.argv[5:]))
+"""
+
+
+def test_workers_split_json_stage(tmp_path):
+    work = str(tmp_path)
+    save_root = os.path.join(work, "save")
+    ledger = os.path.join(work, "ledger.db")
+    latest = os.path.join(work, "latest.txt")
+    with open(latest, "w", encoding="utf-8") as f:
+        for key, value in LATEST.items():
+            f.write(f"{key}: {value}\n")
+
+    ids = ids_from_latest(LATEST, TARGET)
+    fixtures = synthetic_fixtures(ids, exist_ratio=0.8)
+
+    with MockServer(fixtures, latency=0.005) as server:
+        procs = [
+            subprocess.Popen(
+                [sys.executable, "-c", LAUNCHER, ROOT, server.api_base, server.static_base, work,
+                 "json", "--session", "test", "--target", ",".join(TARGET),
+                 "--latest", latest, "--save-root", save_root, "--ledger", ledger,
+                 "--shard-size", str(SHARD_SIZE), "--worker", f"w{n}"],
+                cwd=work, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            )
+            for n in range(WORKERS)
+        ]
+        outputs = [proc.communicate(timeout=300)[0].decode("utf-8", "replace") for proc in procs]
+        paths = server.state.path_counts()
+
+    for proc, output in zip(procs, outputs):
+        assert proc.returncode == 0, output
+
+    # 帯はすべて 1 回ずつ取られて done
+    expected_units = {
+        f"{category}:{item_id // SHARD_SIZE * SHARD_SIZE}"
+        for category, id_list in ids.items() for item_id in id_list
+    }
+    with sqlite3.connect(ledger) as db:
+        rows = db.execute("SELECT key, state, attempts FROM units WHERE stage='json'").fetchall()
+    assert {key for key, _, _ in rows} == expected_units
+    assert all(state == "done" and attempts == 1 for _, state, attempts in rows), rows
+
+    # どの ID の info / エピソード / シナリオ本体も、ワーカー全体で 1 回しか問い合わせていない
+    fetched_twice = {path: n for path, n in paths.items() if n > 1}
+    assert not fetched_twice
+    for category, id_list in ids.items():
+        for item_id in id_list:
+            path = (f"api:/v1/characters/{item_id}" if category == "kamihime"
+                    else f"api:/v1/episodes/{item_id}_harem-job")
+            assert paths.get(path) == 1, path
+    assert any(path.startswith("static:/scenarios/") for path in paths)
+
+    # 存在する ID のフォルダはそれぞれ 1 つ確定し、一時フォルダには何も残っていない
+    saved = []
+    for folder, dirs, files in os.walk(save_root):
+        if ".staging" in dirs:
+            for leftover, _, names in os.walk(os.path.join(folder, ".staging")):
+                assert not names, leftover
+            dirs.remove(".staging")
+        if files:
+            saved.append(folder)
+    characters = [key for key in fixtures["characters"] if key.startswith("kamihime:")]
+    episodes = [key for key in fixtures["episodes"] if key.endswith("_harem-job")]
+    assert len(saved) == len(characters) + len(episodes)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import configparser
+
+import http_client
+import run_control
+from pipeline import run_pipeline
+from download_json_core import load_latest_txt
+
+# watch.py
+# 常駐モード。一定間隔で新しいシナリオを探し、見つかった分だけ
+# JSON → KSD → アセットの順に (pipeline.run_pipeline で並走させて) 取得する。
+# 1 回ごとに作り直していたものを常駐中は使い回す:
+#   - requests.Session (接続プール) と api 応答の条件付き GET キャッシュ
+#   - ID 台帳 (id_manifest.json): 取得済み / 存在しない ID は問い合わせない
+#   - 保存先のフォルダ一覧 (LibraryIndex): 全走査は rescan_interval ごとだけ
+#   - latest.txt は更新されたときだけ読み直す
+# 1 回あたりの通信量は新規分 (+ missing_ttl を過ぎた未公開 ID) に比例する。
+#
+#   python watch.py --session XXX --target all --save-root D:/scenariosForBeta
+
+TARGETS = ["kamihime", "eidolon", "soul", "memorial", "burst", "concierge"]
+
+def get_base_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.dirname(os.path.abspath(__file__))
+
+BASE_DIR = get_base_dir()
+SETTING_PATH = os.path.join(BASE_DIR, "setting.ini")
+LATEST_PATH = os.path.join(BASE_DIR, "latest.txt")
+MANIFEST_PATH = os.path.join(BASE_DIR, "id_manifest.json")
+
+config = configparser.RawConfigParser()
+config.read(SETTING_PATH)
+# 巡回間隔 (秒)
+watch_interval = config.getfloat('watch', 'interval', fallback=1800)
+# 存在しなかった ID を次に問い合わせるまでの時間 (秒)
+missing_ttl = config.getfloat('watch', 'missing_ttl', fallback=21600)
+# 保存先フォルダを全走査し直す間隔 (秒)
+rescan_interval = config.getfloat('watch', 'rescan_interval', fallback=86400)
+# api 応答キャッシュの件数
+http_cache_entries = config.getint('watch', 'http_cache_entries', fallback=4096)
+
+
+class IdManifest:
+    """
+    "<category>:<id>" -> {"status": "saved" | "missing", "save_dir", "checked"}
+    saved  : フォルダ確定済み (save_dir がある限り問い合わせない)
+    missing: 存在しなかった (missing_ttl を過ぎたら問い合わせ直す)
+    error / cancelled の ID は消して次回やり直す。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except Exception as e:
+                logging.warning("Failed to read %s : %s", path, e)
+
+    def get(self, category: str, item_id: int):
+        with self._lock:
+            return self._entries.get(f"{category}:{item_id}")
+
+    def update(self, record: dict):
+        key = f"{record['category']}:{record['id']}"
+        with self._lock:
+            if record["status"] in ("saved", "skipped") and record.get("save_dir"):
+                self._entries[key] = {
+                    "status": "saved",
+                    "save_dir": record["save_dir"],
+                    "checked": time.time(),
+                }
+            elif record["status"] == "missing":
+                self._entries[key] = {"status": "missing", "checked": time.time()}
+            else:
+                self._entries.pop(key, None)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+class LibraryIndex:
+    """保存先の <種類>/<キャラ> フォルダ一覧 (メモリ上)。rescan_interval ごとに作り直す"""
+
+    def __init__(self, save_root: str):
+        self.save_root = save_root
+        self._dirs = set()
+        self.scanned = 0.0
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.normcase(os.path.abspath(path))
+
+    def rescan(self):
+        dirs = set()
+        if os.path.isdir(self.save_root):
+            for kind in os.scandir(self.save_root):
+                if not kind.is_dir() or kind.name.startswith('.'):
+                    continue
+                for char in os.scandir(kind.path):
+                    if char.is_dir():
+                        dirs.add(self._key(char.path))
+        self._dirs = dirs
+        self.scanned = time.time()
+        logging.info("Library index: %d folders", len(dirs))
+
+    def refresh(self):
+        if time.time() - self.scanned >= rescan_interval:
+            self.rescan()
+
+    def add(self, path: str):
+        self._dirs.add(self._key(path))
+
+    def __contains__(self, path: str) -> bool:
+        return self._key(path) in self._dirs
+
+
+class Watcher:
+
+    def __init__(self, session, target, save_root, modify_json=True, latest_path=LATEST_PATH):
+        self.session = session
+        self.target = target
+        self.save_root = save_root
+        self.modify_json = modify_json
+        self.latest_path = latest_path
+
+        self.headers = {
+            'x-kh-session': session,
+            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.113 Safari/537.36'
+        }
+        self.http_session = http_client.new_session(self.headers)
+        http_client.response_cache = http_client.HttpCache(http_cache_entries)
+
+        self.manifest = IdManifest(MANIFEST_PATH)
+        self.library = LibraryIndex(save_root)
+        self._latest = {}
+        self._latest_mtime = None
+        self._stop = threading.Event()
+
+    def latest(self) -> dict:
+        try:
+            mtime = os.path.getmtime(self.latest_path)
+        except OSError:
+            mtime = None
+        if mtime != self._latest_mtime:
+            self._latest = load_latest_txt(self.latest_path)
+            self._latest_mtime = mtime
+            logging.info("Loaded %s", self.latest_path)
+        return self._latest
+
+    def skip_id(self, category: str, item_id: int) -> bool:
+        entry = self.manifest.get(category, item_id)
+        if entry is None:
+            return False
+        if entry["status"] == "saved":
+            return entry["save_dir"] in self.library
+        if entry["status"] == "missing":
+            return time.time() - entry["checked"] < missing_ttl
+        return False
+
+    def on_record(self, record: dict):
+        self.manifest.update(record)
+        if record.get("save_dir") and record["status"] in ("saved", "skipped"):
+            self.library.add(record["save_dir"])
+
+    def cycle(self) -> dict:
+        self.library.refresh()
+        hits = http_client.response_cache.hits
+        started = time.monotonic()
+
+        try:
+            result = run_pipeline(
+                session=self.session,
+                target=self.target,
+                latest_dict=self.latest(),
+                save_root=self.save_root,
+                modify_json=self.modify_json,
+                on_record=self.on_record,
+                http_session=self.http_session,
+                skip_id=self.skip_id,
+                modify_new_only=True
+            )
+        finally:
+            self.manifest.save()
+
+        logging.info(
+            "Cycle done in %.1fs: %d new scenarios, %d cached API responses",
+            time.monotonic() - started,
+            len(result.get("asset_plan", [])),
+            http_client.response_cache.hits - hits
+        )
+        return result
+
+    def run_forever(self, interval: float = None):
+        interval = watch_interval if interval is None else interval
+        while not self._stop.is_set():
+            result = self.cycle()
+            print(result["message"])
+            if result.get("cancelled") and run_control.breaker.expired:
+                logging.error("Session expired. Stopping watch mode.")
+                return result
+            logging.info("Next check in %d seconds", interval)
+            if self._stop.wait(interval):
+                break
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="KP Downloader watch mode")
+    parser.add_argument("--session", default=os.environ.get("KH_SESSION", ""))
+    parser.add_argument("--target", default="all")
+    parser.add_argument("--save-root", required=True)
+    parser.add_argument("--latest", default=LATEST_PATH)
+    parser.add_argument("--interval", type=float, default=None, help="seconds between checks")
+    parser.add_argument("--once", action="store_true", help="run a single check and exit")
+    parser.add_argument("--no-modify-json", action="store_true")
+    args = parser.parse_args(argv)
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    logging.getLogger().addHandler(console)
+    logging.getLogger().setLevel(logging.INFO)
+
+    if not args.session:
+        logging.error("--session (or KH_SESSION) is required.")
+        return 2
+
+    target = TARGETS if args.target == "all" else args.target.split(",")
+    watcher = Watcher(args.session, target, args.save_root,
+                      modify_json=not args.no_modify_json, latest_path=args.latest)
+
+    if args.once:
+        result = watcher.cycle()
+        print(result["message"])
+        return 0 if result.get("success", True) else 1
+
+    try:
+        watcher.run_forever(args.interval)
+    except KeyboardInterrupt:
+        logging.info("Stopped.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
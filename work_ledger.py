@@ -0,0 +1,230 @@
+import os
+import time
+import socket
+import logging
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+
+# work_ledger.py
+# 複数プロセス/複数台で 1 つのライブラリを分担するための作業台帳 (SQLite)。
+# 共有ディスク上の 1 ファイルを全ワーカーで開き、作業単位 (unit) を早い者勝ちで取る。
+#   - 取った単位には lease (期限) が付き、ハートビートのスレッドが期限を延ばし続ける
+#   - ワーカーが落ちて期限が切れた単位は、他のワーカーが取り直す
+#   - 終わった単位は done になり、どのワーカーももう取らない
+# stage ごとに単位を分ける ("json": カテゴリ + ID の帯, "asset": シナリオ)。
+#
+# 注意: ネットワークドライブによってはファイルロックが正しく効かない (SMB の
+# oplock 等)。その場合は台帳だけローカルディスクに置き、各ワーカーから同じ
+# マシンで動かすこと。
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    stage       TEXT NOT NULL,
+    key         TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    owner       TEXT,
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    updated     REAL,
+    PRIMARY KEY (stage, key)
+)
+"""
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Ledger:
+
+    def __init__(
+        self,
+        path: str,
+        stage: str,
+        owner: str = None,
+        lease: float = 60.0,
+        max_attempts: int = 3,
+        poll: float = 2.0
+    ):
+        self.path = path
+        self.stage = stage
+        self.owner = owner or default_owner()
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll = poll
+        self._stop = threading.Event()
+        self._thread = None
+
+        with self._connect() as db:
+            db.execute(SCHEMA)
+
+    def _connect(self):
+        # スレッドごとに接続を作る (sqlite3 の接続はスレッド間で共有できない)
+        return closing(sqlite3.connect(self.path, timeout=60, isolation_level=None))
+
+    # -----------------------------
+    # claim / complete
+    # -----------------------------
+    def state(self, key: str):
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT state, owner, lease_until FROM units WHERE stage=? AND key=?",
+                (self.stage, key)
+            ).fetchone()
+        return row
+
+    def _taken(self, row, now) -> bool:
+        """他のワーカーが持っている / もう誰も取らない単位か"""
+        if row is None:
+            return False
+        state, owner, lease_until = row[:3]
+        if state in (DONE, FAILED):
+            return True
+        if state == LEASED and owner != self.owner and (lease_until or 0) > now:
+            return True
+        return False
+
+    def try_claim(self, key: str) -> bool:
+        now = time.time()
+        # 大半は done / 他ワーカーの lease 中なので、まずは読むだけで判定する
+        if self._taken(self.state(key), now):
+            return False
+
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT state, owner, lease_until, attempts FROM units WHERE stage=? AND key=?",
+                    (self.stage, key)
+                ).fetchone()
+                now = time.time()
+                if self._taken(row, now):
+                    db.execute("COMMIT")
+                    return False
+
+                attempts = (row[3] if row else 0) + 1
+                if attempts > self.max_attempts:
+                    db.execute(
+                        "UPDATE units SET state=?, owner=NULL, updated=? WHERE stage=? AND key=?",
+                        (FAILED, now, self.stage, key)
+                    )
+                    db.execute("COMMIT")
+                    logging.error("Giving up %s %s after %d attempts", self.stage, key, attempts - 1)
+                    return False
+
+                db.execute(
+                    "INSERT OR REPLACE INTO units (stage, key, state, owner, lease_until, attempts, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (self.stage, key, LEASED, self.owner, now + self.lease, attempts, now)
+                )
+                db.execute("COMMIT")
+                return True
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def complete(self, key: str):
+        self._finish(key, DONE)
+
+    def release(self, key: str):
+        """失敗・中断した単位を他のワーカー (または次回) に戻す"""
+        self._finish(key, PENDING)
+
+    def _finish(self, key: str, state: str):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE units SET state=?, owner=NULL, lease_until=NULL, updated=? "
+                "WHERE stage=? AND key=? AND owner=?",
+                (state, time.time(), self.stage, key, self.owner)
+            )
+
+    def claim_iter(self, units):
+        """
+        units: (key, value) の iterable。取れた単位の (key, value) を yield する。
+        他のワーカーが作業中だった単位は最後にまとめて見直し、そのワーカーが
+        落ちて lease が切れていれば取り直す。見直しで何も取れなかったときは
+        None を yield するので、呼び出し側は自分の作業を進めるか poll 秒待ってから
+        次を取りに来ること (ここで待つと、自分の作業の完了を台帳に書けなくなる)。
+        """
+        waiting = []
+        for key, value in units:
+            if self.try_claim(key):
+                yield key, value
+            elif self._is_leased_by_other(key):
+                waiting.append((key, value))
+
+        while waiting:
+            still = []
+            claimed = False
+            for key, value in waiting:
+                if self.try_claim(key):
+                    claimed = True
+                    yield key, value
+                elif self._is_leased_by_other(key):
+                    still.append((key, value))
+            waiting = still
+            if waiting and not claimed:
+                yield None
+
+    def _is_leased_by_other(self, key: str) -> bool:
+        row = self.state(key)
+        return row is not None and row[0] == LEASED and row[1] != self.owner
+
+    # -----------------------------
+    # heartbeat
+    # -----------------------------
+    def renew(self):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE units SET lease_until=? WHERE stage=? AND owner=? AND state=?",
+                (time.time() + self.lease, self.stage, self.owner, LEASED)
+            )
+
+    def start_heartbeat(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _heartbeat(self):
+        interval = max(1.0, self.lease / 3)
+        while not self._stop.wait(interval):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logging.warning("Ledger heartbeat failed: %s", e)
+
+    # -----------------------------
+    # misc
+    # -----------------------------
+    @contextmanager
+    def exclusive(self):
+        """全ワーカー共通の排他区間 (index.csv の追記など)"""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            finally:
+                db.execute("COMMIT")
+
+    def summary(self) -> dict:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT state, COUNT(*) FROM units WHERE stage=? GROUP BY state",
+                (self.stage,)
+            ).fetchall()
+        return dict(rows)
+